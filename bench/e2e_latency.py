@@ -0,0 +1,399 @@
+"""End-to-end latency benchmark: level change at station 2 -> pump command at station 1.
+
+Each station runs in its own process against a pty-backed virtual serial
+port. The harness plays the Arduino on the other end of every pty (same
+frames as heltec_node.ino, JSON or binary), and the stations talk through an
+in-process MQTT broker stand-in (mini_broker) unless --broker is given.
+
+Station 2's float switches are toggled between empty and full. Station 1's
+relay command is expected to follow (empty -> pump on, full -> pump off) and
+the time from writing the level frame to receiving the command is recorded.
+
+    python bench/e2e_latency.py --duration 30 --output bench_output.json
+
+Results are printed (or written) as JSON: latency percentiles, MQTT and
+serial message rates, and CPU/RSS per station process. With --record DIR
+each station records its traffic to DIR/station<id>.log for
+traffic_replay:
+
+    python src/traffic_replay.py replay --station 1 --role source --check /tmp/rec/station1.log
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import pty
+import select
+import signal
+import sys
+import threading
+import time
+import tty
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+sys.path.insert(0, HERE)
+
+import serial_protocol  # noqa: E402
+from mini_broker import MiniBroker  # noqa: E402
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+class SimulatedArduino:
+    """The Arduino end of a virtual serial port, mimicking heltec_node.ino."""
+
+    def __init__(self, station_id, allow_binary=True):
+        self.station_id = station_id
+        self.allow_binary = allow_binary
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        self.port = os.ttyname(self.slave)
+        self.inputs = {
+            "pump_status": False,
+            "pressure_switch": True,
+            "top_level": True,
+            "bottom_level": True,
+            "fault": False,
+            "op_mode": True,
+        }
+        self.outputs = {}
+        self.binary_mode = False
+        self.tx_seq = 0
+        self.frames_sent = 0
+        self.commands_received = 0
+        self.on_command = None      # callback(key, value, monotonic_time)
+        self.write_lock = threading.Lock()
+        self.buffer = bytearray()
+        self.running = True
+        threading.Thread(target=self.read_loop, daemon=True).start()
+
+    def send_status(self, event="heartbeat", arg=0):
+        """Write one status frame; returns the monotonic time just before the write."""
+        with self.write_lock:
+            if self.binary_mode:
+                payload = serial_protocol.encode_status(self.station_id, self.inputs, event, arg)
+                frame = serial_protocol.encode_frame(serial_protocol.STATUS, payload, self.tx_seq)
+                self.tx_seq = (self.tx_seq + 1) & 0xFF
+            else:
+                data = {"station_id": self.station_id}
+                data.update(self.inputs)
+                data["event"] = event
+                if event == "change":
+                    data["age_ms"] = arg
+                elif event == "poll":
+                    data["poll"] = arg
+                frame = (json.dumps(data) + "\n").encode()
+            sent = time.monotonic()
+            os.write(self.master, frame)
+            self.frames_sent += 1
+            return sent
+
+    def read_loop(self):
+        while self.running:
+            ready, _, _ = select.select([self.master], [], [], 0.5)
+            if not ready:
+                continue
+            try:
+                chunk = os.read(self.master, 4096)
+            except OSError:
+                return
+            now = time.monotonic()
+            self.buffer += chunk
+            self.parse(now)
+
+    def parse(self, now):
+        buffer = self.buffer
+        while buffer:
+            if buffer[0] == serial_protocol.SYNC:
+                consumed, frame = serial_protocol.parse_frame(buffer)
+                if not consumed:
+                    return
+                del buffer[:consumed]
+                if frame and frame[0] == serial_protocol.COMMAND:
+                    mask, values = frame[2][0], frame[2][1]
+                    for key, bit in serial_protocol.COMMAND_BITS.items():
+                        if mask >> bit & 1:
+                            self.apply(key, bool(values >> bit & 1), now)
+                elif frame and frame[0] == serial_protocol.POLL:
+                    self.send_status("poll", frame[2][0])
+                continue
+            end = buffer.find(b"\n")
+            if end < 0:
+                return
+            line = bytes(buffer[:end])
+            del buffer[:end + 1]
+            try:
+                command = json.loads(line)
+            except ValueError:
+                continue
+            if "proto" in command and self.allow_binary:
+                with self.write_lock:
+                    self.binary_mode = True
+                    payload = bytes((serial_protocol.VERSION, self.station_id))
+                    os.write(self.master, serial_protocol.encode_frame(serial_protocol.HELLO, payload, self.tx_seq))
+                    self.tx_seq = (self.tx_seq + 1) & 0xFF
+                continue
+            if "poll" in command:
+                self.send_status("poll", command.pop("poll"))
+            for key, value in command.items():
+                self.apply(key, value, now)
+
+    def apply(self, key, value, now):
+        self.commands_received += 1
+        self.outputs[key] = value
+        if self.on_command:
+            self.on_command(key, value, now)
+        if key == "pump_control" and self.inputs["pump_status"] != bool(value):
+            # The relay feeds back into the pump status input, reported as a change
+            self.inputs["pump_status"] = bool(value)
+            self.send_status("change")
+
+    def close(self):
+        self.running = False
+        os.close(self.master)
+        os.close(self.slave)
+
+
+ROLE_KWARGS = {
+    "source": {"control_pump": True, "has_tank": False},
+    "intermediate": {"control_pump": True, "has_tank": True},
+    "monitor": {"control_pump": False, "has_tank": True},
+}
+
+
+def record_path(record_dir, station_id):
+    return os.path.join(record_dir, f"station{station_id}.log") if record_dir else None
+
+
+def run_station(station_id, role, broker, broker_port, serial_port, runtime, verbose, telemetry_codec="json",
+                record_dir=None):
+    """Entry point of a station process."""
+    if not verbose:
+        sys.stdout = open(os.devnull, "w")
+    import pump_station
+
+    station = pump_station.PumpStation(station_id=station_id, broker=broker, broker_port=broker_port,
+                                       serial_ports=[serial_port], runtime=runtime,
+                                       telemetry_codec=telemetry_codec,
+                                       traffic_log_path=record_path(record_dir, station_id), **ROLE_KWARGS[role])
+    # Clean up on terminate() so a traffic log is complete
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        if runtime == "asyncio":
+            import async_runtime
+            async_runtime.run(station)   # returns once interrupted
+        else:
+            while True:
+                time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    station.cleanup()
+
+
+def run_host(specs, broker, broker_port, verbose, telemetry_codec="json", record_dir=None):
+    """Entry point of the --hosted process: every station on one StationHost."""
+    if not verbose:
+        sys.stdout = open(os.devnull, "w")
+    import station_host
+
+    host = station_host.StationHost("bench", broker=broker, port=broker_port)
+    for station_id, role, serial_port in specs:
+        host.add_station(station_id, [serial_port], telemetry_codec=telemetry_codec,
+                         traffic_log_path=record_path(record_dir, station_id), **ROLE_KWARGS[role])
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        host.cleanup()
+
+
+def proc_cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def proc_rss_kb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    # Nearest-rank percentile
+    index = min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+class LatencyProbe:
+    """Pairs level changes at the downstream station with relay commands upstream."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = None         # (expected relay value, time the level frame was written)
+        self.samples = []
+        self.missed = 0
+
+    def expect(self, value, sent):
+        with self.lock:
+            if self.pending is not None:
+                self.missed += 1
+            self.pending = (value, sent)
+
+    def on_command(self, key, value, received):
+        if key != "pump_control":
+            return
+        with self.lock:
+            if self.pending and self.pending[0] == bool(value):
+                self.samples.append(received - self.pending[1])
+                self.pending = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stations", type=int, default=3, help="stations in the chain (default 3)")
+    parser.add_argument("--duration", type=float, default=30, help="measurement time in seconds")
+    parser.add_argument("--toggle-interval", type=float, default=0.5, help="seconds between level changes")
+    parser.add_argument("--frame-interval", type=float, default=5, help="Arduino status heartbeat in seconds")
+    parser.add_argument("--warmup", type=float, default=4, help="seconds to let stations connect")
+    parser.add_argument("--runtime", choices=("threads", "asyncio"), default="threads")
+    parser.add_argument("--telemetry-codec", choices=("json", "compact", "zlib"), default="json",
+                        help="payload encoding of station telemetry")
+    parser.add_argument("--json-serial", action="store_true", help="don't negotiate binary serial frames")
+    parser.add_argument("--hosted", action="store_true",
+                        help="run every station in one process on a shared MQTT connection (station_host)")
+    parser.add_argument("--broker", help="host:port of an external broker instead of the in-process one")
+    parser.add_argument("--record", metavar="DIR", help="record each station's traffic to DIR/station<id>.log")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--verbose", action="store_true", help="keep station output")
+    args = parser.parse_args()
+
+    broker = None
+    if args.broker:
+        host, _, port = args.broker.partition(":")
+        port = int(port or 1883)
+    else:
+        broker = MiniBroker()
+        host, port = "127.0.0.1", broker.start_in_thread()
+
+    station_ids = list(range(1, args.stations + 1))
+    arduinos = {sid: SimulatedArduino(sid, allow_binary=not args.json_serial) for sid in station_ids}
+    ctx = multiprocessing.get_context("spawn")
+    roles = {sid: "source" if sid == 1 else "monitor" if sid == station_ids[-1] else "intermediate"
+             for sid in station_ids}
+    processes = {}   # report key -> (process, station ids it runs)
+    if args.hosted:
+        if args.runtime != "threads":
+            parser.error("--hosted runs on the threaded runtime")
+        specs = [(sid, roles[sid], arduinos[sid].port) for sid in station_ids]
+        processes["host"] = (ctx.Process(target=run_host, daemon=True,
+                                         args=(specs, host, port, args.verbose, args.telemetry_codec,
+                                               args.record)), station_ids)
+    else:
+        for sid in station_ids:
+            processes[str(sid)] = (ctx.Process(target=run_station, daemon=True,
+                                               args=(sid, roles[sid], host, port, arduinos[sid].port, args.runtime,
+                                                     args.verbose, args.telemetry_codec, args.record)), [sid])
+    for process, _ in processes.values():
+        process.start()
+
+    probe = LatencyProbe()
+    arduinos[1].on_command = probe.on_command
+
+    # Heartbeat frames like SEND_INTERVAL on the Arduino
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(args.frame_interval):
+            for arduino in arduinos.values():
+                arduino.send_status()
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+
+    time.sleep(args.warmup)
+    for arduino in arduinos.values():
+        arduino.send_status()
+    time.sleep(1)
+
+    cpu_start = {key: proc_cpu_seconds(process.pid) for key, (process, _) in processes.items()}
+    routed_start = broker.messages_routed if broker else 0
+    bytes_start = broker.bytes_routed if broker else 0
+    frames_start = sum(a.frames_sent for a in arduinos.values())
+    started = time.monotonic()
+
+    downstream = arduinos[2]
+    empty = True
+    while time.monotonic() - started < args.duration:
+        downstream.inputs["top_level"] = not empty
+        downstream.inputs["bottom_level"] = not empty
+        probe.expect(empty, downstream.send_status("change"))
+        empty = not empty
+        time.sleep(args.toggle_interval)
+
+    elapsed = time.monotonic() - started
+    stop.set()
+    stations = {}
+    for key, (process, sids) in processes.items():
+        cpu = proc_cpu_seconds(process.pid) - cpu_start[key]
+        stations[key] = {
+            "pid": process.pid,
+            "cpu_seconds": round(cpu, 3),
+            "cpu_percent": round(100 * cpu / elapsed, 2),
+            "rss_kb": proc_rss_kb(process.pid),
+            "serial_commands_received": sum(arduinos[sid].commands_received for sid in sids),
+            "binary_serial": all(arduinos[sid].binary_mode for sid in sids),
+        }
+        process.terminate()
+    # Let the stations clean up (and close their traffic logs) before the
+    # multiprocessing atexit handler interrupts them
+    for process, _ in processes.values():
+        process.join(5)
+
+    latencies_ms = [sample * 1000 for sample in probe.samples]
+    report = {
+        "config": {
+            "stations": args.stations,
+            "duration_s": round(elapsed, 3),
+            "toggle_interval_s": args.toggle_interval,
+            "frame_interval_s": args.frame_interval,
+            "runtime": args.runtime,
+            "telemetry_codec": args.telemetry_codec,
+            "serial_protocol": "json" if args.json_serial else "auto",
+            "hosted": args.hosted,
+            "broker": args.broker or "in-process",
+        },
+        "sensor_to_relay_ms": {
+            "count": len(latencies_ms),
+            "missed": probe.missed,
+            "p50": percentile(latencies_ms, 0.50),
+            "p99": percentile(latencies_ms, 0.99),
+            "max": max(latencies_ms) if latencies_ms else None,
+            "mean": sum(latencies_ms) / len(latencies_ms) if latencies_ms else None,
+        },
+        "mqtt_messages_per_sec": round((broker.messages_routed - routed_start) / elapsed, 2) if broker else None,
+        "mqtt_payload_bytes_per_sec": round((broker.bytes_routed - bytes_start) / elapsed, 2) if broker else None,
+        "serial_frames_per_sec": round((sum(a.frames_sent for a in arduinos.values()) - frames_start) / elapsed, 2),
+        "stations": stations,
+    }
+
+    for arduino in arduinos.values():
+        arduino.close()
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""Fleet load test for the aggregator: hundreds of simulated stations at 1 Hz.
+
+The aggregator runs in its own process against an in-process MQTT broker
+stand-in (mini_broker) unless --broker is given. A few MQTT connections
+publish on behalf of every simulated station: a retained snapshot at start,
+then one telemetry delta per station per second (spread evenly over the
+second), like a PumpStation whose alive pulse is folded into its telemetry.
+Meanwhile the query API is polled and its response time recorded.
+
+    python bench/fleet_sim.py --stations 500 --duration 30 --output fleet_output.json
+
+The JSON report has the query latency percentiles, how many stations the
+aggregator shows online and how stale their last_seen is, and the
+aggregator's CPU/RSS.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import threading
+import time
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+sys.path.insert(0, HERE)
+
+import paho.mqtt.client as mqtt  # noqa: E402
+
+import mqtt_client  # noqa: E402
+import payload_codec  # noqa: E402
+from e2e_latency import percentile, proc_cpu_seconds, proc_rss_kb  # noqa: E402
+from mini_broker import MiniBroker  # noqa: E402
+
+
+def run_aggregator(broker, broker_port, http_port, verbose):
+    """Entry point of the aggregator process."""
+    if not verbose:
+        sys.stdout = open(os.devnull, "w")
+    import aggregator
+
+    fleet = aggregator.FleetAggregator(broker, broker_port, capacity=16)
+    fleet.serve(http_port)
+    while True:
+        time.sleep(3600)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class StationPublisher(threading.Thread):
+    """Publishes telemetry for a slice of the simulated stations over one connection."""
+
+    def __init__(self, index, station_ids, host, port, codec, stop):
+        super().__init__(daemon=True)
+        self.station_ids = station_ids
+        self.codec = codec
+        self.stop = stop
+        self.published = 0
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=f"fleet_sim_{index}")
+        self.client.connect(host, port)
+        self.client.loop_start()
+
+    def publish(self, station_id, data, retain=False):
+        self.client.publish(mqtt_client.station_topic(station_id, "telemetry"),
+                            payload_codec.encode(data, self.codec), retain=retain)
+        self.published += 1
+
+    def run(self):
+        levels = {}
+        for station_id in self.station_ids:
+            levels[station_id] = False
+            self.publish(station_id, {"station_id": station_id, "pressure_switch": True, "top_level": False,
+                                      "bottom_level": False, "pump_status": False, "fault_detected": False,
+                                      "op_mode": True, "soft_manual": False, "is_next_station_online": True,
+                                      "last_time_of_next_station": time.time()}, retain=True)
+
+        spacing = 1.0 / len(self.station_ids)
+        next_send = time.monotonic()
+        while not self.stop.is_set():
+            for station_id in self.station_ids:
+                delta = {"station_id": station_id, "delta": True, "last_time_of_next_station": time.time()}
+                if random.random() < 0.1:
+                    levels[station_id] = not levels[station_id]
+                    delta["top_level"] = delta["bottom_level"] = levels[station_id]
+                self.publish(station_id, delta)
+                next_send += spacing
+                delay = next_send - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+def timed_get(url):
+    started = time.perf_counter()
+    with urllib.request.urlopen(url, timeout=5) as response:
+        body = response.read()
+    return (time.perf_counter() - started) * 1000, body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stations", type=int, default=300, help="simulated stations (default 300)")
+    parser.add_argument("--publishers", type=int, default=4, help="MQTT connections the stations share")
+    parser.add_argument("--duration", type=float, default=30, help="measurement time in seconds")
+    parser.add_argument("--query-interval", type=float, default=0.05, help="seconds between API queries")
+    parser.add_argument("--warmup", type=float, default=3, help="seconds to let the aggregator connect")
+    parser.add_argument("--codec", choices=payload_codec.CODECS, default="json",
+                        help="payload encoding of the simulated telemetry")
+    parser.add_argument("--broker", help="host:port of an external broker instead of the in-process one")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--verbose", action="store_true", help="keep aggregator output")
+    args = parser.parse_args()
+
+    broker = None
+    if args.broker:
+        host, _, port = args.broker.partition(":")
+        port = int(port or 1883)
+    else:
+        broker = MiniBroker()
+        host, port = "127.0.0.1", broker.start_in_thread()
+
+    http_port = free_port()
+    ctx = multiprocessing.get_context("spawn")
+    process = ctx.Process(target=run_aggregator, args=(host, port, http_port, args.verbose), daemon=True)
+    process.start()
+    time.sleep(args.warmup)
+
+    station_ids = list(range(1, args.stations + 1))
+    stop = threading.Event()
+    publishers = [StationPublisher(i, station_ids[i::args.publishers], host, port, args.codec, stop)
+                  for i in range(min(args.publishers, args.stations))]
+    for publisher in publishers:
+        publisher.start()
+    time.sleep(2)
+
+    base = f"http://127.0.0.1:{http_port}"
+    cpu_start = proc_cpu_seconds(process.pid)
+    routed_start = broker.messages_routed if broker else 0
+    published_start = sum(p.published for p in publishers)
+    started = time.monotonic()
+    all_ms, one_ms, errors = [], [], 0
+    while time.monotonic() - started < args.duration:
+        try:
+            all_ms.append(timed_get(base + "/stations")[0])
+            one_ms.append(timed_get(f"{base}/stations/{random.choice(station_ids)}")[0])
+        except OSError:
+            errors += 1
+        time.sleep(args.query_interval)
+    elapsed = time.monotonic() - started
+    cpu = proc_cpu_seconds(process.pid) - cpu_start
+    rss_kb = proc_rss_kb(process.pid)
+    published = sum(p.published for p in publishers) - published_start
+
+    _, body = timed_get(base + "/stations")
+    rows = json.loads(body)
+    now = time.time()
+    staleness = [now - row["last_seen"] for row in rows if row["last_seen"]]
+    stop.set()
+    process.terminate()
+
+    report = {
+        "config": {
+            "stations": args.stations,
+            "publishers": len(publishers),
+            "duration_s": round(elapsed, 3),
+            "codec": args.codec,
+            "broker": args.broker or "in-process",
+        },
+        "published_per_sec": round(published / elapsed, 2),
+        "mqtt_messages_per_sec": round((broker.messages_routed - routed_start) / elapsed, 2) if broker else None,
+        "query_all_ms": {"count": len(all_ms), "p50": percentile(all_ms, 0.5), "p99": percentile(all_ms, 0.99),
+                         "max": max(all_ms) if all_ms else None},
+        "query_one_ms": {"count": len(one_ms), "p50": percentile(one_ms, 0.5), "p99": percentile(one_ms, 0.99),
+                         "max": max(one_ms) if one_ms else None},
+        "query_errors": errors,
+        "stations_in_table": len(rows),
+        "stations_online": sum(1 for row in rows if row["online"]),
+        "last_seen_age_s": {"p50": percentile(staleness, 0.5), "max": max(staleness) if staleness else None},
+        "aggregator": {
+            "cpu_percent": round(100 * cpu / elapsed, 2),
+            "rss_kb": rss_kb,
+        },
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""Compare the fixed and the adaptive local-mode pump timer on a simulated tank.
+
+A simple tank model stands in for the chain: station 1's pump fills the
+downstream tank at --inflow (fraction of the tank per hour) while it drains
+at --outflow. The float switches sit at 20 % (bottom) and 80 % (top) and the
+tank overflows at 100 %.
+
+1. --history-days of normal network operation (pump on at the bottom switch,
+   off at the top) are written to a telemetry history file, the way
+   PumpStation records them.
+2. pump_analytics turns that history into cycle statistics and a local
+   schedule.
+3. A --outage-hours comms outage is simulated twice from the same starting
+   level: with the fixed LOCAL_PUMP_INTERVAL timer and with the adaptive one.
+
+    python bench/local_schedule_sim.py --inflow 2.0 --outflow 0.8 --output schedule_output.json
+
+The report gives pump hours, overflow minutes (pumping into a full tank) and
+dry minutes (empty tank) for both timers.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+
+import control_engine  # noqa: E402
+import pump_analytics  # noqa: E402
+import telemetry_history  # noqa: E402
+
+BOTTOM, TOP = 0.2, 0.8
+STEP = 10.0   # seconds per simulation step
+
+
+class Tank:
+    def __init__(self, level, inflow, outflow):
+        self.level = level
+        self.inflow = inflow / 3600 * STEP
+        self.outflow = outflow / 3600 * STEP
+
+    def step(self, pump_on):
+        """Advance one step; returns (overflowing, dry)."""
+        self.level += (self.inflow if pump_on else 0) - self.outflow
+        overflowing = self.level > 1.0
+        dry = self.level < 0.0
+        self.level = min(max(self.level, 0.0), 1.0)
+        return overflowing and pump_on, dry
+
+    def downstream_bits(self):
+        if self.level < BOTTOM:
+            return control_engine.DOWNSTREAM_EMPTY
+        if self.level >= TOP:
+            return control_engine.DOWNSTREAM_FULL
+        return 0
+
+
+def record_history(history, tank, seconds, start_time, interval=60.0):
+    """Network-mode operation: what PumpStation would write to its history."""
+    pump_on = False
+    last = None
+    last_time = 0
+    now = start_time
+    for _ in range(int(seconds / STEP)):
+        bits = tank.downstream_bits()
+        if bits & control_engine.DOWNSTREAM_EMPTY:
+            pump_on = True
+        elif bits & control_engine.DOWNSTREAM_FULL:
+            pump_on = False
+        inputs = telemetry_history.pack_inputs({"pressure_switch": True, "pump_status": pump_on, "op_mode": True})
+        flags = telemetry_history.NEXT_ONLINE | (telemetry_history.PUMP_COMMAND if pump_on else 0)
+        record = (inputs, flags, bits | telemetry_history.DOWNSTREAM_AUTO)
+        if record != last or now - last_time >= interval:
+            history.append(now, *record)
+            last, last_time = record, now
+        tank.step(pump_on)
+        now += STEP
+    return now
+
+
+def simulate_outage(schedule, tank, hours):
+    """Run the local timer as PumpStation.run_local_timer does, starting with the adaptive phase rule."""
+    toggle = not (schedule.adaptive and tank.downstream_bits() & control_engine.DOWNSTREAM_FULL)
+    pump_on = False
+    last_switch = -1e9
+    pump_seconds = overflow_seconds = dry_seconds = 0.0
+    for i in range(int(hours * 3600 / STEP)):
+        now = i * STEP
+        interval = schedule.off_seconds if toggle else schedule.on_seconds
+        if now - last_switch >= interval:
+            last_switch = now
+            pump_on = toggle
+            toggle = not toggle
+        overflowing, dry = tank.step(pump_on)
+        pump_seconds += STEP if pump_on else 0
+        overflow_seconds += STEP if overflowing else 0
+        dry_seconds += STEP if dry else 0
+    return {
+        "pump_hours": round(pump_seconds / 3600, 2),
+        "overflow_minutes": round(overflow_seconds / 60, 1),
+        "dry_minutes": round(dry_seconds / 60, 1),
+        "end_level": round(tank.level, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--inflow", type=float, default=2.0, help="tank fraction per hour the pump adds")
+    parser.add_argument("--outflow", type=float, default=0.8, help="tank fraction per hour consumed")
+    parser.add_argument("--history-days", type=float, default=3)
+    parser.add_argument("--outage-hours", type=float, default=24)
+    parser.add_argument("--start-level", type=float, default=0.5, help="tank level when the outage starts")
+    parser.add_argument("--interval", type=float, default=2700, help="fixed LOCAL_PUMP_INTERVAL in seconds")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        history = telemetry_history.TelemetryHistory(os.path.join(directory, "history.bin"))
+        end = record_history(history, Tank(0.5, args.inflow, args.outflow), args.history_days * 86400, 0.0)
+        records = history.query(end - args.history_days * 86400)
+        stats = pump_analytics.analyze(records, control_engine.SOURCE)
+        history.close()
+
+    fixed = pump_analytics.LocalSchedule(args.interval, args.interval)
+    adaptive = pump_analytics.local_schedule(stats, args.interval)
+    report = {
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "history": stats.as_dict(),
+        "schedules": {
+            "fixed": {"on_seconds": fixed.on_seconds, "off_seconds": fixed.off_seconds},
+            "adaptive": {"on_seconds": round(adaptive.on_seconds, 1), "off_seconds": round(adaptive.off_seconds, 1),
+                         "adaptive": adaptive.adaptive},
+        },
+        "outage": {
+            "fixed": simulate_outage(fixed, Tank(args.start_level, args.inflow, args.outflow), args.outage_hours),
+            "adaptive": simulate_outage(adaptive, Tank(args.start_level, args.inflow, args.outflow),
+                                        args.outage_hours),
+        },
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""Minimal in-process MQTT 3.1.1 broker used as a stand-in for mosquitto.
+
+Supports what the pump stations use: CONNECT (with Last Will), SUBSCRIBE /
+UNSUBSCRIBE with + and # wildcards, PUBLISH at QoS 0/1 (delivered at QoS 0),
+retained messages, PINGREQ and DISCONNECT. It is not meant for production.
+"""
+import asyncio
+import struct
+import threading
+
+
+def topic_matches(sub, topic):
+    sub_parts = sub.split("/")
+    topic_parts = topic.split("/")
+    for i, part in enumerate(sub_parts):
+        if part == "#":
+            return True
+        if i >= len(topic_parts):
+            return False
+        if part != "+" and part != topic_parts[i]:
+            return False
+    return len(sub_parts) == len(topic_parts)
+
+
+def encode_length(length):
+    out = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        out.append(byte)
+        if not length:
+            return bytes(out)
+
+
+def publish_packet(topic, payload, retain=False):
+    topic_bytes = topic.encode()
+    body = struct.pack("!H", len(topic_bytes)) + topic_bytes + payload
+    return bytes([0x30 | (1 if retain else 0)]) + encode_length(len(body)) + body
+
+
+class Session:
+    def __init__(self, broker, reader, writer):
+        self.broker = broker
+        self.reader = reader
+        self.writer = writer
+        self.subscriptions = set()
+        self.will = None
+        self.client_id = ""
+
+    async def read_packet(self):
+        header = await self.reader.readexactly(1)
+        multiplier, length = 1, 0
+        while True:
+            byte = (await self.reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            if not byte & 0x80:
+                break
+            multiplier *= 128
+        body = await self.reader.readexactly(length) if length else b""
+        return header[0], body
+
+    def write(self, data):
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+    async def run(self):
+        clean = False
+        try:
+            while True:
+                header, body = await self.read_packet()
+                kind = header >> 4
+                if kind == 1:
+                    self.handle_connect(body)
+                elif kind == 3:
+                    self.handle_publish(header, body)
+                elif kind == 8:
+                    self.handle_subscribe(body)
+                elif kind == 10:
+                    packet_id = body[:2]
+                    self.write(b"\xb0\x02" + packet_id)
+                elif kind == 12:
+                    self.write(b"\xd0\x00")
+                elif kind == 14:
+                    clean = True
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.broker.sessions.discard(self)
+            if not clean and self.will:
+                self.broker.route(*self.will)
+            self.writer.close()
+
+    def handle_connect(self, body):
+        pos = 2 + struct.unpack("!H", body[:2])[0]
+        flags = body[pos + 1]
+        pos += 4
+        def read_str():
+            nonlocal pos
+            size = struct.unpack("!H", body[pos:pos + 2])[0]
+            value = body[pos + 2:pos + 2 + size]
+            pos += 2 + size
+            return value
+        self.client_id = read_str().decode()
+        if flags & 0x04:
+            will_topic = read_str().decode()
+            will_payload = read_str()
+            self.will = (will_topic, will_payload, bool(flags & 0x20))
+        self.write(b"\x20\x02\x00\x00")
+
+    def handle_publish(self, header, body):
+        qos = (header >> 1) & 0x03
+        retain = bool(header & 0x01)
+        size = struct.unpack("!H", body[:2])[0]
+        topic = body[2:2 + size].decode()
+        pos = 2 + size
+        if qos:
+            packet_id = body[pos:pos + 2]
+            pos += 2
+            self.write(b"\x40\x02" + packet_id)
+        self.broker.route(topic, body[pos:], retain)
+
+    def handle_subscribe(self, body):
+        packet_id = body[:2]
+        pos = 2
+        granted = bytearray()
+        new_subs = []
+        while pos < len(body):
+            size = struct.unpack("!H", body[pos:pos + 2])[0]
+            sub = body[pos + 2:pos + 2 + size].decode()
+            pos += 3 + size
+            self.subscriptions.add(sub)
+            new_subs.append(sub)
+            granted.append(0)
+        self.write(b"\x90" + encode_length(2 + len(granted)) + packet_id + bytes(granted))
+        for topic, payload in list(self.broker.retained.items()):
+            if any(topic_matches(sub, topic) for sub in new_subs):
+                self.write(publish_packet(topic, payload, retain=True))
+
+
+class MiniBroker:
+    def __init__(self, host="127.0.0.1", port=0):
+        self.host = host
+        self.port = port
+        self.sessions = set()
+        self.retained = {}
+        self.messages_routed = 0
+        self.bytes_routed = 0     # payload bytes received from publishers
+        self.loop = None
+        self.server = None
+
+    def route(self, topic, payload, retain=False):
+        self.messages_routed += 1
+        self.bytes_routed += len(payload)
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        packet = publish_packet(topic, payload)
+        for session in list(self.sessions):
+            if any(topic_matches(sub, topic) for sub in session.subscriptions):
+                session.write(packet)
+
+    async def handle_client(self, reader, writer):
+        session = Session(self, reader, writer)
+        self.sessions.add(session)
+        await session.run()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def start_in_thread(self):
+        """Run the broker on its own event loop thread and return the bound port."""
+        ready = threading.Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            self.loop.run_until_complete(self.start())
+            ready.set()
+            self.loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        ready.wait()
+        return self.port
+
+
+async def serve_forever(broker):
+    await broker.start()
+    print(f"Mini broker listening on {broker.host}:{broker.port}")
+    await broker.server.serve_forever()
+
+
+if __name__ == "__main__":
+    asyncio.run(serve_forever(MiniBroker(port=1883)))
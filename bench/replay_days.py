@@ -0,0 +1,123 @@
+"""Replay days of synthetic station 1 traffic on a virtual clock.
+
+A traffic log is written the way a recording station 1 (river pump) would
+write it, without running anything in real time:
+
+- the Arduino's binary status heartbeat every 5 s
+- station 2's alive pulse every 2 s, telemetry deltas every 5 s and a
+  snapshot whenever its tank level changes (empty, half, full, every
+  --level-period hours)
+- a daily --outage-hours silence from station 2 starting at noon, during
+  which station 1 falls back to the local 45-minute pump timer
+
+traffic_replay then replays the log into a PumpStation as fast as it can.
+The report gives the log size, the replay speed, and the local-mode pump
+switches the station made during the outages.
+
+    python bench/replay_days.py --days 3 --output replay_output.json
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+
+import mqtt_client  # noqa: E402
+import serial_protocol  # noqa: E402
+import traffic_log  # noqa: E402
+import traffic_replay  # noqa: E402
+
+START = 1_700_000_000.0
+LEVELS = ({"bottom_level": False, "top_level": False}, {"bottom_level": True, "top_level": False},
+          {"bottom_level": True, "top_level": True})
+
+
+class Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def write_log(path, days, level_period, outage_hours):
+    """Station 1's traffic for days; returns the outage windows as (start, end)."""
+    clock = Clock(START)
+    recorder = traffic_log.TrafficRecorder(path, max_bytes=1 << 40, clock=clock)
+    telemetry = mqtt_client.station_topic(2, "telemetry")
+    alive = mqtt_client.station_topic(2, "alive")
+    inputs = {"pressure_switch": True, "op_mode": True}
+    outages = [(START + day * 86400 + 12 * 3600, START + day * 86400 + (12 + outage_hours) * 3600)
+               for day in range(int(days + 0.999))]
+
+    recorder.mqtt_state(True)
+    seq = 0
+    last_level = None
+    for second in range(int(days * 86400)):
+        clock.now = now = START + second
+        if second % 5 == 0:
+            payload = serial_protocol.encode_status(1, dict(inputs, pump_status=False), "heartbeat")
+            recorder.serial_in(serial_protocol.encode_frame(serial_protocol.STATUS, payload, seq))
+            seq = (seq + 1) & 0xFF
+        if any(start <= now < end for start, end in outages):
+            continue
+        level = LEVELS[int(second / (level_period * 3600 / len(LEVELS))) % len(LEVELS)]
+        if level is not last_level:
+            snapshot = dict(station_id=2, pressure_switch=True, pump_status=False, fault_detected=False,
+                            op_mode=True, soft_manual=False, is_next_station_online=True,
+                            last_time_of_next_station=now - 1, **level)
+            recorder.mqtt_message(telemetry, json.dumps(snapshot).encode())
+            last_level = level
+        elif second % 5 == 0:
+            delta = {"station_id": 2, "delta": True, "last_time_of_next_station": now - 1}
+            recorder.mqtt_message(telemetry, json.dumps(delta).encode())
+        if second % 2 == 0:
+            recorder.mqtt_message(alive, json.dumps({"station_id": "station_2", "status": "ALIVE"}).encode())
+    recorder.close()
+    return outages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--days", type=float, default=3)
+    parser.add_argument("--level-period", type=float, default=4, help="hours per empty/half/full level cycle")
+    parser.add_argument("--outage-hours", type=float, default=6, help="daily silence of station 2")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "traffic.log")
+        outages = write_log(path, args.days, args.level_period, args.outage_hours)
+        log_bytes = os.path.getsize(path)
+        replayer = traffic_replay.Replayer(1, START, control_pump=True, has_tank=False)
+        summary = replayer.run(traffic_log.read(path))
+        replayer.cleanup()
+
+    # Pump switches made in local mode during the outages, and the time between them
+    switches = [when for when, kind, _, data in replayer.outputs
+                if kind == "serial" and "pump_control" in data and any(start <= when < end for start, end in outages)]
+    intervals = [b - a for a, b in zip(switches, switches[1:]) if b - a < 3 * 3600]
+    report = {
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "log_bytes": log_bytes,
+        "log_bytes_per_day": round(log_bytes / args.days),
+        "replay": summary,
+        "outage_pump_switches": len(switches),
+        "outage_switch_interval_s": statistics.median(intervals) if intervals else None,
+        "mode_changes": [(round(when - START), data) for when, kind, _, data in replayer.outputs if kind == "mode"][:8],
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+"""Fleet aggregator: the "station 0" supervisor.
+
+Subscribes to the telemetry and alive topics of every station (pumps/+/...),
+keeps the latest state of each in a table, and sends set_pump /
+set_soft_manual commands to their cmd topics. A small HTTP API serves the
+table to operator tools so they don't have to listen to MQTT themselves:
+
+    GET  /stations                    every station heard from
+    GET  /stations/<id>               one station
+    POST /stations/<id>/pump          {"value": true}
+    POST /stations/<id>/soft_manual   {"value": true}
+
+    python aggregator.py --broker 10.10.0.248 --http-port 8081
+
+Stations sharing a connection (station_host) name its Last Will topic in
+their ONLINE status; an OFFLINE there marks all of them offline at once.
+
+The table is a set of arrays indexed by station_id, with the station's inputs
+and flags in one bitfield, so applying a snapshot or a delta is a handful of
+item assignments and memory stays flat however much traffic comes in.
+"""
+import argparse
+import json
+import logging
+import math
+import threading
+import time
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+import metrics
+import mqtt_client
+
+logger = logging.getLogger(__name__)
+
+# Bit of each boolean telemetry field in the state bitfield
+FIELD_BITS = {
+    "pressure_switch": 1 << 0,
+    "top_level": 1 << 1,
+    "bottom_level": 1 << 2,
+    "pump_status": 1 << 3,
+    "fault_detected": 1 << 4,
+    "op_mode": 1 << 5,
+    "soft_manual": 1 << 6,
+    "is_next_station_online": 1 << 7,
+}
+
+# status column
+UNKNOWN, ONLINE, OFFLINE = 0, 1, 2
+STATUS_NAMES = {UNKNOWN: None, ONLINE: "ONLINE", OFFLINE: "OFFLINE"}
+
+
+def topic_station(topic: str) -> Optional[int]:
+    """Station id from a pumps/<id>/<kind> topic."""
+    parts = topic.split("/")
+    if len(parts) == 3 and parts[1].isdigit():
+        return int(parts[1])
+    return None
+
+
+def valid_telemetry(data) -> bool:
+    """A telemetry snapshot or delta whose fields fit the table's columns."""
+    if not isinstance(data, dict):
+        return False
+    for key in FIELD_BITS:
+        if key in data and not isinstance(data[key], bool):
+            return False
+    next_time = data.get("last_time_of_next_station")
+    return next_time is None or (isinstance(next_time, (int, float)) and not isinstance(next_time, bool))
+
+
+class StationTable:
+    def __init__(self, capacity: int = 256, stale_after: float = 10.0, max_station_id: int = 4095):
+        self.lock = threading.Lock()
+        self.stale_after = stale_after   # seconds of silence before a station counts as offline
+        self.max_station_id = max_station_id   # a row is allocated for every id up to the highest seen
+        self.capacity = 0
+        self.present = array("B")
+        self.bits = array("B")
+        self.status = array("B")
+        self.last_seen = array("d")          # time.time() of the last live message, 0 if none yet
+        self.last_update = array("d")        # time.time() the telemetry was last applied
+        self.next_station_time = array("d")  # last_time_of_next_station, NaN for None
+        self.grow(min(capacity, max_station_id + 1))
+
+    def grow(self, capacity: int):
+        extra = capacity - self.capacity
+        if extra <= 0:
+            return
+        self.present.extend(bytes(extra))
+        self.bits.extend(bytes(extra))
+        self.status.extend(bytes(extra))
+        self.last_seen.extend([0.0] * extra)
+        self.last_update.extend([0.0] * extra)
+        self.next_station_time.extend([math.nan] * extra)
+        self.capacity = capacity
+
+    def make_room(self, station_id: int) -> bool:
+        """Grow the table to hold station_id. False for an id above max_station_id. Needs the lock."""
+        if station_id > self.max_station_id:
+            logger.warning("Ignoring station %d above max_station_id %d", station_id, self.max_station_id)
+            return False
+        if station_id >= self.capacity:
+            self.grow(min(max(station_id + 1, self.capacity * 2), self.max_station_id + 1))
+        return True
+
+    def update(self, station_id: int, data: Dict, now: float):
+        """Apply a telemetry snapshot or delta."""
+        with self.lock:
+            if not self.make_room(station_id):
+                return
+            bits = self.bits[station_id] if data.get("delta") else 0
+            for key, value in data.items():
+                bit = FIELD_BITS.get(key)
+                if bit is not None:
+                    bits = bits | bit if value else bits & ~bit
+            self.bits[station_id] = bits
+            if "last_time_of_next_station" in data:
+                next_time = data["last_time_of_next_station"]
+                self.next_station_time[station_id] = math.nan if next_time is None else next_time
+            self.present[station_id] = 1
+            self.last_update[station_id] = now
+
+    def seen(self, station_id: int, now: float, status: int = ONLINE):
+        with self.lock:
+            if not self.make_room(station_id):
+                return
+            self.present[station_id] = 1
+            self.status[station_id] = status
+            if status == ONLINE:
+                self.last_seen[station_id] = now
+
+    def is_online(self, station_id: int, now: float) -> bool:
+        return (self.status[station_id] == ONLINE
+                and now - self.last_seen[station_id] <= self.stale_after)
+
+    def mode(self, station_id: int, now: float) -> str:
+        """The mode the station is in, as its status LED shows it (or offline)."""
+        if not self.is_online(station_id, now):
+            return "offline"
+        bits = self.bits[station_id]
+        if not bits & FIELD_BITS["is_next_station_online"]:
+            return "local"
+        return "soft" if bits & FIELD_BITS["soft_manual"] else "network"
+
+    def row(self, station_id: int, now: float) -> Dict:
+        bits = self.bits[station_id]
+        next_time = self.next_station_time[station_id]
+        last_seen = self.last_seen[station_id]
+        row = {"station_id": station_id}
+        for key, bit in FIELD_BITS.items():
+            row[key] = bool(bits & bit)
+        row["last_time_of_next_station"] = None if math.isnan(next_time) else next_time
+        row["status"] = STATUS_NAMES[self.status[station_id]]
+        row["last_seen"] = last_seen or None
+        row["last_update"] = self.last_update[station_id] or None
+        row["online"] = self.is_online(station_id, now)
+        row["mode"] = self.mode(station_id, now)
+        return row
+
+    def get(self, station_id: int) -> Optional[Dict]:
+        now = time.time()
+        with self.lock:
+            if not 0 <= station_id < self.capacity or not self.present[station_id]:
+                return None
+            return self.row(station_id, now)
+
+    def all(self) -> List[Dict]:
+        now = time.time()
+        with self.lock:
+            return [self.row(station_id, now) for station_id in range(self.capacity) if self.present[station_id]]
+
+    def online_count(self) -> int:
+        now = time.time()
+        with self.lock:
+            return sum(1 for station_id in range(self.capacity)
+                       if self.present[station_id] and self.is_online(station_id, now))
+
+
+class FleetAggregator:
+    def __init__(self, broker="localhost", port=1883, client_id="station_0", capacity=256, stale_after=10.0,
+                 start=True, max_station_id=4095):
+        self.table = StationTable(capacity, stale_after, max_station_id)
+        self.messages = metrics.counter("aggregator_messages_total", "Station messages applied to the table")
+        self.commands = metrics.counter("aggregator_commands_total", "Commands sent to stations")
+        self.http_server = None
+        self.will_topics: Dict[int, str] = {}   # station_id -> Last Will topic of its shared connection
+
+        self.mqtt_client = mqtt_client.MQTTClient(id=client_id, broker=broker, port=port, start=start)
+        self.mqtt_client.subscribe(mqtt_client.station_topic("+", "telemetry"), self.on_telemetry)
+        self.mqtt_client.subscribe(mqtt_client.station_topic("+", "alive"), self.on_alive)
+        metrics.add_collector(self.collect_metrics)
+
+    def on_telemetry(self, data: Dict):
+        if not valid_telemetry(data):
+            logger.warning("Ignoring malformed telemetry: %r", data)
+            return
+        station_id = topic_station(data.get("_topic", ""))
+        if station_id is None:
+            return
+        now = time.time()
+        self.table.update(station_id, data, now)
+        # A retained snapshot may be old; it fills in the state but isn't a sign of life
+        if not data.get("_retained"):
+            self.table.seen(station_id, now)
+        self.messages.inc()
+
+    def on_alive(self, data: Dict):
+        if not isinstance(data, dict):
+            logger.warning("Ignoring malformed alive message: %r", data)
+            return
+        topic = data.get("_topic", "")
+        station_id = topic_station(topic)
+        if station_id is None:
+            # pumps/<host_id>/alive: a host's Last Will covers its stations
+            if data.get("status") == "OFFLINE":
+                now = time.time()
+                for hosted_id in [sid for sid, will_topic in self.will_topics.items() if will_topic == topic]:
+                    self.table.seen(hosted_id, now, OFFLINE)
+            return
+        if data.get("status") == "OFFLINE":
+            self.table.seen(station_id, time.time(), OFFLINE)
+        else:
+            if data.get("status") == "ONLINE":
+                if data.get("will_topic") and isinstance(data["will_topic"], str):
+                    self.will_topics[station_id] = data["will_topic"]
+                else:
+                    self.will_topics.pop(station_id, None)
+            if not data.get("_retained"):
+                self.table.seen(station_id, time.time())
+        self.messages.inc()
+
+    def send_command(self, station_id: int, command: str, value):
+        self.mqtt_client.send({"command": command, "which_station": station_id, "value": value},
+                              mqtt_client.station_topic(station_id, "cmd"))
+        self.commands.inc()
+        logger.info("Sent %s=%s to station %s", command, value, station_id)
+
+    def set_pump(self, station_id: int, value: bool):
+        """Switch a station's pump; the station only obeys while in soft manual mode."""
+        self.send_command(station_id, "set_pump", bool(value))
+
+    def set_soft_manual(self, station_id: int, value: bool):
+        self.send_command(station_id, "set_soft_manual", bool(value))
+
+    def collect_metrics(self):
+        yield "aggregator_stations", "gauge", "Stations in the table", {}, len(self.table.all())
+        yield "aggregator_stations_online", "gauge", "Stations heard from recently", {}, self.table.online_count()
+
+    def serve(self, port=8081, host="127.0.0.1"):
+        """Serve the query API from a daemon thread."""
+        self.http_server = ThreadingHTTPServer((host, port), AggregatorHandler)
+        self.http_server.daemon_threads = True
+        self.http_server.aggregator = self
+        threading.Thread(target=self.http_server.serve_forever, daemon=True).start()
+        logger.info("Serving fleet state on http://%s:%d/stations", host, self.http_server.server_port)
+        return self.http_server
+
+    def cleanup(self):
+        if self.http_server is not None:
+            self.http_server.shutdown()
+        metrics.REGISTRY.remove_collector(self.collect_metrics)
+        self.mqtt_client.cleanup()
+
+
+class AggregatorHandler(BaseHTTPRequestHandler):
+    COMMANDS = {"pump": "set_pump", "soft_manual": "set_soft_manual"}
+
+    def do_GET(self):
+        table = self.server.aggregator.table
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if parts == ["stations"]:
+            self.send_json(200, table.all())
+        elif len(parts) == 2 and parts[0] == "stations" and parts[1].isdigit():
+            row = table.get(int(parts[1]))
+            if row is None:
+                self.send_json(404, {"error": "unknown station"})
+            else:
+                self.send_json(200, row)
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if not (len(parts) == 3 and parts[0] == "stations" and parts[1].isdigit() and parts[2] in self.COMMANDS):
+            self.send_json(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            value = json.loads(self.rfile.read(length) or b"{}")["value"]
+        except (ValueError, KeyError, TypeError):
+            value = None
+        # Only a JSON boolean: "false" or 0 must not be read as a command to switch on
+        if not isinstance(value, bool):
+            self.send_json(400, {"error": 'expected {"value": true|false}'})
+            return
+        aggregator = self.server.aggregator
+        getattr(aggregator, self.COMMANDS[parts[2]])(int(parts[1]), value)
+        self.send_json(202, {"sent": self.COMMANDS[parts[2]], "station_id": int(parts[1]), "value": value})
+
+    def send_json(self, code, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("http: " + format, *args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fleet aggregator (station 0)")
+    parser.add_argument("--broker", default="localhost")
+    parser.add_argument("--port", type=int, default=1883, help="MQTT broker port")
+    parser.add_argument("--http-port", type=int, default=8081)
+    parser.add_argument("--http-host", default="127.0.0.1")
+    parser.add_argument("--client-id", default="station_0")
+    parser.add_argument("--stale-after", type=float, default=10.0,
+                        help="seconds without a message before a station is shown offline")
+    parser.add_argument("--max-station-id", type=int, default=4095,
+                        help="messages from higher station ids are ignored")
+    args = parser.parse_args()
+
+    logging.basicConfig(level="INFO", format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    aggregator = FleetAggregator(args.broker, args.port, args.client_id, stale_after=args.stale_after,
+                                 max_station_id=args.max_station_id)
+    aggregator.serve(args.http_port, args.http_host)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        aggregator.cleanup()
@@ -23,13 +23,36 @@ const int BUTTON2_PIN = 10;        // Info button 2
 // const int BUTTON1_PIN = 10;         // Info button 1
 // const int BUTTON2_PIN = 11;        // Info button 2
 
-// Timing control
-const unsigned long SEND_INTERVAL = 5000;  // Send status every 5 seconds
+// Timing control: a status frame goes out as soon as an input changes, and
+// after HEARTBEAT_INTERVAL without one
+const unsigned long HEARTBEAT_INTERVAL = 5000;
+const unsigned long DEBOUNCE_MS = 20;      // an input must hold its new level this long
 unsigned long lastSendTime = 0;
 
+// Debounced inputs, in the INPUT_BITS order of serial_protocol.py
+const uint8_t INPUT_COUNT = 6;
+uint8_t rawBits = 0;                       // last reading
+uint8_t stableBits = 0;                    // debounced state that gets reported
+unsigned long rawChangeTime[INPUT_COUNT];  // when each input last changed level
+
 // Station configuration
 const int STATION_ID = 1;  // Change this for each station (1, 2, or 3)
 
+// Binary framing (see src/serial_protocol.py). Stays on JSON until the Pi
+// sends {"proto": 1}.
+const uint8_t FRAME_SYNC = 0xA5;
+const uint8_t PROTOCOL_VERSION = 1;
+const uint8_t FRAME_HELLO = 0x01;
+const uint8_t FRAME_STATUS = 0x02;
+const uint8_t FRAME_COMMAND = 0x10;
+const uint8_t FRAME_POLL = 0x11;
+const uint8_t EVENT_HEARTBEAT = 0;
+const uint8_t EVENT_CHANGE = 1;
+const uint8_t EVENT_POLL = 2;
+const uint8_t MAX_PAYLOAD = 32;
+bool binaryMode = false;
+uint8_t txSeq = 0;
+
 void setup() {
   // Initialize serial communication
   Serial.begin(115200);
@@ -50,33 +73,129 @@ void setup() {
   // Configure output pin
   pinMode(PUMP_CONTROL_PIN, OUTPUT);
   digitalWrite(PUMP_CONTROL_PIN, LOW);  // Ensure pump starts off
+
+  rawBits = stableBits = readInputBits();
+  for (uint8_t i = 0; i < INPUT_COUNT; i++) {
+    rawChangeTime[i] = millis();
+  }
+
+  // Opening the port resets the board, so report right away rather than
+  // leaving the Pi without inputs until the first heartbeat
+  sendStatus(EVENT_HEARTBEAT, 0);
 }
 
 void loop() {
   // Check for incoming commands
   if (Serial.available()) {
-    String command = Serial.readStringUntil('\n');
-    processCommand(command);
+    if (Serial.peek() == FRAME_SYNC) {
+      processBinaryCommand();
+    } else {
+      String command = Serial.readStringUntil('\n');
+      processCommand(command);
+    }
   }
   
-  // Send status update at regular intervals
-  if (millis() - lastSendTime >= SEND_INTERVAL) {
-    sendStatus();
-    lastSendTime = millis();
+  // Report input changes right away, otherwise a heartbeat
+  scanInputs();
+  if (millis() - lastSendTime >= HEARTBEAT_INTERVAL) {
+    sendStatus(EVENT_HEARTBEAT, 0);
+  }
+}
+
+void scanInputs() {
+  unsigned long now = millis();
+  uint8_t bits = readInputBits();
+  uint8_t changed = bits ^ rawBits;
+  for (uint8_t i = 0; i < INPUT_COUNT; i++) {
+    if (changed & (1 << i)) {
+      rawChangeTime[i] = now;  // bouncing restarts the debounce time
+    }
+  }
+  rawBits = bits;
+
+  // Accept each input that differs from the reported state and has held
+  // its level for DEBOUNCE_MS; age is since the oldest accepted edge
+  uint8_t next = stableBits;
+  unsigned long age = 0;
+  for (uint8_t i = 0; i < INPUT_COUNT; i++) {
+    uint8_t bit = 1 << i;
+    if (((rawBits ^ stableBits) & bit) && now - rawChangeTime[i] >= DEBOUNCE_MS) {
+      next ^= bit;
+      age = max(age, now - rawChangeTime[i]);
+    }
   }
+  if (next != stableBits) {
+    stableBits = next;
+    sendStatus(EVENT_CHANGE, min(age, 255UL));
+  }
+}
+
+uint16_t crc16(const uint8_t *data, size_t length) {
+  // CRC-16/CCITT-FALSE
+  uint16_t crc = 0xFFFF;
+  for (size_t i = 0; i < length; i++) {
+    crc ^= (uint16_t)data[i] << 8;
+    for (uint8_t bit = 0; bit < 8; bit++) {
+      crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+    }
+  }
+  return crc;
+}
+
+void sendFrame(uint8_t type, const uint8_t *payload, uint8_t length) {
+  uint8_t frame[5 + MAX_PAYLOAD + 2];
+  frame[0] = FRAME_SYNC;
+  frame[1] = length;
+  frame[2] = PROTOCOL_VERSION;
+  frame[3] = txSeq++;
+  frame[4] = type;
+  memcpy(frame + 5, payload, length);
+  uint16_t crc = crc16(frame + 2, 3 + length);
+  frame[5 + length] = crc >> 8;
+  frame[6 + length] = crc & 0xFF;
+  Serial.write(frame, 7 + length);
+}
+
+uint8_t readInputBits() {
+  // Same bit order as INPUT_BITS in serial_protocol.py
+  uint8_t bits = 0;
+  if (!digitalRead(PUMP_STATUS_PIN)) bits |= 1 << 0;
+  if (!digitalRead(PRESSURE_SWITCH_PIN)) bits |= 1 << 1;
+  if (!digitalRead(TOP_LEVEL_PIN)) bits |= 1 << 2;
+  if (!digitalRead(BOTTOM_LEVEL_PIN)) bits |= 1 << 3;
+  if (!digitalRead(FAULT_PIN)) bits |= 1 << 4;
+  if (digitalRead(OP_MODE_PIN) == 1) bits |= 1 << 5;
+  return bits;
 }
 
-void sendStatus() {
+void sendStatus(uint8_t event, uint8_t arg) {
+  // arg: ms since the input edge for EVENT_CHANGE, the poll's seq for EVENT_POLL
+  lastSendTime = millis();
+  if (binaryMode) {
+    uint8_t payload[4] = {(uint8_t)STATION_ID, stableBits, event, arg};
+    sendFrame(FRAME_STATUS, payload, 4);
+    return;
+  }
+
   // Create JSON status object
   StaticJsonDocument<200> doc;
   
   doc["station_id"] = STATION_ID;
-  doc["pump_status"] = !digitalRead(PUMP_STATUS_PIN);  // Inverted due to LOW trigger
-  doc["pressure_switch"] = !digitalRead(PRESSURE_SWITCH_PIN);
-  doc["top_level"] = !digitalRead(TOP_LEVEL_PIN);
-  doc["bottom_level"] = !digitalRead(BOTTOM_LEVEL_PIN);
-  doc["fault"] = !digitalRead(FAULT_PIN);
-  if (digitalRead(OP_MODE_PIN) == 1) { doc["op_mode"] = true; } else { doc["op_mode"] = false; };
+  doc["pump_status"] = (stableBits & (1 << 0)) != 0;  // Inverted due to LOW trigger, see readInputBits
+  doc["pressure_switch"] = (stableBits & (1 << 1)) != 0;
+  doc["top_level"] = (stableBits & (1 << 2)) != 0;
+  doc["bottom_level"] = (stableBits & (1 << 3)) != 0;
+  doc["fault"] = (stableBits & (1 << 4)) != 0;
+  doc["op_mode"] = (stableBits & (1 << 5)) != 0;
+  if (event == EVENT_CHANGE) {
+    doc["event"] = "change";
+    doc["age_ms"] = arg;
+  } else if (event == EVENT_POLL) {
+    doc["event"] = "poll";
+    doc["poll"] = arg;
+  } else {
+    doc["event"] = "heartbeat";
+  }
   
   // Serialize JSON to string
   String jsonString;
@@ -93,7 +212,23 @@ void processCommand(String command) {
   if (error) {
     return;
   }
+
+  // Protocol negotiation: answer with a HELLO frame and switch to binary
+  if (doc.containsKey("proto")) {
+    int version = doc["proto"];
+    if (version >= 1) {
+      binaryMode = true;
+      uint8_t payload[2] = {PROTOCOL_VERSION, (uint8_t)STATION_ID};
+      sendFrame(FRAME_HELLO, payload, 2);
+    }
+  }
   
+  // Poll: answer with the current status right away
+  if (doc.containsKey("poll")) {
+    scanInputs();
+    sendStatus(EVENT_POLL, (uint8_t)(int)doc["poll"]);
+  }
+
   // Process pump control commands
   if (doc.containsKey("pump_control")) {
     bool pumpState = doc["pump_control"];
@@ -106,4 +241,36 @@ void processCommand(String command) {
     digitalWrite(CONNECTED_STATUS_PIN, connectedStatus);
     digitalWrite(13, connectedStatus);
   }
-}
\ No newline at end of file
+}
+
+void setOutputs(uint8_t mask, uint8_t values) {
+  if (mask & (1 << 0)) {
+    digitalWrite(PUMP_CONTROL_PIN, (values >> 0) & 1);
+  }
+  if (mask & (1 << 1)) {
+    bool connectedStatus = (values >> 1) & 1;
+    digitalWrite(CONNECTED_STATUS_PIN, connectedStatus);
+    digitalWrite(13, connectedStatus);
+  }
+}
+
+void processBinaryCommand() {
+  uint8_t frame[5 + MAX_PAYLOAD + 2];
+  if (Serial.readBytes(frame, 2) != 2 || frame[1] > MAX_PAYLOAD) {
+    return;  // Dropped the sync byte; the next loop resyncs
+  }
+  uint8_t length = frame[1];
+  if (Serial.readBytes(frame + 2, 5 + length) != (size_t)(5 + length)) {
+    return;
+  }
+  uint16_t crc = ((uint16_t)frame[5 + length] << 8) | frame[6 + length];
+  if (crc16(frame + 2, 3 + length) != crc) {
+    return;  // Corrupted frame
+  }
+  if (frame[4] == FRAME_COMMAND && length >= 2) {
+    setOutputs(frame[5], frame[6]);
+  } else if (frame[4] == FRAME_POLL && length >= 1) {
+    scanInputs();
+    sendStatus(EVENT_POLL, frame[5]);
+  }
+}
@@ -0,0 +1,252 @@
+"""Run a PumpStation on a single asyncio event loop.
+
+Instead of the paho network thread, the serial reader and writer threads and
+the monitor thread, everything runs as tasks on one loop:
+
+- serial I/O: the port fd is watched with add_reader and bytes go through
+  SerialClient.feed; queued commands are written by a writer task through
+  the awaitable send_serial()
+- MQTT I/O: paho's socket callbacks hook its socket into the loop; the
+  station's MQTTClient.send() goes through the awaitable publish(), one task
+  per message
+- timers (alive pulse, liveness deadlines): the station's scheduler, woken
+  when its next deadline is due or an earlier one is added
+- outbox replay: batches are published by a task, paced with asyncio.sleep
+- control decisions: serial frames and MQTT messages are queued and handled
+  one at a time by a single control task, in arrival order
+
+Usage:
+    station = PumpStation(station_id=1, ..., runtime="asyncio")
+    async_runtime.run(station)
+"""
+import asyncio
+import functools
+import logging
+import time
+
+import paho.mqtt.client as mqtt
+import serial
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncStationRuntime:
+    MQTT_MISC_INTERVAL = 1   # paho keepalive/housekeeping
+
+    def __init__(self, station):
+        if station.runtime != "asyncio":
+            raise ValueError("AsyncStationRuntime needs a PumpStation created with runtime='asyncio'")
+        self.station = station
+        self.serial = station.serial_client
+        self.mqtt = station.mqtt_client
+        self.loop = None
+        self.events = None       # (handler, data) waiting for the control task
+        self.write_event = None  # set when a command is queued on the serial client
+        self.schedule_event = None  # set when an earlier deadline is scheduled
+        self.mqtt_socket = None
+        self.tasks = []
+        self.replay = None
+        self.sends = set()   # publish() tasks started for MQTTClient.send
+
+    async def run(self):
+        """Run the station until stop() is called."""
+        self.loop = asyncio.get_running_loop()
+        self.events = asyncio.Queue()
+        self.write_event = asyncio.Event()
+        self.schedule_event = asyncio.Event()
+
+        # Every input goes through the control task so decisions never interleave
+        self.serial.callback = functools.partial(self.enqueue, self.station.serial_callback)
+        self.mqtt.executor = self.enqueue
+        self.mqtt.sender = self.submit_publish
+        self.mqtt.replay_runner = functools.partial(self.in_loop, self.start_replay)
+        self.serial.on_queued = lambda: self.loop.call_soon_threadsafe(self.write_event.set)
+        self.station.scheduler.on_change = lambda: self.loop.call_soon_threadsafe(self.schedule_event.set)
+        self.install_mqtt_socket_callbacks()
+
+        self.tasks = [
+            asyncio.create_task(self.control_task()),
+            asyncio.create_task(self.serial_task()),
+            asyncio.create_task(self.serial_writer_task()),
+            asyncio.create_task(self.mqtt_task()),
+            asyncio.create_task(self.scheduler_task()),
+        ]
+        try:
+            await asyncio.gather(*self.tasks)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.mqtt.mqtt_client.disconnect()
+            self.serial.on_disconnect()
+
+    def stop(self):
+        self.station.running = False
+        for task in self.tasks:
+            task.cancel()
+        if self.replay is not None:
+            self.replay.cancel()
+
+    def enqueue(self, handler, data):
+        self.events.put_nowait((handler, data))
+
+    # Awaitable send paths. Both run on the loop; from another thread, use
+    # asyncio.run_coroutine_threadsafe (or submit_publish)
+
+    async def send_serial(self, data=None):
+        """Write data and every queued command now (subject to the shadow)."""
+        pending = self.serial.collect_pending(dict(data) if data else {})
+        if pending:
+            self.serial.write_changes(pending)
+
+    async def publish(self, data, topic=None, retain=False, timeout=1.0):
+        """Publish and wait until paho has written the message to the socket. False if it wasn't."""
+        if self.mqtt_socket is None:
+            # Not connected, or connect() is still running in the executor
+            return False
+        info = self.mqtt.publish(data, topic, retain)
+        if info is None or info.rc != mqtt.MQTT_ERR_SUCCESS:
+            return False
+        deadline = self.loop.time() + timeout
+        while not info.is_published() and self.loop.time() < deadline:
+            await asyncio.sleep(0.005)
+        return info.is_published()
+
+    def submit_publish(self, data, topic=None, retain=False):
+        """MQTTClient.send on this runtime: publish() as a task, in call order, from any thread."""
+        self.in_loop(self.start_send, self.publish(data, topic, retain))
+
+    def start_send(self, coroutine):
+        task = self.loop.create_task(coroutine)
+        self.sends.add(task)
+        task.add_done_callback(self.sends.discard)
+
+    # Tasks
+
+    async def control_task(self):
+        while self.station.running:
+            handler, data = await self.events.get()
+            try:
+                handler(data)
+            except Exception as e:
+                logger.exception("Control handler error: %s", e)
+
+    async def scheduler_task(self):
+        scheduler = self.station.scheduler
+        while self.station.running:
+            self.schedule_event.clear()
+            delay = scheduler.run_pending()
+            try:
+                await asyncio.wait_for(self.schedule_event.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def serial_task(self):
+        """Keep the port open and feed received bytes to the frame splitter."""
+        while self.station.running:
+            delay = self.serial.supervisor.attempt()
+            if delay:
+                await asyncio.sleep(delay)
+                continue
+            lost = self.loop.create_future()
+            fd = self.serial.ser.fileno()
+            self.loop.add_reader(fd, self.on_serial_readable, lost)
+            try:
+                await lost
+            finally:
+                self.loop.remove_reader(fd)
+                self.serial.on_disconnect()
+                if lost.done() and not lost.cancelled():
+                    self.serial.supervisor.connection_lost(lost.result())
+
+    def on_serial_readable(self, lost):
+        ser = self.serial.ser
+        try:
+            chunk = ser.read(ser.in_waiting or 1)
+        except (serial.SerialException, OSError) as e:
+            logger.warning("Serial connection error: %s", e)
+            if not lost.done():
+                lost.set_result(e)
+            return
+        if chunk:
+            self.serial.feed(chunk, time.monotonic())
+
+    async def serial_writer_task(self):
+        while self.station.running:
+            await self.write_event.wait()
+            self.write_event.clear()
+            await self.send_serial()
+
+    def start_replay(self, steps):
+        self.replay = self.loop.create_task(self.replay_task(steps))
+
+    async def replay_task(self, steps):
+        """Publish the outbox on the loop, like MQTTClient.replay does in its thread."""
+        try:
+            for interval in steps:
+                await asyncio.sleep(interval)
+        finally:
+            steps.close()
+
+    async def mqtt_task(self):
+        client = self.mqtt.mqtt_client
+        while self.station.running:
+            if self.mqtt_socket is None:
+                # Backoff and attempt stats are shared with the threaded runtime.
+                # paho's connect() blocks until the broker answers or times out,
+                # so it runs in a worker thread to keep serial and control going
+                delay = await self.loop.run_in_executor(None, self.mqtt.supervisor.attempt)
+                if delay:
+                    logger.warning("MQTT connection failed, retrying in %.1f seconds...", delay)
+                    await asyncio.sleep(delay)
+                    continue
+            client.loop_misc()
+            await asyncio.sleep(self.MQTT_MISC_INTERVAL)
+
+    # paho socket callbacks
+
+    def install_mqtt_socket_callbacks(self):
+        client = self.mqtt.mqtt_client
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    # paho calls these from connect(), which runs in a worker thread, so
+    # anything that touches the loop is handed over to it
+
+    def in_loop(self, callback, *args):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self.mqtt_socket = sock
+        self.in_loop(self.loop.add_reader, sock, client.loop_read)
+
+    def on_socket_close(self, client, userdata, sock):
+        self.in_loop(self.remove_socket, sock)
+        self.mqtt_socket = None
+
+    def remove_socket(self, sock):
+        self.loop.remove_reader(sock)
+        self.loop.remove_writer(sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.in_loop(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.in_loop(self.loop.remove_writer, sock)
+
+
+def run(station):
+    """Run a station created with runtime="asyncio" until interrupted."""
+    runtime = AsyncStationRuntime(station)
+    try:
+        asyncio.run(runtime.run())
+    except KeyboardInterrupt:
+        runtime.stop()
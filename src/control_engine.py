@@ -0,0 +1,180 @@
+"""Table-driven pump control decisions.
+
+A station's role decides how it reacts to its own inputs and to the state of
+the station(s) it feeds:
+
+- source: pumps from a river/well, guarded by the pressure switch, and runs on
+  a timer when it can't see the next station (station 1)
+- intermediate: has a tank and a pump feeding the next tank (station 2)
+- monitor: has a tank but no pump, only reports (station 3)
+
+The rules for each role are evaluated once, for every combination of inputs,
+when the engine is built. At run time a decision is a single table lookup on
+a bitfield of the station's inputs and the aggregated downstream levels, so
+it costs the same however long the chain is.
+"""
+from typing import Dict, Iterable
+
+SOURCE = "source"
+INTERMEDIATE = "intermediate"
+MONITOR = "monitor"
+ROLES = (SOURCE, INTERMEDIATE, MONITOR)
+
+# Actions
+NONE = 0
+START = 1
+STOP = 2
+TIMER = 3   # local-mode timed on/off cycle (source stations)
+
+# Local input bits
+PRESSURE = 1 << 0
+TOP = 1 << 1
+BOTTOM = 1 << 2
+FAULT = 1 << 3
+LOCAL_BITS = 4
+
+# Aggregated downstream bits, placed above the local bits in the network table
+DOWNSTREAM_EMPTY = 1 << 0
+DOWNSTREAM_FULL = 1 << 1
+NEXT_EMPTY = DOWNSTREAM_EMPTY << LOCAL_BITS
+NEXT_FULL = DOWNSTREAM_FULL << LOCAL_BITS
+
+
+def local_bits(pressure_ok: bool, top_level: bool, bottom_level: bool, fault: bool) -> int:
+    """Pack a station's own inputs into the index used by the decision tables."""
+    return ((PRESSURE if pressure_ok else 0) | (TOP if top_level else 0)
+            | (BOTTOM if bottom_level else 0) | (FAULT if fault else 0))
+
+
+def downstream_bits(statuses: Iterable[Dict]) -> int:
+    """Aggregate the tank levels of every station we feed.
+
+    A tank is empty when both float switches are clear and full when both are
+    set; a missing field counts as neither. With several downstream tanks
+    (a branch) any full tank stops the pump so it can't overflow, otherwise
+    any empty tank starts it.
+    """
+    empty = full = False
+    for status in statuses:
+        if not status.get("bottom_level", True) and not status.get("top_level", True):
+            empty = True
+        if status.get("bottom_level", False) and status.get("top_level", False):
+            full = True
+    if full:
+        return DOWNSTREAM_FULL
+    if empty:
+        return DOWNSTREAM_EMPTY
+    return 0
+
+
+def default_role(control_pump: bool, has_tank: bool) -> str:
+    """Role implied by the original PumpStation flags."""
+    if not control_pump:
+        return MONITOR
+    return INTERMEDIATE if has_tank else SOURCE
+
+
+# Rules, written for readability; only used to fill the tables
+
+def _source_network(bits):
+    if not bits & PRESSURE:
+        return STOP
+    if bits & NEXT_EMPTY and not bits & FAULT:
+        return START
+    if bits & NEXT_FULL:
+        return STOP
+    return NONE
+
+
+def _intermediate_network(bits):
+    # Don't run the pump on an empty tank
+    if not bits & BOTTOM and not bits & TOP:
+        return STOP
+    if bits & NEXT_EMPTY and not bits & FAULT:
+        return START
+    if bits & NEXT_FULL:
+        return STOP
+    return NONE
+
+
+def _source_local(bits):
+    if bits & FAULT:
+        return NONE
+    return TIMER if bits & PRESSURE else STOP
+
+
+def _intermediate_local(bits):
+    if bits & FAULT:
+        return NONE
+    if bits & TOP and bits & BOTTOM:
+        return START
+    if not bits & TOP and not bits & BOTTOM:
+        return STOP
+    return NONE
+
+
+def _source_manual(bits, value):
+    if not value:
+        return STOP
+    return START if bits & PRESSURE else NONE
+
+
+def _intermediate_manual(bits, value):
+    if not value:
+        return STOP
+    return START if not bits & BOTTOM else NONE
+
+
+def _source_can_start(bits):
+    return bool(bits & PRESSURE) and not bits & FAULT
+
+
+def _intermediate_can_start(bits):
+    return not bits & TOP and not bits & FAULT
+
+
+def _never(*args):
+    return NONE
+
+
+RULES = {
+    SOURCE: (_source_network, _source_local, _source_manual, _source_can_start),
+    INTERMEDIATE: (_intermediate_network, _intermediate_local, _intermediate_manual, _intermediate_can_start),
+    MONITOR: (_never, _never, _never, lambda bits: False),
+}
+
+
+class ControlEngine:
+    def __init__(self, role: str, control_pump: bool = True):
+        if role not in RULES:
+            raise ValueError(f"Unknown station role: {role}")
+        self.role = role
+        self.controls_pump = control_pump and role != MONITOR
+        network, local, manual, can_start = RULES[role]
+
+        local_range = range(1 << LOCAL_BITS)
+        self.start_table = bytes(1 if self.controls_pump and can_start(bits) else 0 for bits in local_range)
+        self.network_table = bytes(self._compile(network(bits), bits) for bits in range(1 << (LOCAL_BITS + 2)))
+        self.local_table = bytes(self._compile(local(bits), bits) for bits in local_range)
+        self.manual_table = bytes(self._compile(manual(bits, value), bits)
+                                  for value in (False, True) for bits in local_range)
+
+    def _compile(self, action, bits):
+        """Fold the start/stop permissions into the table entry."""
+        if not self.controls_pump:
+            return NONE
+        if action == START and not self.start_table[bits & ((1 << LOCAL_BITS) - 1)]:
+            return NONE
+        return action
+
+    def network(self, local: int, downstream: int) -> int:
+        return self.network_table[local | downstream << LOCAL_BITS]
+
+    def local(self, local: int) -> int:
+        return self.local_table[local]
+
+    def manual(self, local: int, value: bool) -> int:
+        return self.manual_table[(1 << LOCAL_BITS if value else 0) | local]
+
+    def can_start(self, local: int) -> bool:
+        return bool(self.start_table[local])
@@ -1,9 +1,74 @@
-from pump_station import PumpStation
-if __name__ == "__main__":    # Station 1 (river pump)
-    station1 = PumpStation(station_id=1, control_pump=True, has_tank=False, broker="10.10.0.248")
+import time
 
-    # Station 2 (intermediate station)
-    #station2 = PumpStation(station_id=2, control_pump=True, has_tank=True, broker="10.10.10.6")
+process_started = time.monotonic()
 
-    # Station 3 (monitoring only)
-    #station3 = PumpStation(station_id=3, control_pump=False, has_tank=True, broker="10.10.10.6")
+import argparse  # noqa: E402
+import logging  # noqa: E402
+import os  # noqa: E402
+import signal  # noqa: E402
+
+import metrics  # noqa: E402
+import station_config  # noqa: E402
+from pump_station import PumpStation  # noqa: E402
+
+logger = logging.getLogger("main")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pump station controller")
+    parser.add_argument("--config", default=os.environ.get("PUMP_CONFIG"),
+                        help="station config file (JSON, see station_config.py); PUMP_CONFIG also works")
+    args = parser.parse_args()
+
+    # PUMP_LOG_LEVEL=DEBUG shows every serial write, PUMP_LOG_LEVEL=OFF silences logging
+    log_level = os.environ.get("PUMP_LOG_LEVEL", "INFO").upper()
+    if log_level == "OFF":
+        logging.disable(logging.CRITICAL)
+    else:
+        logging.basicConfig(level=log_level, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    # Prometheus metrics on http://127.0.0.1:9108/metrics, PUMP_METRICS_PORT=off to disable
+    metrics_port = os.environ.get("PUMP_METRICS_PORT", "9108")
+    if metrics_port.lower() != "off":
+        # A busy port must not keep the pump from coming under control
+        try:
+            metrics.start_server(int(metrics_port))
+        except OSError as e:
+            logger.error("Metrics server not started on port %s, running without metrics: %s", metrics_port, e)
+
+    # Stations come up without waiting for the Arduino or the broker: serial
+    # and MQTT connect in the background and each station logs its startup
+    # timing once it is in control
+    host = None
+    if args.config:
+        stations, host = station_config.build(station_config.load(args.config))
+    else:
+        # Station 1 (river pump)
+        stations = [PumpStation(station_id=1, control_pump=True, has_tank=False, broker="10.10.0.248")]
+
+        # Station 1 on the single-threaded asyncio runtime instead
+        # import async_runtime
+        # station1 = PumpStation(station_id=1, control_pump=True, has_tank=False, broker="10.10.0.248", runtime="asyncio")
+        # async_runtime.run(station1)
+
+        # Stations 2 and 3 (intermediate station, monitoring only) are configured
+        # with a config file, see config/gateway.json
+    logger.info("%d station(s) created %.3f s after process start (the first after %.3f s)", len(stations),
+                time.monotonic() - process_started, stations[0].started - process_started)
+    # Run until Ctrl-C or systemd's SIGTERM, then say OFFLINE instead of leaving
+    # it to the will (and close the traffic log, if any)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        if stations[0].runtime == "asyncio":
+            import async_runtime
+            async_runtime.run(stations[0])   # returns once interrupted
+        else:
+            # The stations run in background threads
+            while True:
+                time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    if host is not None:
+        host.cleanup()
+    else:
+        for station in stations:
+            station.cleanup()
@@ -0,0 +1,173 @@
+"""Low-overhead counters, gauges and histograms with a Prometheus /metrics endpoint.
+
+Updating a metric is a couple of attribute operations under the GIL, with no
+I/O and no locks, so it is safe to do in the serial and MQTT hot paths.
+Statistics that a component already keeps (e.g. SerialClient.frame_stats) are
+exported through collectors that are only read when /metrics is scraped.
+
+    metrics.start_server(9108)   # http://127.0.0.1:9108/metrics
+"""
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Seconds; aimed at sub-millisecond parse/callback times up to slow publishes
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+def _format_labels(labels: Dict[str, str], extra: Tuple = ()) -> str:
+    items = list(labels.items()) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in items) + "}"
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, self.labels, (), self.value
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, labels, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield self.name + "_bucket", self.labels, (("le", repr(bound)),), cumulative
+        cumulative += self.counts[-1]
+        yield self.name + "_bucket", self.labels, (("le", "+Inf"),), cumulative
+        yield self.name + "_sum", self.labels, (), self.sum
+        yield self.name + "_count", self.labels, (), cumulative
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.collectors = []
+
+    def get(self, cls, name, help, labels, **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                metric = self.metrics[key] = cls(name, help, labels, **kwargs)
+            return metric
+
+    def add_collector(self, collector: Callable[[], Iterable[Tuple[str, str, str, Dict, float]]]):
+        with self.lock:
+            self.collectors.append(collector)
+
+    def remove_collector(self, collector):
+        with self.lock:
+            if collector in self.collectors:
+                self.collectors.remove(collector)
+
+    def render(self) -> str:
+        """Prometheus text exposition format."""
+        families = {}
+        with self.lock:
+            metrics = list(self.metrics.values())
+            collectors = list(self.collectors)
+        for metric in metrics:
+            family = families.setdefault(metric.name, [metric.type, metric.help, []])
+            family[2].extend(metric.samples())
+        for collector in collectors:
+            try:
+                for name, kind, help, labels, value in collector():
+                    family = families.setdefault(name, [kind, help, []])
+                    family[2].append((name, labels, (), value))
+            except Exception as e:
+                logger.warning("Metrics collector failed: %s", e)
+
+        lines = []
+        for name, (kind, help, samples) in families.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample_name, labels, extra, value in samples:
+                lines.append(f"{sample_name}{_format_labels(labels, extra)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, **labels) -> Counter:
+    return REGISTRY.get(Counter, name, help, labels)
+
+
+def gauge(name, help, **labels) -> Gauge:
+    return REGISTRY.get(Gauge, name, help, labels)
+
+
+def histogram(name, help, buckets=DEFAULT_BUCKETS, **labels) -> Histogram:
+    return REGISTRY.get(Histogram, name, help, labels, buckets=buckets)
+
+
+def add_collector(collector):
+    REGISTRY.add_collector(collector)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics: " + format, *args)
+
+
+_server = None
+
+
+def start_server(port=9108, host="127.0.0.1"):
+    """Serve /metrics from a daemon thread. Only the first call starts a server."""
+    global _server
+    if _server is None:
+        _server = ThreadingHTTPServer((host, port), MetricsHandler)
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, daemon=True).start()
+        logger.info("Serving metrics on http://%s:%d/metrics", host, _server.server_port)
+    return _server
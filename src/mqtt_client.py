@@ -1,116 +1,371 @@
 import paho.mqtt.client as mqtt
+import metrics
+import payload_codec
+from supervisor import ConnectionSupervisor
 import json
+import logging
 import time
 import threading
 
+logger = logging.getLogger(__name__)
+
+TOPIC_PREFIX = "pumps"
+
+
+def station_topic(station_id, kind, prefix=TOPIC_PREFIX):
+    """Build a per-station topic, e.g. pumps/2/telemetry, pumps/2/cmd, pumps/2/alive."""
+    return f"{prefix}/{station_id}/{kind}"
+
+
 class MQTTClient:
-    def __init__(self, id, broker="localhost", port=1883, topic="test/topic", alive_pulse_interval=2, callback=None):
+    def __init__(self, id, broker="localhost", port=1883, topic="test/topic", alive_pulse_interval=2, callback=None,
+                 alive_topic=None, start=True, outbox=None, replay_topic=None, replay_order="oldest",
+                 replay_batch=50, replay_rate=2.0, max_queued_messages=100, status_topic=None, keepalive=60,
+                 codecs=None, default_codec=payload_codec.JSON):
         self.id = id
         self.broker = broker
         self.port = port
         self.topic = topic
+        self.alive_topic = alive_topic or topic
         self.alive_pulse_interval = alive_pulse_interval
         self.callback = callback
+        self.keepalive = keepalive
+
+        # Payload encoding per topic (wildcards allowed), see payload_codec.
+        # Incoming messages are decoded by their marker whatever the topic.
+        self.codecs = dict(codecs or {})
+        self.default_codec = default_codec
+
+        # Retained ONLINE/OFFLINE status. OFFLINE is also the Last Will, so the
+        # broker publishes it as soon as it notices the connection is gone
+        # (at once if the process dies, after 1.5 x keepalive if the link does).
+        # A connection has one will: stations sharing it (see station_host) get
+        # their own status topics, whose ONLINE names the will topic to watch
+        self.status_topic = status_topic
+        self.status_topics = {status_topic: id} if status_topic else {}
+
+        # Topic -> callbacks. Messages are dispatched by topic so a handler only
+        # ever sees the traffic it subscribed to, and each payload is decoded
+        # once however many handlers it has.
+        self.handlers = {}
+        if callback is not None:
+            self.handlers[topic] = [callback]
+        # Runs handler(data) when set, e.g. to queue it for async_runtime's control task
+        self.executor = None
+        # Publishes for send() when set, e.g. async_runtime's awaitable publish
+        self.sender = None
+        # traffic_log.TrafficRecorders that see every message and connection change
+        self.recorders = []
+
+        labels = {"client": str(id)}
+        self.publish_seconds = metrics.histogram("mqtt_publish_seconds", "Time to hand a message to paho", **labels)
+        self.callback_seconds = metrics.histogram("mqtt_callback_seconds", "Time spent in message handlers", **labels)
+        self.messages_received = metrics.counter("mqtt_messages_received_total", "Messages dispatched to a handler",
+                                                 **labels)
+        self.messages_sent = metrics.counter("mqtt_messages_sent_total", "Messages published", **labels)
+        self.invalid_messages = metrics.counter("mqtt_invalid_messages_total", "Undecodable or non-object MQTT payloads", **labels)
+        self.send_failures = metrics.counter("mqtt_send_failures_total", "Publishes that raised", **labels)
+        self.connected_gauge = metrics.gauge("mqtt_connected", "1 while connected to the broker", **labels)
+
+        # Store-and-forward: messages passed to store() while disconnected go
+        # to the outbox and are replayed on reconnect to replay_topic, in
+        # batches of replay_batch records, at most replay_rate batches/s,
+        # oldest or newest first
+        self.outbox = outbox
+        self.replay_topic = replay_topic
+        self.replay_order = replay_order
+        self.replay_batch = replay_batch
+        self.replay_rate = replay_rate
+        self.replay_thread = None
+        # Set by the asyncio runtime to run replay_steps() on its loop
+        self.replay_runner = None
+        self.replaying = False
+        self.replayed = metrics.counter("mqtt_replayed_records_total", "Outbox records replayed", **labels)
+        if outbox is not None:
+            metrics.add_collector(self.collect_metrics)
 
         self.mqtt_connected = False
-        self.reconnect_thread_active = False
         self.lock = threading.Lock()
         self.last_message_time = time.time()
-        self.initial_connection = False
 
-
-        
+        # paho's own retry loop is off: the supervisor is the only thing that reconnects
         self.mqtt_client = mqtt.Client(
             client_id=self.id,
             protocol=mqtt.MQTTv311,
             userdata=None, 
-            callback_api_version=mqtt.CallbackAPIVersion.VERSION2
+            callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
+            reconnect_on_failure=False
         )
         self.mqtt_client.on_message = self.on_message
         self.mqtt_client.on_connect = self.on_connect
         self.mqtt_client.on_disconnect = self.on_disconnect
+        # Don't let paho buffer an unbounded backlog in memory during outages
+        self.mqtt_client.max_queued_messages_set(max_queued_messages)
+        if status_topic:
+            self.mqtt_client.will_set(status_topic, self.status_payload("OFFLINE"), qos=1, retain=True)
 
         # self.mqtt_client.connect(self.broker, self.port)
         # self.mqtt_client.subscribe(self.topic)
         # self.mqtt_client.loop_start()
 
-        try:
-            self.mqtt_client.connect(self.broker, self.port)
-            self.mqtt_client.subscribe(self.topic)
+        self.supervisor = ConnectionSupervisor("mqtt", self.try_connect, initial_delay=1.0, max_delay=30.0,
+                                               metric_labels=labels)
+
+        # With start=False the caller drives the network loop (see async_runtime)
+        self.threaded = start
+        if start:
+            self.supervisor.start()
+
+    def try_connect(self):
+        """One connection attempt, made by the supervisor. Raises if the broker is unreachable."""
+        if self.threaded:
+            # Reap the network thread of the connection that dropped
+            self.mqtt_client.loop_stop()
+        self.mqtt_client.connect(self.broker, self.port, self.keepalive)
+        if self.threaded:
             self.mqtt_client.loop_start()
-            self.initial_connection = True
-        except Exception as e:
-            self.start_reconnect_thread()
+        return True
 
     def on_connect(self, client, userdata, flags, rc, properties=None):
-        print(f"Connected to MQTT broker with result code {rc}")
+        logger.info("Connected to MQTT broker with result code %s", rc)
         # Resubscribe to topics on reconnect
         if rc == 0:
             with self.lock:
                 self.mqtt_connected = True
-                self.reconnect_thread_active = False
-            self.mqtt_client.subscribe(self.topic)
+            self.connected_gauge.set(1)
+            for recorder in self.recorders:
+                recorder.mqtt_state(True)
+            self.subscribe_all()
+            for status_topic in list(self.status_topics):
+                self.publish_status(status_topic, "ONLINE")
+            self.start_replay()
         else:
-            print(f"Failed to connect with result code: {rc}")
+            logger.warning("Failed to connect with result code: %s", rc)
             self.mqtt_connected = False
+            self.supervisor.connection_lost(rc)
 
 
     def on_disconnect(self, client, userdata, disconnect_flags, reason_code, properties):
-        print(f"Disconnected from MQTT broker with reason code: {reason_code}")
+        logger.warning("Disconnected from MQTT broker with reason code: %s", reason_code)
         with self.lock:
             self.mqtt_connected = False
+        self.connected_gauge.set(0)
+        for recorder in self.recorders:
+            recorder.mqtt_state(False)
         if reason_code != 0:
-            self.start_reconnect_thread()
+            self.supervisor.connection_lost(reason_code)
+
+    def subscribe(self, topic, callback):
+        """Register a callback for a topic (wildcards allowed) and subscribe to it."""
+        handlers = self.handlers.get(topic)
+        if handlers is None:
+            self.handlers[topic] = [callback]
+            self.mqtt_client.subscribe(topic)
+        else:
+            # Copy on write: on_message may be iterating the old list
+            self.handlers[topic] = handlers + [callback]
+
+    def unsubscribe(self, topic, callback):
+        handlers = [handler for handler in self.handlers.get(topic, ()) if handler != callback]
+        if handlers:
+            self.handlers[topic] = handlers
+        elif self.handlers.pop(topic, None) is not None:
+            self.mqtt_client.unsubscribe(topic)
+
+    def subscribe_all(self):
+        if self.handlers:
+            self.mqtt_client.subscribe([(topic, 0) for topic in list(self.handlers)])
+
+    def find_handlers(self, topic):
+        handlers = self.handlers.get(topic)
+        if handlers is None:
+            handlers = []
+            for sub, callbacks in list(self.handlers.items()):
+                if mqtt.topic_matches_sub(sub, topic):
+                    handlers.extend(callbacks)
+        return handlers
 
     def on_message(self, client, userdata, message):
+        for recorder in self.recorders:
+            recorder.mqtt_message(message.topic, message.payload, message.retain)
+        handlers = self.handlers.get(message.topic)
+        wildcard = handlers is None
+        if wildcard:
+            handlers = self.find_handlers(message.topic)
+            if not handlers:
+                return
         try:
-            #print("on message mqtt")
-            data = json.loads(message.payload.decode())
-            self.callback(data)
-            self.last_message_time = time.time()
-        except json.JSONDecodeError:
-            print(f"Invalid MQTT message: {message.payload.decode()}")
-
-    def send(self, data):
+            data = payload_codec.decode(message.payload)
+        except ValueError:
+            self.invalid_messages.inc()
+            logger.warning("Invalid MQTT message on %s: %r", message.topic, message.payload)
+            return
+        if not isinstance(data, dict):
+            # Valid JSON but not an object: no handler expects it
+            self.invalid_messages.inc()
+            logger.warning("Ignoring MQTT message on %s that is not an object: %r", message.topic, message.payload)
+            return
+        if message.retain:
+            # Delivered from the broker's retained store, not published just now
+            data["_retained"] = True
+        if wildcard:
+            # Tell wildcard subscribers (e.g. pumps/+/telemetry) which topic matched
+            data["_topic"] = message.topic
+        self.messages_received.inc()
+        started = time.perf_counter()
+        for index, handler in enumerate(handlers):
+            # Handlers may add keys, so each one after the first gets its own copy
+            payload = dict(data) if index else data
+            if self.executor is not None:
+                self.executor(handler, payload)
+                continue
+            # An exception here would end paho's network thread for good
+            try:
+                handler(payload)
+            except Exception as e:
+                logger.exception("Error handling MQTT message on %s: %s", message.topic, e)
+        self.callback_seconds.observe(time.perf_counter() - started)
+        self.last_message_time = time.time()
+
+    def send(self, data, topic=None, retain=False):
+        if self.sender is not None:
+            self.sender(data, topic, retain)
+        else:
+            self.publish(data, topic, retain)
+
+    def publish(self, data, topic=None, retain=False):
+        """Hand a message to paho; returns its MQTTMessageInfo, or None if that failed."""
         try:
-            json_data = json.dumps(data)
-            self.mqtt_client.publish(self.topic, json_data)
+            started = time.perf_counter()
+            topic = topic or self.topic
+            info = self.mqtt_client.publish(topic, self.encode(data, topic), retain=retain)
+            self.publish_seconds.observe(time.perf_counter() - started)
+            self.messages_sent.inc()
+            return info
         except Exception as e:
-            print(f"Failed to send data: {e}")
+            self.send_failures.inc()
+            logger.warning("Failed to send data: %s", e)
+            return None
+
+    def codec_for(self, topic):
+        codec = self.codecs.get(topic)
+        if codec is None:
+            for sub, sub_codec in self.codecs.items():
+                if mqtt.topic_matches_sub(sub, topic):
+                    return sub_codec
+            return self.default_codec
+        return codec
 
-    def reconnect(self):
+    def encode(self, data, topic=None):
+        return payload_codec.encode(data, self.codec_for(topic or self.topic))
+
+    def store(self, data, topic=None, timestamp=None):
+        """Keep a message in the outbox to be replayed once the broker is reachable."""
         try:
-            #print("Attempting to reconnect...")
-            if self.initial_connection:
-                self.mqtt_client.reconnect()
-            else:
-                self.mqtt_client.connect(self.broker, self.port)
-                self.mqtt_client.subscribe(self.topic)
-                self.mqtt_client.loop_start()
-                self.initial_connection = True
-        except Exception as e:
-            time.sleep(5)
-            self.reconnect()
+            self.outbox.append(topic or self.topic, json.dumps(data).encode(), timestamp)
+        except OSError as e:
+            logger.error("Failed to store message in outbox: %s", e)
+
+    def start_replay(self):
+        if self.outbox is None or not self.outbox.has_pending():
+            return
+        if self.replaying:
+            return
+        self.replaying = True
+        if self.replay_runner is not None:
+            self.replay_runner(self.replay_steps())
+            return
+        self.replay_thread = threading.Thread(target=self.replay, daemon=True)
+        self.replay_thread.start()
 
-    def start_reconnect_thread(self):
-        self.reconnect_thread_active = True
-        threading.Thread(target=self.reconnect, daemon=True).start()
+    def replay(self):
+        for interval in self.replay_steps():
+            time.sleep(interval)
+
+    def replay_steps(self):
+        """Publish the outbox in rate-limited batches, yielding the time to wait after
+        each; stops early if the connection drops."""
+        try:
+            yield from self._replay_batches()
+        finally:
+            self.replaying = False
 
-    def alive_pulse(self):
-        data = {"station_id": self.id, "status": "ALIVE"}
-        self.send(data)
+    def _replay_batches(self):
+        records = self.outbox.start_replay()
+        replay_topic = self.replay_topic or self.topic
+        compressed = self.codec_for(replay_topic) == payload_codec.ZLIB
+        logger.info("Replaying %d stored messages (%s first)", len(records), self.replay_order)
+        if self.replay_order == "newest":
+            records.reverse()
 
-    def check_connection(self):
-        # Check if no message has been received in a given timeout period
-        if not self.mqtt_connected:
-            self.start_reconnect_thread()
+        sent = 0
+        interval = 1.0 / self.replay_rate if self.replay_rate else 0
+        while sent < len(records) and self.is_connected():
+            batch = records[sent:sent + self.replay_batch]
+            payload = (b'{"client": ' + json.dumps(self.id).encode() + b', "records": ['
+                       + b", ".join(b'{"t": ' + repr(timestamp).encode() + b', "topic": ' + json.dumps(topic).encode()
+                                    + b', "data": ' + message + b'}' for timestamp, topic, message in batch)
+                       + b']}')
+            if compressed:
+                payload = payload_codec.compress(payload)
+            info = self.mqtt_client.publish(replay_topic, payload, qos=1)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                break
+            sent += len(batch)
+            self.replayed.inc(len(batch))
+            yield interval
+
+        unsent = records[sent:]
+        if self.replay_order == "newest":
+            unsent.reverse()
+        self.outbox.finish_replay(unsent)
+        if unsent:
+            logger.warning("Replay interrupted, %d messages kept for later", len(unsent))
+
+    def collect_metrics(self):
+        labels = {"client": str(self.id)}
+        yield "mqtt_outbox_bytes", "gauge", "Bytes waiting in the outbox", labels, self.outbox.size()
+        yield ("mqtt_outbox_dropped_bytes_total", "counter", "Oldest outbox bytes dropped to stay bounded",
+               labels, self.outbox.dropped_bytes)
+
+    def status_payload(self, status, id=None):
+        return json.dumps({"station_id": self.id if id is None else id, "status": status})
+
+    def publish_status(self, topic, status):
+        payload = {"station_id": self.status_topics.get(topic, self.id), "status": status}
+        if topic != self.status_topic and status == "ONLINE" and self.status_topic:
+            # Our Last Will goes to another topic; watchers subscribe to it too
+            payload["will_topic"] = self.status_topic
+        self.mqtt_client.publish(topic, json.dumps(payload), qos=1, retain=True)
+
+    def add_status_topic(self, topic, id):
+        """Keep a retained ONLINE/OFFLINE status on topic for id as well (a station sharing this connection)."""
+        self.status_topics[topic] = id
+        if self.is_connected():
+            self.publish_status(topic, "ONLINE")
+
+    def remove_status_topic(self, topic):
+        id = self.status_topics.pop(topic, None)
+        if id is not None and self.is_connected():
+            self.mqtt_client.publish(topic, self.status_payload("OFFLINE", id), qos=1, retain=True)
+
+    def alive_pulse(self, topic=None, id=None):
+        data = {"station_id": self.id if id is None else id, "status": "ALIVE"}
+        self.send(data, topic or self.alive_topic)
 
     def is_connected(self):
         return self.mqtt_client.is_connected()
 
     def cleanup(self):
-        self.mqtt_client.loop_stop()
+        self.supervisor.stop()
+        if self.is_connected():
+            # A clean disconnect doesn't trigger the will, so say it ourselves
+            for status_topic in list(self.status_topics):
+                self.publish_status(status_topic, "OFFLINE")
         self.mqtt_client.disconnect()
+        self.mqtt_client.loop_stop()
+        if self.outbox is not None:
+            self.outbox.close()
 
 
 def test_callback(data):
@@ -0,0 +1,209 @@
+"""Disk-backed store-and-forward queue for messages that couldn't be published.
+
+Records are appended to pending.log in a directory. Each record is
+
+    CRC32  LENGTH  TIMESTAMP  TOPIC_LENGTH  TOPIC  PAYLOAD
+
+where the CRC covers everything after it, so a record torn by a power cut
+ends the log instead of corrupting replay. fsync is batched: every
+fsync_every records or fsync_interval seconds, whichever comes first.
+
+Size is bounded: when pending.log reaches half of max_bytes it moves onto
+the end of pending.old, and the oldest records (those of replay.log, then of
+pending.old) are dropped until the three files fit in max_bytes.
+
+Replay moves everything pending into replay.log before publishing it, so new
+records can keep arriving. Records that could not be sent are written back
+to replay.log, and one left over after a crash is replayed on the next run.
+Delivery is at least once.
+"""
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import List, Tuple
+
+logger = logging.getLogger(__name__)
+
+RECORD_HEADER = struct.Struct("<IIdH")   # crc32, length of the rest, timestamp, topic length
+CRC_SIZE = 4
+
+Record = Tuple[float, str, bytes]
+
+
+class Outbox:
+    def __init__(self, directory: str, max_bytes: int = 16 * 1024 * 1024, fsync_every: int = 20,
+                 fsync_interval: float = 5.0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        self.pending_path = os.path.join(directory, "pending.log")
+        self.old_path = os.path.join(directory, "pending.old")
+        self.replay_path = os.path.join(directory, "replay.log")
+        os.makedirs(directory, exist_ok=True)
+
+        self.file = open(self.pending_path, "ab")
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self.dropped_bytes = 0
+        # Records handed out by start_replay, and how many of the oldest were
+        # dropped from replay.log since (they must not be written back)
+        self.replay_records = None
+        self.replay_dropped = 0
+        with self.lock:
+            self._trim()
+
+    @staticmethod
+    def encode(timestamp: float, topic: str, payload: bytes) -> bytes:
+        topic_bytes = topic.encode()
+        length = RECORD_HEADER.size - CRC_SIZE + len(topic_bytes) + len(payload)
+        body = RECORD_HEADER.pack(0, length, timestamp, len(topic_bytes))[CRC_SIZE:] + topic_bytes + payload
+        return struct.pack("<I", zlib.crc32(body)) + body
+
+    @staticmethod
+    def decode_file(path: str) -> List[Record]:
+        """Read every intact record of a log file, stopping at the first torn or corrupt one."""
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        records = []
+        pos = 0
+        while pos + RECORD_HEADER.size <= len(data):
+            crc, length, timestamp, topic_length = RECORD_HEADER.unpack_from(data, pos)
+            end = pos + CRC_SIZE + length
+            if end > len(data) or zlib.crc32(data[pos + CRC_SIZE:end]) != crc:
+                logger.warning("Outbox %s: stopping at damaged record at offset %d", path, pos)
+                break
+            topic_start = pos + RECORD_HEADER.size
+            topic = data[topic_start:topic_start + topic_length].decode()
+            records.append((timestamp, topic, data[topic_start + topic_length:end]))
+            pos = end
+        return records
+
+    def append(self, topic: str, payload: bytes, timestamp: float = None):
+        record = self.encode(time.time() if timestamp is None else timestamp, topic, payload)
+        with self.lock:
+            if self.file.tell() + len(record) > self.max_bytes // 2:
+                self._rotate()
+            self.file.write(record)
+            self.unsynced += 1
+            if self.unsynced >= self.fsync_every or time.monotonic() - self.last_sync >= self.fsync_interval:
+                self._sync()
+
+    def _rotate(self):
+        self._sync()
+        self.file.close()
+        if os.path.exists(self.old_path):
+            with open(self.old_path, "ab") as old, open(self.pending_path, "rb") as f:
+                old.write(f.read())
+                old.flush()
+                os.fsync(old.fileno())
+            os.remove(self.pending_path)
+        else:
+            os.replace(self.pending_path, self.old_path)
+        self.file = open(self.pending_path, "ab")
+        self._trim()
+
+    def _trim(self):
+        """Drop the oldest records so that replay.log and pending.old leave room for
+        a full pending.log within max_bytes. Needs the lock."""
+        excess = sum(os.path.getsize(path) for path in (self.replay_path, self.old_path)
+                     if os.path.exists(path)) - (self.max_bytes - self.max_bytes // 2)
+        for path in (self.replay_path, self.old_path):
+            if excess <= 0:
+                break
+            excess -= self._drop_oldest(path, excess)
+
+    def _drop_oldest(self, path: str, nbytes: int) -> int:
+        """Drop records from the start of a log file until at least nbytes are gone
+        (or the file is). Returns the bytes dropped. Needs the lock."""
+        if not os.path.exists(path):
+            return 0
+        records = self.decode_file(path)
+        dropped = 0
+        count = 0
+        while count < len(records) and dropped < nbytes:
+            dropped += len(self.encode(*records[count]))
+            count += 1
+        if path == self.replay_path and self.replay_records is not None:
+            self.replay_dropped += count
+        if count == len(records):
+            dropped = os.path.getsize(path)
+            os.remove(path)
+        else:
+            self._write_records(path, records[count:])
+        self.dropped_bytes += dropped
+        logger.warning("Outbox full, dropping oldest %d bytes", dropped)
+        return dropped
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def has_pending(self) -> bool:
+        with self.lock:
+            return self.file.tell() > 0 or os.path.exists(self.old_path) or os.path.exists(self.replay_path)
+
+    def size(self) -> int:
+        """Bytes waiting on disk, including an unfinished replay."""
+        with self.lock:
+            total = self.file.tell()
+        for path in (self.old_path, self.replay_path):
+            if os.path.exists(path):
+                total += os.path.getsize(path)
+        return total
+
+    def start_replay(self) -> List[Record]:
+        """Move everything pending into replay.log and return its records, oldest first."""
+        with self.lock:
+            self._sync()
+            self.file.close()
+            with open(self.replay_path, "ab") as replay:
+                for path in (self.old_path, self.pending_path):
+                    if os.path.exists(path):
+                        with open(path, "rb") as f:
+                            replay.write(f.read())
+                replay.flush()
+                os.fsync(replay.fileno())
+            for path in (self.old_path, self.pending_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.file = open(self.pending_path, "ab")
+            self.replay_records = self.decode_file(self.replay_path)
+            self.replay_dropped = 0
+            return list(self.replay_records)
+
+    def finish_replay(self, unsent: List[Record]):
+        """Drop replay.log, keeping the records that were not sent (oldest first)."""
+        with self.lock:
+            dropped = {id(record) for record in (self.replay_records or [])[:self.replay_dropped]}
+            unsent = [record for record in unsent if id(record) not in dropped]
+            self.replay_records = None
+            self.replay_dropped = 0
+            if unsent:
+                self._write_records(self.replay_path, unsent)
+            elif os.path.exists(self.replay_path):
+                os.remove(self.replay_path)
+            self._trim()
+
+    def _write_records(self, path: str, records: List[Record]):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            for timestamp, topic, payload in records:
+                f.write(self.encode(timestamp, topic, payload))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def close(self):
+        with self.lock:
+            self._sync()
+            self.file.close()
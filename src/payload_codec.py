@@ -0,0 +1,156 @@
+"""MQTT payload encodings, chosen per topic and told apart by their first byte.
+
+- json: plain JSON, no marker (what every station has always sent)
+- compact: a COMPACT marker byte and a fixed binary layout for the station
+  fields below. Booleans are bits, numbers are packed with struct, so a
+  telemetry snapshot is about 20 bytes instead of about 250
+- zlib: a ZLIB marker byte followed by zlib-compressed JSON, meant for
+  multi-sample batches such as the outbox history replay
+
+decode() accepts all three whatever the sender picked, so stations with
+different settings or firmware generations can share a broker. A message that
+doesn't fit the compact layout (unknown key, unexpected type) is sent as JSON.
+"""
+import json
+import struct
+import zlib
+from functools import lru_cache
+from typing import Any, Dict, Optional
+
+JSON = "json"
+COMPACT = "compact"
+ZLIB = "zlib"
+CODECS = (JSON, COMPACT, ZLIB)
+
+COMPACT_MARKER = 0xB1
+ZLIB_MARKER = 0xB2
+
+# Compact layout: at most 16 fields, in the order they appear in a station's data
+BOOL, INT, FLOAT, STR = range(4)
+FIELDS = (
+    ("station_id", INT),
+    ("pressure_switch", BOOL),
+    ("top_level", BOOL),
+    ("bottom_level", BOOL),
+    ("pump_status", BOOL),
+    ("fault_detected", BOOL),
+    ("op_mode", BOOL),
+    ("soft_manual", BOOL),
+    ("is_next_station_online", BOOL),
+    ("last_time_of_next_station", FLOAT),
+    ("delta", BOOL),
+    ("fault", BOOL),
+    ("command", STR),
+    ("which_station", INT),
+    ("value", BOOL),
+    ("status", STR),
+)
+FIELD_INDEX = {name: (index, kind) for index, (name, kind) in enumerate(FIELDS)}
+FIXED_FORMATS = {INT: "i", FLOAT: "d"}
+FIXED_MASK = sum(1 << index for index, (_, kind) in enumerate(FIELDS) if kind in FIXED_FORMATS)
+COMPACT_HEADER = struct.Struct("<BHHH")   # marker, present, null and true bitmasks
+INT_RANGE = (-(1 << 31), (1 << 31) - 1)
+
+
+@lru_cache(maxsize=None)
+def _fixed_struct(mask: int) -> struct.Struct:
+    """Struct for the int/float fields present in mask, in field order."""
+    return struct.Struct("<" + "".join(FIXED_FORMATS[kind] for index, (_, kind) in enumerate(FIELDS)
+                                       if mask >> index & 1))
+
+
+@lru_cache(maxsize=None)
+def _plan(present: int):
+    return tuple((1 << index, name, kind) for index, (name, kind) in enumerate(FIELDS) if present >> index & 1)
+
+
+def encode_compact(data: Dict) -> Optional[bytes]:
+    """Pack data in the compact layout, or return None if it doesn't fit."""
+    present = nulls = trues = 0
+    values = {}
+    for key, value in data.items():
+        entry = FIELD_INDEX.get(key)
+        if entry is None:
+            return None
+        index, kind = entry
+        bit = 1 << index
+        present |= bit
+        if value is None:
+            nulls |= bit
+        elif kind == BOOL:
+            if type(value) is not bool:
+                return None
+            if value:
+                trues |= bit
+        elif kind == INT:
+            if type(value) is not int or not INT_RANGE[0] <= value <= INT_RANGE[1]:
+                return None
+            values[index] = value
+        elif kind == FLOAT:
+            if type(value) is not float:
+                return None
+            values[index] = value
+        else:
+            if type(value) is not str:
+                return None
+            encoded = value.encode()
+            if len(encoded) > 255:
+                return None
+            values[index] = encoded
+
+    fixed_mask = present & ~nulls & FIXED_MASK
+    parts = [COMPACT_HEADER.pack(COMPACT_MARKER, present, nulls, trues),
+             _fixed_struct(fixed_mask).pack(*(values[index] for index in sorted(values)
+                                              if fixed_mask >> index & 1))]
+    for index in sorted(values):
+        if not fixed_mask >> index & 1:
+            parts.append(bytes((len(values[index]),)) + values[index])
+    return b"".join(parts)
+
+
+def decode_compact(payload: bytes) -> Dict:
+    _, present, nulls, trues = COMPACT_HEADER.unpack_from(payload)
+    fixed = _fixed_struct(present & ~nulls & FIXED_MASK)
+    numbers = iter(fixed.unpack_from(payload, COMPACT_HEADER.size))
+    pos = COMPACT_HEADER.size + fixed.size
+    data = {}
+    for bit, name, kind in _plan(present):
+        if nulls & bit:
+            data[name] = None
+        elif kind == BOOL:
+            data[name] = bool(trues & bit)
+        elif kind == STR:
+            length = payload[pos]
+            data[name] = payload[pos + 1:pos + 1 + length].decode()
+            pos += 1 + length
+        else:
+            data[name] = next(numbers)
+    return data
+
+
+def compress(json_bytes: bytes, level: int = 6) -> bytes:
+    """Wrap already-encoded JSON in the zlib encoding."""
+    return bytes((ZLIB_MARKER,)) + zlib.compress(json_bytes, level)
+
+
+def encode(data: Any, codec: str = JSON) -> bytes:
+    if codec == COMPACT and isinstance(data, dict):
+        payload = encode_compact(data)
+        if payload is not None:
+            return payload
+    elif codec == ZLIB:
+        return compress(json.dumps(data).encode())
+    return json.dumps(data).encode()
+
+
+def decode(payload: bytes) -> Any:
+    """Decode a payload in any of the encodings. Raises ValueError if it is malformed."""
+    marker = payload[0] if payload else None
+    try:
+        if marker == COMPACT_MARKER:
+            return decode_compact(payload)
+        if marker == ZLIB_MARKER:
+            return json.loads(zlib.decompress(payload[1:]))
+    except (struct.error, zlib.error, IndexError, StopIteration) as e:
+        raise ValueError(f"Malformed payload: {e}") from e
+    return json.loads(payload)
@@ -0,0 +1,158 @@
+"""Pump-cycle statistics from the telemetry history, and the local-mode schedule built on them.
+
+The functions take the structured array returned by TelemetryHistory.query()
+and need NumPy. Each record stands for the station's state from its timestamp
+until the next record; a gap longer than max_gap means the station was down,
+so it counts as max_gap and breaks any fill or drain in progress.
+
+Fill and drain times are measured on the tank this station feeds, between
+its two float switches, from the downstream bits recorded while the next
+station was online: a fill is empty -> between -> full, a drain is
+full -> between -> empty. The time is from leaving one switch to reaching the
+other.
+"""
+from typing import Optional
+
+import control_engine
+import serial_protocol
+import telemetry_history
+
+try:
+    import numpy as np
+except ImportError:  # analytics are skipped, local mode keeps the fixed timer
+    np = None
+
+_INPUT_BITS = dict(serial_protocol.INPUT_BITS)
+PUMP_BIT = 1 << _INPUT_BITS["pump_status"]
+PRESSURE_BIT = 1 << _INPUT_BITS["pressure_switch"]
+TOP_BIT = 1 << _INPUT_BITS["top_level"]
+BOTTOM_BIT = 1 << _INPUT_BITS["bottom_level"]
+
+# Downstream level codes
+UNKNOWN, EMPTY, BETWEEN, FULL = -1, 0, 1, 2
+
+
+def durations(records, max_gap: float):
+    """Seconds each record's state lasted, capped at max_gap; the last record counts 0."""
+    timestamps = records["timestamp"]
+    if len(timestamps) == 0:
+        return np.zeros(0)
+    return np.minimum(np.diff(timestamps, append=timestamps[-1]), max_gap)
+
+
+def rising_edges(condition) -> int:
+    """Number of False -> True transitions."""
+    condition = condition.astype(bool)
+    return int(np.count_nonzero(condition[1:] & ~condition[:-1]))
+
+
+def downstream_levels(records, max_gap: float):
+    """EMPTY/BETWEEN/FULL per record, UNKNOWN while the next station was offline or after a gap."""
+    downstream = records["downstream"]
+    levels = np.full(len(records), BETWEEN, dtype=np.int8)
+    levels[(downstream & control_engine.DOWNSTREAM_EMPTY) != 0] = EMPTY
+    levels[(downstream & control_engine.DOWNSTREAM_FULL) != 0] = FULL
+    levels[(records["flags"] & telemetry_history.NEXT_ONLINE) == 0] = UNKNOWN
+    if len(records) > 1:
+        levels[1:][np.diff(records["timestamp"]) > max_gap] = UNKNOWN
+    return levels
+
+
+def level_spans(records, max_gap: float):
+    """(fill_seconds, drain_seconds) arrays for every complete fill and drain in the records."""
+    levels = downstream_levels(records, max_gap)
+    timestamps = records["timestamp"]
+    changes = np.flatnonzero(levels[1:] != levels[:-1]) + 1
+    if len(changes) < 2:
+        return np.zeros(0), np.zeros(0)
+    before = levels[changes - 1]
+    after = levels[changes]
+    start, end = changes[:-1], changes[1:]
+    # The level between two consecutive changes is constant, so a span is a
+    # change into BETWEEN followed directly by a change out of it
+    fills = (before[:-1] == EMPTY) & (after[:-1] == BETWEEN) & (after[1:] == FULL)
+    drains = (before[:-1] == FULL) & (after[:-1] == BETWEEN) & (after[1:] == EMPTY)
+    return timestamps[end[fills]] - timestamps[start[fills]], timestamps[end[drains]] - timestamps[start[drains]]
+
+
+class PumpCycleStats:
+    def __init__(self, records, role: str = control_engine.SOURCE, max_gap: float = 180.0):
+        inputs = records["inputs"]
+        seconds = durations(records, max_gap)
+        running = (inputs & PUMP_BIT) != 0
+        self.records = len(records)
+        self.hours = float(seconds.sum()) / 3600
+        self.run_hours = float(seconds[running].sum()) / 3600
+        self.duty_cycle = self.run_hours / self.hours if self.hours else 0.0
+        self.starts = rising_edges(running)
+        self.starts_per_hour = self.starts / self.hours if self.hours else 0.0
+
+        # Running dry: no water at the intake (source) or an empty own tank
+        if role == control_engine.SOURCE:
+            dry = running & ((inputs & PRESSURE_BIT) == 0)
+        else:
+            dry = running & ((inputs & (TOP_BIT | BOTTOM_BIT)) == 0)
+        self.dry_run_events = rising_edges(dry)
+        self.dry_run_seconds = float(seconds[dry].sum())
+
+        self.fill_times, self.drain_times = level_spans(records, max_gap)
+
+    @property
+    def fill_seconds(self) -> Optional[float]:
+        """Median time to fill the downstream tank from the bottom to the top switch."""
+        return float(np.median(self.fill_times)) if len(self.fill_times) else None
+
+    @property
+    def drain_seconds(self) -> Optional[float]:
+        """Median time for the downstream tank to drain from the top to the bottom switch."""
+        return float(np.median(self.drain_times)) if len(self.drain_times) else None
+
+    def as_dict(self):
+        return {
+            "records": self.records,
+            "hours": round(self.hours, 3),
+            "duty_cycle": round(self.duty_cycle, 4),
+            "starts_per_hour": round(self.starts_per_hour, 3),
+            "dry_run_events": self.dry_run_events,
+            "dry_run_seconds": round(self.dry_run_seconds, 1),
+            "fills": len(self.fill_times),
+            "fill_seconds": self.fill_seconds,
+            "drains": len(self.drain_times),
+            "drain_seconds": self.drain_seconds,
+        }
+
+
+def analyze(records, role: str = control_engine.SOURCE, max_gap: float = 180.0) -> PumpCycleStats:
+    return PumpCycleStats(records, role, max_gap)
+
+
+class LocalSchedule:
+    """On/off times for the local-mode pump timer."""
+
+    def __init__(self, on_seconds: float, off_seconds: float, adaptive: bool = False):
+        self.on_seconds = on_seconds
+        self.off_seconds = off_seconds
+        self.adaptive = adaptive
+
+    def __repr__(self):
+        kind = "adaptive" if self.adaptive else "fixed"
+        return f"LocalSchedule({kind}, on={self.on_seconds:.0f}s, off={self.off_seconds:.0f}s)"
+
+
+def local_schedule(stats: Optional[PumpCycleStats], default_interval: float, fill_margin: float = 0.8,
+                   drain_margin: float = 0.8, min_cycles: int = 3, min_seconds: float = 300,
+                   max_seconds: Optional[float] = None) -> LocalSchedule:
+    """Pump for a fraction of the usual fill time, then rest for a fraction of the usual drain time.
+
+    Each cycle then adds and removes roughly the same fraction of the tank
+    between the switches, so without seeing the tank it neither overflows nor
+    runs dry. Times are kept within [min_seconds, max_seconds] so the motor
+    isn't short-cycled. Without min_cycles fills and drains on record it is
+    the fixed default_interval on and off.
+    """
+    if stats is None or len(stats.fill_times) < min_cycles or len(stats.drain_times) < min_cycles:
+        return LocalSchedule(default_interval, default_interval)
+    upper = max_seconds if max_seconds is not None else 4 * default_interval
+    on_seconds = min(max(fill_margin * stats.fill_seconds, min_seconds), upper)
+    off_seconds = min(max(drain_margin * stats.drain_seconds, min_seconds), upper)
+    return LocalSchedule(on_seconds, off_seconds, adaptive=True)
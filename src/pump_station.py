@@ -1,206 +1,511 @@
 import mqtt_client
 import serial_client
+import control_engine
+import telemetry_history
+import metrics
+import outbox
+import pump_analytics
+import scheduler
+import station_state
+import traffic_log
+import functools
 import json
-import time
-from typing import Optional, Dict
+import logging
 import threading
+import time
+from typing import Callable, Optional, Dict
+
+logger = logging.getLogger(__name__)
+
+MODES = ("local", "network", "soft")
 
 class PumpStation:
-    def __init__(self, station_id: int, control_pump: bool = True, has_tank: bool = True, broker="localhost"):
+    # Fields that change on almost every frame without the station's state
+    # really changing; on their own they only go out as deltas
+    VOLATILE_FIELDS = ("last_time_of_next_station",)
+
+    def __init__(self, station_id: int, control_pump: bool = True, has_tank: bool = True, broker="localhost",
+                 publish_mode: str = "delta", snapshot_keepalive: float = 60, runtime: str = "threads",
+                 broker_port: int = 1883, serial_ports: Optional[list] = None, role: Optional[str] = None,
+                 downstream: Optional[list] = None, history_path: Optional[str] = None,
+                 history_capacity: int = 65536, history_interval: float = 60, outbox_path: Optional[str] = None,
+                 outbox_max_bytes: int = 16 * 1024 * 1024, replay_order: str = "oldest",
+                 liveness_timeout: float = 6.0, mqtt_keepalive: int = 5, telemetry_codec: str = "json",
+                 history_codec: str = "zlib", adaptive_local: bool = True, analytics_window: float = 7 * 86400,
+                 poll_timeout: float = 0.25, shared_mqtt: Optional[mqtt_client.MQTTClient] = None,
+                 shared_scheduler: Optional[scheduler.DeadlineScheduler] = None, startup_timeout: float = 10.0,
+                 traffic_log_path: Optional[str] = None, traffic_log_max_bytes: int = 64 * 1024 * 1024,
+                 clock: Optional[Callable[[], float]] = None):
         self.station_id = station_id
+        # Startup milestones, in seconds from here (see check_startup)
+        self.started = time.monotonic()
+        self.startup = {}
+        self.startup_reported = False
+        self.runtime = runtime  # "threads", "asyncio" (driven by async_runtime) or "replay" (traffic_replay)
+        # Wall clock of every control decision; traffic_replay passes a virtual
+        # one, which then drives the scheduler as well
+        self.clock = clock or time.time
         self.control_pump = control_pump
         self.has_tank = has_tank
-        
-        # Station state tracking
-        self.pressure_ok = False
-        self.top_level_triggered = False
-        self.bottom_level_triggered = False
-        self.pump_status = False
-        self.fault_detected = False
-        self.op_mode = False
-
-        self.data = {
-            "station_id": station_id,
-            "pressure_switch": False,
-            "top_level": False,
-            "bottom_level": False,
-            "pump_status": False,
-            "fault_detected": False,
-            "op_mode": False,
-            "soft_manual": False,
-            "is_next_station_online": False,
-            "last_time_of_next_station": None
-        }
-        
+
+        # Control decisions come from tables compiled for the station's role.
+        # downstream lists the stations this one feeds (more than one for a branch).
+        self.role = role or control_engine.default_role(control_pump, has_tank)
+        self.engine = control_engine.ControlEngine(self.role, control_pump)
+        if downstream is None:
+            downstream = [] if self.role == control_engine.MONITOR else [station_id + 1]
+        self.downstream = list(downstream)
+        self.downstream_bits = 0
+        self.downstream_network = False
+
+        # Station state: written only through self.state's update methods,
+        # read from its immutable snapshot (see station_state)
+        self.state = station_state.StationState(station_id)
+
         # Network state tracking
-        self.mqtt_connected = False
-        self.next_station_online = False
         self.last_status_update = {}
         self.station_status = {}
-        self.no_updates_timeout = 30
-        self.number_of_stations_in_series = 2
+
+        # Liveness of the stations we feed. Each one is dropped back to local
+        # mode when its Last Will (OFFLINE) arrives, or when nothing has been
+        # heard from it for no_updates_timeout seconds, checked by a deadline
+        # timer rather than by polling. The time from its last sign of life
+        # to the switch is recorded in pump_station_failover_seconds.
+        self.no_updates_timeout = liveness_timeout
+        # A StationHost passes its scheduler and MQTT connection in to share them
+        # between stations; a station only starts and stops what it owns
+        self.owns_scheduler = shared_scheduler is None
+        self.scheduler = shared_scheduler or scheduler.DeadlineScheduler(clock=clock or time.monotonic,
+                                                                           metric_labels={"station": str(station_id)})
+        self.last_seen = {}          # station -> scheduler clock time of its last message
+        self.liveness_timers = {}
+        self.failover_seconds = {cause: metrics.histogram("pump_station_failover_seconds",
+                                                          "Last sign of life of a downstream station to local mode",
+                                                          buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60),
+                                                          station=str(station_id), cause=cause)
+                                 for cause in ("will", "timeout")}
+
+        # Commands from station 0 are acted on with fresh inputs: the Arduino
+        # is polled and the command runs when its answer arrives, or with the
+        # last known inputs after poll_timeout seconds
+        self.poll_timeout = poll_timeout
+        self.poll_lock = threading.Lock()
+        self.pending_poll = None
+        self.pending_actions = []
+        self.poll_timer = None
+
+        # Input edge at the Arduino (debounce included) to the control decision
+        self.decision_seconds = metrics.histogram("pump_station_input_decision_seconds",
+                                                  "Input change at the Arduino to the control decision",
+                                                  buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+                                                  station=str(station_id))
+
+        # Telemetry publishing: "full" sends the state on every frame, "delta"
+        # sends a retained snapshot on change/keep-alive and deltas otherwise
+        self.publish_mode = publish_mode
+        self.snapshot_keepalive = snapshot_keepalive
+        self.last_published = None   # snapshot last published
+        self.last_snapshot_time = 0
+        self.last_publish_time = 0
         
-        # Initialize communication clients
-        self.mqtt_client = mqtt_client.MQTTClient(
-            id=f"station_{station_id}",
-            broker = broker,
-            callback=self.mqtt_callback
-        )
-        self.serial_client = serial_client.SerialClient(self.serial_callback)
+        # Telemetry history: a record on every change of inputs/outputs/mode,
+        # and at least every history_interval seconds
+        self.history = telemetry_history.TelemetryHistory(history_path, history_capacity) if history_path else None
+        self.history_interval = history_interval
+        self.last_history_record = None
+        self.last_history_time = 0
+        self.last_serial_data = None
+        self.pump_command = False
+        self.connected_status = False
+
+        # Topic layout: we publish our own telemetry/alive topics, and only
+        # subscribe to our command topic and the next station's status
+        self.telemetry_topic = mqtt_client.station_topic(station_id, "telemetry")
+        self.command_topic = mqtt_client.station_topic(station_id, "cmd")
+        self.history_topic = mqtt_client.station_topic(station_id, "history")
+        self.alive_topic = mqtt_client.station_topic(station_id, "alive")
+
+        # Telemetry produced while the broker is unreachable is kept on disk
+        # and replayed to pumps/<id>/history on reconnect, so the live
+        # telemetry topic never carries stale state
+        self.last_stored = None
+        self.last_stored_time = 0
+
+        # Initialize communication clients. A shared connection's outbox,
+        # keepalive and Last Will belong to the host, so outbox_path,
+        # replay_order and mqtt_keepalive only apply to a station's own client
+        self.client_id = f"station_{station_id}"
+        self.owns_mqtt = shared_mqtt is None
+        # "compact" telemetry needs every station reading it to run this version
+        codecs = {self.telemetry_topic: telemetry_codec, self.history_topic: history_codec}
+        if self.owns_mqtt:
+            station_outbox = outbox.Outbox(outbox_path, outbox_max_bytes) if outbox_path else None
+            self.mqtt_client = mqtt_client.MQTTClient(
+                id=self.client_id,
+                broker = broker,
+                port=broker_port,
+                alive_topic=self.alive_topic,
+                start=runtime == "threads",
+                outbox=station_outbox,
+                replay_topic=self.history_topic,
+                replay_order=replay_order,
+                status_topic=self.alive_topic,
+                keepalive=mqtt_keepalive,
+                codecs=codecs
+            )
+        else:
+            if outbox_path:
+                logger.warning("Station %s: outbox_path is ignored on a shared MQTT connection", station_id)
+            self.mqtt_client = shared_mqtt
+            self.mqtt_client.codecs.update(codecs)
+            self.mqtt_client.add_status_topic(self.alive_topic, self.client_id)
+
+        self.subscriptions = []
+        self.will_watches = set()    # (will topic, station) of stations whose Last Will is on another topic
+        self.subscribe(self.command_topic, self.command_callback)
+        for next_id in self.downstream:
+            self.subscribe(mqtt_client.station_topic(next_id, "telemetry"),
+                           functools.partial(self.next_station_callback, next_id))
+            self.subscribe(mqtt_client.station_topic(next_id, "alive"),
+                           functools.partial(self.next_station_alive, next_id))
+        self.serial_client = serial_client.SerialClient(self.serial_callback, start=runtime == "threads",
+                                                      ports=serial_ports,
+                                                      metric_labels={"station": str(station_id)})
+
+        # Serial and MQTT traffic recorded for replay (see traffic_log). On a
+        # shared connection every station's log has all of the host's messages,
+        # so each one replays on its own
+        self.recorder = None
+        if traffic_log_path:
+            self.recorder = traffic_log.TrafficRecorder(traffic_log_path, traffic_log_max_bytes)
+            self.serial_client.recorder = self.recorder
+            self.mqtt_client.recorders.append(self.recorder)
+            if self.mqtt_client.is_connected():
+                self.recorder.mqtt_state(True)
         
         # Local control mode parameters
         self.LOCAL_PUMP_INTERVAL = 2700  # 45 minutes
         self.last_pump_time = 0
         self.local_mode = False
         self.toggle = True
+
+        # With history (and NumPy) the local timer pumps for a fraction of the
+        # downstream tank's usual fill time and rests for a fraction of its
+        # drain time, recomputed over analytics_window when local mode starts
+        self.adaptive_local = adaptive_local and self.history is not None and pump_analytics.np is not None
+        self.analytics_window = analytics_window
+        self.analytics_refresh = 600
+        self.local_schedule = pump_analytics.LocalSchedule(self.LOCAL_PUMP_INTERVAL, self.LOCAL_PUMP_INTERVAL)
+        self.local_schedule_time = None
         
-        # Start monitoring thread
+        # Current mode as a Prometheus state set: the active mode's gauge is 1
+        self.mode = ""
+        self.mode_gauges = {mode: metrics.gauge("pump_station_mode", "1 for the station's current mode",
+                                                station=str(station_id), mode=mode) for mode in MODES}
+
+        # Alive pulse and status LED; the asyncio runtime runs the scheduler itself
         self.running = True
-        self.monitor_loop()
-        self.monitor_thread = threading.Thread(target=self.monitor_loop)
-        self.monitor_thread.daemon = True
-        self.monitor_thread.start()
+        self.heartbeat_timer = self.scheduler.call_every(self.mqtt_client.alive_pulse_interval, self.heartbeat)
+        self.startup_timer = self.scheduler.call_later(startup_timeout, self.check_startup, True)
+        if runtime == "threads" and self.owns_scheduler:
+            self.scheduler.start()
+        self.mark_startup("init")
 
-    def mqtt_callback(self, data: Dict):
-        """Handle incoming MQTT messages."""
+    def subscribe(self, topic: str, callback):
+        self.mqtt_client.subscribe(topic, callback)
+        self.subscriptions.append((topic, callback))
+
+    def command_callback(self, data: Dict):
+        """Handle commands from station 0 published on our command topic."""
 
         try:
-            station_id = data.get("station_id")
-            if station_id == 0:
-                which_station = data.get("which_station")
-                if which_station == self.data["station_id"]:
-                    command = data.get("command")
-                    if command == "set_soft_manual":
-                        self.data["soft_manual"] = data.get("value")
-                    elif command == "set_pump":
-                        if self.data["soft_manual"]:
-                            if data.get("value"):
-                                if self.data["station_id"] == 1 and self.data["pressure_switch"]:
-                                    self.start_pump()
-                                elif self.data["station_id"] == 2 and not self.data["bottom_level"]:
-                                    self.start_pump()
-                            else:
-                                self.stop_pump()
-            elif self.data["station_id"] + 1 == station_id and not self.data["soft_manual"]:
-                self.data["is_next_station_online"] = True
-                self.data["last_time_of_next_station"] = time.time()
-
-                if data.get("op_mode", False):
-                    # Take action based on status of next pump station
-                    self.handle_network_mode(data)
-                else:
-                    self.handle_local_mode()
-
-            elif self.data["station_id"] == station_id and not self.data["is_next_station_online"] and not self.data["soft_manual"]:
-                self.handle_local_mode()
+            if data.get("which_station", self.station_id) != self.station_id:
+                return
+            command = data.get("command")
+            if command == "set_soft_manual":
+                self.state.update(soft_manual=bool(data.get("value")))
+                self.update_mode()
+            elif command == "set_pump":
+                if self.state.soft_manual:
+                    self.after_poll(functools.partial(self.manual_pump, bool(data.get("value"))))
         except Exception as e:
             self.handle_local_mode()  # Fallback to local mode on error
 
+    def manual_pump(self, value: bool):
+        # The fresh frame may have ended soft manual mode (op_mode switch)
+        if self.state.soft_manual:
+            self.execute(self.engine.manual(self.state.input_bits, value))
+
+    def after_poll(self, action):
+        """Run action once the Arduino has answered a poll, or after poll_timeout with the inputs we have."""
+        with self.poll_lock:
+            if self.pending_poll is None:
+                seq = self.serial_client.poll()
+                if seq is not None:
+                    self.pending_poll = seq
+                    self.poll_timer = self.scheduler.call_later(self.poll_timeout, self.poll_expired)
+            if self.pending_poll is not None:
+                self.pending_actions.append(action)
+                return
+        action()
+
+    def poll_answered(self, seq: int):
+        with self.poll_lock:
+            if seq != self.pending_poll:
+                return
+        self.run_pending_actions()
+
+    def poll_expired(self):
+        logger.debug("Station %s: poll not answered within %.3f s, using the last status",
+                     self.station_id, self.poll_timeout)
+        self.run_pending_actions()
+
+    def run_pending_actions(self):
+        with self.poll_lock:
+            self.scheduler.cancel(self.poll_timer)
+            actions, self.pending_actions = self.pending_actions, []
+            self.pending_poll = self.poll_timer = None
+        for action in actions:
+            action()
+
+    def next_station_callback(self, station_id: int, data: Dict):
+        """Handle telemetry (snapshots and deltas) published by a station we feed."""
+
+        try:
+            self.merge_station_status(station_id, data)
+            downstream_bits = self.downstream_bits
+            self.update_downstream()
+            if self.downstream_bits != downstream_bits and self.history is not None and self.last_serial_data:
+                # Record level changes as they happen, for the fill/drain times
+                self.record_history(self.last_serial_data)
+
+            # A retained snapshot may be arbitrarily old; keep it as the last
+            # known state but don't treat it as a sign of life
+            if data.get("_retained"):
+                return
+            self.mark_next_station_seen(station_id)
+            if not self.state.soft_manual:
+                self.apply_control()
+        except Exception as e:
+            self.handle_local_mode()  # Fallback to local mode on error
+
+    def merge_station_status(self, station_id: int, data: Dict) -> Dict:
+        """Apply a snapshot or delta to the cached state of another station."""
+        if data.get("delta"):
+            status = dict(self.station_status.get(station_id, {}))
+            status.update(data)
+        else:
+            status = dict(data)
+        status.pop("delta", None)
+        status.pop("_retained", None)
+        self.station_status[station_id] = status
+        return status
+
+    def update_downstream(self):
+        """Recompute the aggregated downstream bits after a status change."""
+        statuses = [self.station_status.get(station_id, {}) for station_id in self.downstream]
+        self.downstream_bits = control_engine.downstream_bits(statuses)
+        self.downstream_network = bool(statuses) and all(status.get("op_mode", False) for status in statuses)
+
+    def next_station_alive(self, station_id: int, data: Dict):
+        """Alive pulses refresh liveness; OFFLINE (the station's Last Will) fails over at once."""
+
+        try:
+            status = data.get("status")
+            if status == "OFFLINE":
+                self.fail_over(station_id, "will")
+                return
+            will_topic = data.get("will_topic")
+            if will_topic and (will_topic, station_id) not in self.will_watches:
+                # The station shares a connection whose Last Will goes to will_topic
+                self.will_watches.add((will_topic, station_id))
+                self.subscribe(will_topic, functools.partial(self.next_station_will, station_id))
+            if not data.get("_retained"):
+                # A retained ONLINE only says the station was up when it last connected
+                self.mark_next_station_seen(station_id)
+        except Exception as e:
+            self.handle_local_mode()  # Fallback to local mode on error
+
+    def next_station_will(self, station_id: int, data: Dict):
+        """The Last Will of the connection a station we feed shares with others."""
+        if data.get("status") == "OFFLINE":
+            self.fail_over(station_id, "will")
+
+    def mark_next_station_seen(self, station_id: int):
+        self.last_status_update[station_id] = self.clock()
+        if station_id not in self.last_seen:
+            self.liveness_timers[station_id] = self.scheduler.call_later(self.no_updates_timeout,
+                                                                         self.check_liveness, station_id)
+        self.last_seen[station_id] = self.scheduler.clock()
+        # Online once every station we feed has been heard from; the oldest
+        # update is the one that times out first
+        if len(self.last_status_update) == len(self.downstream) and not self.state.is_next_station_online:
+            self.state.update(is_next_station_online=True)
+            self.update_mode()
+        self.state.update(last_time_of_next_station=min(self.last_status_update.values()))
+
+    def check_liveness(self, station_id: int):
+        """Deadline timer: fail over if the station stayed silent, otherwise wait for its new deadline."""
+        last_seen = self.last_seen.get(station_id)
+        if last_seen is None:
+            return
+        deadline = last_seen + self.no_updates_timeout
+        if self.scheduler.clock() < deadline:
+            self.liveness_timers[station_id] = self.scheduler.call_at(deadline, self.check_liveness, station_id)
+        else:
+            self.fail_over(station_id, "timeout")
+
+    def fail_over(self, station_id: int, cause: str):
+        """A station we feed went offline: switch to local mode now instead of on the next frame."""
+        last_seen = self.last_seen.pop(station_id, None)
+        self.scheduler.cancel(self.liveness_timers.pop(station_id, None))
+        self.last_status_update.pop(station_id, None)
+        if last_seen is None:
+            return
+        self.state.update(is_next_station_online=False)
+        if not self.state.soft_manual:
+            self.handle_local_mode()
+        self.update_mode()
+        elapsed = self.scheduler.clock() - last_seen
+        self.failover_seconds[cause].observe(elapsed)
+        logger.warning("Station %s: station %s offline (%s), local mode %.3f s after it was last heard",
+                       self.station_id, station_id, cause, elapsed)
+
     def serial_callback(self, data: Dict):
         """Handle incoming serial data from Arduino."""
         try:
             self.update_station_state(data)
 
             if self.mqtt_client.is_connected():
-                self.mqtt_client.send(self.data)  # Forward to MQTT
+                self.publish_state()  # Forward to MQTT
+                if not self.state.soft_manual:
+                    # Re-evaluate against the cached downstream state so local
+                    # input changes are acted on straight away
+                    self.apply_control()
             else:
                 # if the systemm is disconnected from Mqqt broker soft_manual must be reset
-                self.data["soft_manual"] = False
+                self.state.update(soft_manual=False)
                 self.handle_local_mode()
+                self.store_state()
         except Exception as e:
             # if the systemm is disconnected from Mqqt broker soft_manual must be reset
-            self.data["soft_manual"] = False
+            self.state.update(soft_manual=False)
             self.handle_local_mode()  # Fallback to local mode on error
 
+        if data.get("event") == "change" and "_arrival" in data:
+            self.decision_seconds.observe(time.monotonic() - data["_arrival"] + data.get("age_ms", 0) / 1000)
+        if "poll" in data:
+            self.poll_answered(data["poll"])
+        if not self.startup_reported:
+            self.mark_startup("first_frame")
+            self.mark_startup("control")
+            self.check_startup()
+
+        if self.history is not None:
+            self.last_serial_data = data
+            self.record_history(data)
+
+    def record_history(self, data: Dict):
+        """Append a history record if anything changed or the interval has passed."""
+        snapshot = self.state.snapshot
+        flags = ((telemetry_history.PUMP_COMMAND if self.pump_command else 0)
+                 | (telemetry_history.CONNECTED if self.connected_status else 0)
+                 | (telemetry_history.SOFT_MANUAL if snapshot.soft_manual else 0)
+                 | (telemetry_history.NEXT_ONLINE if snapshot.is_next_station_online else 0)
+                 | (telemetry_history.LOCAL_MODE if self.local_mode else 0))
+        downstream = self.downstream_bits | (telemetry_history.DOWNSTREAM_AUTO if self.downstream_network else 0)
+        record = (telemetry_history.pack_inputs(data), flags, downstream)
+        now = self.clock()
+        if record != self.last_history_record or now - self.last_history_time >= self.history_interval:
+            self.history.append(now, *record)
+            self.last_history_record = record
+            self.last_history_time = now
+
+    def publish_state(self):
+        """Publish station state according to publish_mode."""
+        now = self.clock()
+        snapshot = self.state.snapshot
+        if self.publish_mode == "full":
+            self.mqtt_client.send(snapshot.as_dict(), self.telemetry_topic)
+            self.last_publish_time = now
+            return
+
+        changed = snapshot.changes(self.last_published)
+
+        if (any(key not in self.VOLATILE_FIELDS for key in changed)
+                or now - self.last_snapshot_time >= self.snapshot_keepalive):
+            # Retained so a station that subscribes later gets it immediately
+            self.mqtt_client.send(snapshot.as_dict(), self.telemetry_topic, retain=True)
+            self.last_snapshot_time = now
+        elif changed:
+            changed["station_id"] = self.station_id
+            changed["delta"] = True
+            self.mqtt_client.send(changed, self.telemetry_topic)
+        else:
+            return
+        self.last_published = snapshot
+        self.last_publish_time = now
+
+    def store_state(self):
+        """While MQTT is down, keep full snapshots in the outbox on change and every snapshot_keepalive."""
+        if self.mqtt_client.outbox is None:
+            return
+        now = self.clock()
+        snapshot = self.state.snapshot
+        if (self.last_stored is None or snapshot.version != self.last_stored.version
+                or now - self.last_stored_time >= self.snapshot_keepalive):
+            self.mqtt_client.store(snapshot.as_dict(), self.telemetry_topic, timestamp=now)
+            self.last_stored = snapshot
+            self.last_stored_time = now
+
     def update_station_state(self, data: Dict):
         """Update internal state based on Arduino data."""
-        self.pressure_ok = data.get("pressure_switch", False)
-        self.top_level_triggered = data.get("top_level", False)
-        self.bottom_level_triggered = data.get("bottom_level", False)
-        self.pump_status = data.get("pump_status", False)
-        self.fault_detected = data.get("fault", False)
-        self.op_mode = data.get("op_mode", False)
-
-        self.data["pressure_switch"] = data.get("pressure_switch", False)
-        self.data["top_level"] = data.get("top_level", False)
-        self.data["bottom_level"] = data.get("bottom_level", False)
-        self.data["pump_status"] = data.get("pump_status", False)
-        self.data["fault_detected"] = data.get("fault", False)
-        self.data["op_mode"] = data.get("op_mode", False)
-
-        # if manual switch is turned back to local mode it must reset soft manual control
-        if self.data["op_mode"]:
-            self.data["soft_manual"] = False
-
-        # print(f"pump status {self.pump_status}")
-        # print(f"fault status {self.fault_detected}")
-        # print(f"pressure status {self.pressure_ok}")
-        # print(f"top float status {self.top_level_triggered}")
-        # print(f"bottom float status {self.bottom_level_triggered}")
-        # print(f"op_mode status {self.op_mode}")
+        # Switching the manual switch back to local mode also ends soft manual control
+        self.state.apply_frame(data)
 
     def should_monitor_station(self, station_id: int) -> bool:
-        """Determine if we should monitor this station based on our station ID."""
-        if self.station_id == 1:
-            return station_id == 2
-        elif self.station_id == 2:
-            return station_id == 3
-        return False
-
-    def handle_network_mode(self, data: Dict):
-        """Process status updates from the next station in the chain."""
-        if self.station_id == 1:  # Station 1 monitors Station 2's bottom level
-            if not self.pressure_ok:
-                self.stop_pump()
-                # print("pressure not ok")
-            elif not data.get("bottom_level", True) and not data.get("top_level", True) and not self.fault_detected:
-                self.start_pump()
-                # print("start pump")
-            elif data.get("bottom_level", False) and data.get("top_level", False):
-                self.stop_pump()
-                # print("stop pump")
-
+        """Determine if we should monitor this station, i.e. if we feed it."""
+        return station_id in self.downstream
 
-        elif self.station_id == 2:  # Station 2 monitors Station 3's levels
-            if not self.bottom_level_triggered and not self.top_level_triggered:
-                self.stop_pump()
-                # print("stop pump")
-
-            elif not data.get("bottom_level", True) and not data.get("top_level", True) and not self.fault_detected:
-                self.start_pump()
-                # print("start pump")
-            elif data.get("bottom_level", False) and data.get("top_level", False):
-                self.stop_pump()
-                # print("stop pump")
+    def apply_control(self):
+        """Run the decision for the current mode: network if every station we feed is online and in auto."""
+        if self.state.is_next_station_online and self.downstream_network:
+            self.handle_network_mode()
+        else:
+            self.handle_local_mode()
 
+    def handle_network_mode(self):
+        """Act on our inputs and the levels of the stations we feed."""
+        self.local_mode = False
+        self.execute(self.engine.network(self.state.input_bits, self.downstream_bits))
 
-        elif self.station_id == 3:
-            pass
+    def execute(self, action: int):
+        if action == control_engine.START:
+            self.send_pump_command(True)
+        elif action == control_engine.STOP:
+            self.send_pump_command(False)
+        elif action == control_engine.TIMER:
+            self.run_local_timer()
 
     def start_pump(self):
         """Start the pump if conditions allow."""
-        if not self.control_pump:
-            return
-            
-        if self.station_id == 1:
-            if self.pressure_ok and not self.fault_detected:
-                self.send_pump_command(True)
-        else:
-            if not self.top_level_triggered and not self.fault_detected:
-                self.send_pump_command(True)
+        if self.engine.can_start(self.state.input_bits):
+            self.send_pump_command(True)
 
     def stop_pump(self):
         """Stop the pump."""
-        if self.control_pump:
+        if self.engine.controls_pump:
             self.send_pump_command(False)
 
     def send_pump_command(self, state: bool):
         """Send pump control command to Arduino."""
+        self.pump_command = state
         command = {"pump_control": state}
         self.serial_client.send(command)
 
     def set_connected_status(self, state: bool):
         """send connected status for LED indicator"""
+        self.connected_status = state
         command = {"connected_status": state}
         self.serial_client.send(command)
 
@@ -210,72 +515,131 @@ class PumpStation:
 
     def handle_local_mode(self):
         """Manage pump operation in local control mode."""
-        # print("handle local mode start")
-        current_time = time.time()
-        
-        if self.station_id == 1:
-            # print("station 1 ............")
-            # Station 1: Use pressure switch and timing
-            if not self.fault_detected:
-                if self.pressure_ok:
-                    # print("pressure ok")
-                    if current_time - self.last_pump_time >= self.LOCAL_PUMP_INTERVAL:
-                        self.last_pump_time = current_time
-                        if self.toggle:
-                            self.start_pump()
-                            # print("start pump on station 1 local")
-                            self.toggle = not self.toggle
-                        else:
-                            self.stop_pump()
-                            # print("stop pump on station 1 local")
-                            self.toggle = not self.toggle
-
-                else:
-                    self.stop_pump()
-                    # print("stop pump on station 1 local")
-                
-        elif self.station_id == 2:
-            # print("station 2 ...........")
-            # Station 2: Use local tank levels
-            if not self.fault_detected:
-                if self.top_level_triggered and self.bottom_level_triggered:
-                    # print("station 2 start pump local")
-                    self.start_pump()
-                elif not self.top_level_triggered and not self.bottom_level_triggered:
-                    # print("station 2 stop pump local")
-                    self.stop_pump()
-
-        elif self.station_id == 3:
-            # station 3 doesnt control its motor
-            # print("station 3 ...........")
-            pass 
-
-    def monitor_loop(self):
-        """Main monitoring loop to handle mode switching and status checks."""
-        while self.running:
-
-            if self.data["last_time_of_next_station"] != None:
-                if time.time() - self.data["last_time_of_next_station"] > self.no_updates_timeout:
-                    self.data["is_next_station_online"] = False
-
-            mode = ""
-            if not self.data["is_next_station_online"]:
-                mode = "local"
-                self.set_connected_status(False)
+        if not self.local_mode:
+            self.enter_local_mode()
+        self.local_mode = True
+        self.execute(self.engine.local(self.state.input_bits))
+
+    def enter_local_mode(self):
+        """Pick the local timer's on/off times and start with the phase the last known level calls for."""
+        now = self.clock()
+        if self.adaptive_local and (self.local_schedule_time is None
+                                    or now - self.local_schedule_time >= self.analytics_refresh):
+            try:
+                records = self.history.query(now - self.analytics_window)
+                stats = pump_analytics.analyze(records, self.role, max_gap=3 * self.history_interval)
+                self.local_schedule = pump_analytics.local_schedule(stats, self.LOCAL_PUMP_INTERVAL)
+                logger.info("Station %s local schedule %s from %s", self.station_id, self.local_schedule,
+                            stats.as_dict())
+            except Exception as e:
+                logger.warning("Station %s pump analytics failed, keeping %s: %s",
+                               self.station_id, self.local_schedule, e)
+            self.local_schedule_time = now
+        elif not self.adaptive_local:
+            self.local_schedule = pump_analytics.LocalSchedule(self.LOCAL_PUMP_INTERVAL, self.LOCAL_PUMP_INTERVAL)
+        if self.local_schedule.adaptive:
+            # A full tank downstream gets a rest first, anything else a fill
+            self.toggle = not self.downstream_bits & control_engine.DOWNSTREAM_FULL
+
+    def run_local_timer(self):
+        """Alternate the pump ON and OFF following the local schedule (LOCAL_PUMP_INTERVAL each by default)."""
+        current_time = self.clock()
+        # toggle set: the pump is resting and starts next
+        interval = self.local_schedule.off_seconds if self.toggle else self.local_schedule.on_seconds
+        if current_time - self.last_pump_time >= interval:
+            self.last_pump_time = current_time
+            if self.toggle:
+                self.start_pump()
             else:
-                if self.data["soft_manual"]:
-                    mode = "soft"
-                else:
-                    mode = "network"
-                self.set_connected_status(True)
-            # print(f"Station {self.station_id} switching to {mode} mode")
-
-            time.sleep(1)
+                self.stop_pump()
+            self.toggle = not self.toggle
+
+    def heartbeat(self):
+        """Every alive_pulse_interval: alive pulse, and refresh the status LED."""
+        # Telemetry is a sign of life too, so skip the pulse if some just went out
+        if self.clock() - self.last_publish_time >= self.mqtt_client.alive_pulse_interval:
+            self.mqtt_client.alive_pulse(self.alive_topic, self.client_id)
+        self.update_mode()
+
+    def update_mode(self):
+        """Set the status LED and mode gauges from the current mode."""
+        mode = ""
+        snapshot = self.state.snapshot
+        if not snapshot.is_next_station_online:
+            mode = "local"
+            self.set_connected_status(False)
+        else:
+            if snapshot.soft_manual:
+                mode = "soft"
+            else:
+                mode = "network"
+            self.set_connected_status(True)
+
+        if mode != self.mode:
+            logger.info("Station %s switching to %s mode", self.station_id, mode)
+            for name, gauge in self.mode_gauges.items():
+                gauge.set(1 if name == mode else 0)
+            self.mode = mode
+            if mode == "network" and not self.startup_reported:
+                self.mark_startup("network")
+                self.check_startup()
+
+    def mark_startup(self, phase: str, when: Optional[float] = None):
+        """Record the first time a startup milestone was reached."""
+        if phase not in self.startup:
+            elapsed = (when if when is not None else time.monotonic()) - self.started
+            self.startup[phase] = elapsed
+            metrics.gauge("pump_station_startup_seconds", "Station start to each startup milestone",
+                          station=str(self.station_id), phase=phase).set(elapsed)
+
+    def check_startup(self, deadline: bool = False):
+        """Log the startup timing once the station is in control, or at startup_timeout with what is missing.
+
+        Control starts with the first Arduino frame, in local mode until the
+        broker and the stations we feed are reachable, so the pump is handled
+        as soon as the serial port is up whatever the network does.
+        """
+        if self.startup_reported:
+            return
+        for phase, supervisor in (("serial", self.serial_client.supervisor), ("mqtt", self.mqtt_client.supervisor)):
+            if supervisor.connected_since is not None:
+                self.mark_startup(phase, supervisor.connected_since)
+        expected = ["serial", "first_frame", "control", "mqtt"] + (["network"] if self.downstream else [])
+        missing = [phase for phase in expected if phase not in self.startup]
+        if missing and not deadline:
+            return
+        self.startup_reported = True
+        self.scheduler.cancel(self.startup_timer)
+        timing = ", ".join(f"{phase} {seconds:.3f} s" for phase, seconds in
+                           sorted(self.startup.items(), key=lambda item: item[1]))
+        if not missing:
+            logger.info("Station %s started in %.3f s (%s mode): %s", self.station_id,
+                        max(self.startup.values()), self.mode, timing)
+            return
+        logger.warning("Station %s not fully up after %.0f s, waiting for %s (%s mode): %s", self.station_id,
+                       time.monotonic() - self.started, ", ".join(missing), self.mode or "no", timing)
+        if "first_frame" in missing:
+            # The Arduino may have missed its boot frame; ask for one
+            self.serial_client.poll()
 
     def cleanup(self):
         """Clean up resources when shutting down."""
         self.running = False
-        if self.monitor_thread.is_alive():
-            self.monitor_thread.join()
-        self.mqtt_client.cleanup()
+        if self.owns_scheduler:
+            self.scheduler.stop()
+        else:
+            for timer in [self.heartbeat_timer, self.poll_timer, self.startup_timer, *self.liveness_timers.values()]:
+                self.scheduler.cancel(timer)
+        if self.owns_mqtt:
+            self.mqtt_client.cleanup()
+        else:
+            for topic, callback in self.subscriptions:
+                self.mqtt_client.unsubscribe(topic, callback)
+            self.mqtt_client.remove_status_topic(self.alive_topic)
         self.serial_client.stop()
+        if self.history is not None:
+            self.history.close()
+        if self.recorder is not None:
+            if not self.owns_mqtt:
+                self.mqtt_client.recorders.remove(self.recorder)
+            self.recorder.close()
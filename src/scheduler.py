@@ -0,0 +1,131 @@
+"""Run callbacks at deadlines from a single thread.
+
+Deadlines are kept in a heap, so the thread sleeps until the earliest one
+instead of waking on a fixed tick. Cancelling only flags a timer; it is
+dropped when it reaches the top of the heap.
+
+    scheduler = DeadlineScheduler()
+    scheduler.start()
+    timer = scheduler.call_later(5.0, callback, arg)
+    scheduler.call_every(2.0, heartbeat)
+    scheduler.cancel(timer)
+
+The clock is injectable, and run_pending() can be called directly instead of
+start(), e.g. from an event loop (see async_runtime) or with a simulated clock.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Seconds a callback ran after its deadline
+LAG_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+
+class Timer:
+    __slots__ = ("when", "callback", "args", "interval", "cancelled")
+
+    def __init__(self, when, callback, args, interval=None):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.interval = interval
+        self.cancelled = False
+
+
+class DeadlineScheduler:
+    def __init__(self, clock: Callable[[], float] = time.monotonic, metric_labels=None):
+        self.clock = clock
+        self.heap = []
+        self.counter = itertools.count()   # keeps equal deadlines in insertion order
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+        self.on_change = None   # called when a new earliest deadline is added (see async_runtime)
+        self.lag_seconds = metrics.histogram("scheduler_lag_seconds", "Delay between a deadline and its callback",
+                                             buckets=LAG_BUCKETS, **(metric_labels or {}))
+
+    def call_at(self, when: float, callback, *args) -> Timer:
+        return self._push(Timer(when, callback, args))
+
+    def call_later(self, delay: float, callback, *args) -> Timer:
+        return self._push(Timer(self.clock() + delay, callback, args))
+
+    def call_every(self, interval: float, callback, *args) -> Timer:
+        """Run callback every interval seconds, the first time right away."""
+        return self._push(Timer(self.clock(), callback, args, interval))
+
+    def cancel(self, timer: Optional[Timer]):
+        if timer is not None:
+            timer.cancelled = True
+
+    def _push(self, timer: Timer) -> Timer:
+        with self.condition:
+            heapq.heappush(self.heap, (timer.when, next(self.counter), timer))
+            earliest = self.heap[0][2] is timer
+            if earliest:
+                self.condition.notify()
+        if earliest and self.on_change is not None:
+            self.on_change()
+        return timer
+
+    def run_pending(self, now: Optional[float] = None) -> Optional[float]:
+        """Run every callback that is due. Returns the seconds until the next deadline, or None."""
+        heap = self.heap
+        while True:
+            with self.condition:
+                current = self.clock() if now is None else now
+                while heap and heap[0][2].cancelled:
+                    heapq.heappop(heap)
+                if not heap:
+                    return None
+                when, _, timer = heap[0]
+                if when > current:
+                    return when - current
+                heapq.heappop(heap)
+
+            self.lag_seconds.observe(current - when)
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                logger.exception("Scheduled callback %r failed: %s", timer.callback, e)
+
+            if timer.interval and not timer.cancelled:
+                # Keep the original cadence, but don't try to catch up missed runs
+                timer.when = when + timer.interval
+                if timer.when <= current:
+                    timer.when = current + timer.interval
+                self._push(timer)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="scheduler", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            self.run_pending()
+            with self.condition:
+                if not self.running:
+                    break
+                # Re-read the head under the lock so a deadline added since
+                # run_pending returned can't be missed
+                if self.heap:
+                    delay = self.heap[0][0] - self.clock()
+                    if delay > 0:
+                        self.condition.wait(delay)
+                else:
+                    self.condition.wait()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join()
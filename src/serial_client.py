@@ -1,95 +1,437 @@
 import serial
+import serial_protocol
+import metrics
+from supervisor import ConnectionSupervisor
 import json
+import logging
 import time
+import queue
 import threading
+from typing import Optional
+
+logger = logging.getLogger(__name__)
 
 class SerialClient:
-    def __init__(self, callback):
+    MAX_FRAME_SIZE = 1024
+    MAX_HELLO_ATTEMPTS = 3
+    MAX_UNANSWERED_POLLS = 3
+
+    DEFAULT_PORTS = ('/dev/ttyACM0', '/dev/ttyUSB0')
+
+    def __init__(self, callback, refresh_interval=30, write_queue_size=32, protocol="auto", start=True,
+                 ports=None, metric_labels=None):
         self.ser = None
+        self.ports = tuple(ports) if ports else self.DEFAULT_PORTS
         self.lock = threading.Lock()  # Mutex for thread-safe access
         self.running = True           # Control flag for the thread
         self.message_thread = None    # Thread for listening to messages
+        self.writer_thread = None     # Thread writing queued commands
         self.callback = callback
+        self.buffer = bytearray()     # Bytes received but not yet split into frames
+        self.latency_stats = {"frames": 0, "total": 0.0, "max": 0.0, "last": 0.0}
+
+        # Wire protocol: "json" only, or "auto" to negotiate binary framing
+        # (see serial_protocol) and fall back to JSON if the firmware is older
+        self.protocol = protocol
+        self.protocol_version = 0     # 0 = JSON lines, >= 1 = binary frames
+        self.hello_attempts = 0
+        self.rx_seq = None
+        self.tx_seq = 0
+        self.write_lock = threading.Lock()
+        self.frame_stats = {"json": 0, "binary": 0, "invalid": 0, "crc_errors": 0, "seq_gaps": 0}
+
+        # Polls waiting for their status frame: seq -> monotonic time sent.
+        # Firmware that never answers is not polled again until it is reopened
+        self.poll_seq = 0
+        self.polls_sent = {}
+        self.polls_answered = False
+        self.poll_stats = {"sent": 0, "answered": 0}
+
+        # Outgoing commands are written by a single writer thread. The shadow
+        # holds the last value written per key so repeats are only re-sent
+        # every refresh_interval seconds.
+        self.refresh_interval = refresh_interval
+        self.write_queue = queue.Queue(maxsize=write_queue_size)
+        self.shadow = {}
+        self.shadow_time = {}
+        self.write_stats = {"queued": 0, "written": 0, "suppressed": 0, "dropped": 0}
+
+        # Hot-path metrics; the stats dicts above are exported at scrape time
+        labels = metric_labels or {}
+        self.metric_labels = labels
+        self.parse_seconds = metrics.histogram("serial_frame_parse_seconds", "Time to decode one serial frame", **labels)
+        self.callback_seconds = metrics.histogram("serial_callback_seconds",
+                                                  "Time spent in the serial frame callback", **labels)
+        self.latency_seconds = metrics.histogram("serial_frame_latency_seconds",
+                                                 "Frame arrival to callback completion", **labels)
+        self.poll_seconds = metrics.histogram("serial_poll_seconds", "Poll request to its status frame", **labels)
+        metrics.add_collector(self.collect_metrics)
 
-        # Try to establish connection
-        self.reconnect()
+        # Opens the port, and reopens it with backoff whenever it is lost
+        self.supervisor = ConnectionSupervisor("serial", self.try_open, initial_delay=1.0, max_delay=30.0,
+                                               metric_labels=labels)
+
+        # The asyncio runtime drives the port itself (see async_runtime)
+        self.on_queued = None
+        # A traffic_log.TrafficRecorder when the station records its traffic
+        self.recorder = None
+        if not start:
+            return
+
+        # Connect in the background; frames are read once the port is open
+        self.supervisor.start()
 
         # Start the on_message thread
         self.message_thread = threading.Thread(target=self.on_messages)
         self.message_thread.daemon = True
         self.message_thread.start()
 
+        # Start the writer thread
+        self.writer_thread = threading.Thread(target=self.writer_loop)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
     def on_connect(self):
-        pass
+        # Opening the port resets the Arduino, so its outputs no longer match the
+        # shadow and it is back on JSON until we negotiate again
+        self.buffer.clear()
+        self.invalidate_shadow()
+        self.protocol_version = 0
+        self.hello_attempts = 0
+        self.rx_seq = None
+        self.polls_sent.clear()
+        self.polls_answered = False
+        if self.protocol == "auto":
+            self.send_hello()
 
     def on_disconnect(self):
         if self.ser and self.ser.is_open:
             self.ser.close()
 
     def on_messages(self):
-        """Thread function to continuously listen for messages."""
+        """Thread function to continuously listen for messages.
+
+        The thread blocks inside read() until bytes arrive (or the port timeout
+        expires) instead of polling in_waiting, and it does not hold the lock
+        while waiting so is_connected() and reconnects are never stalled.
+        """
         while self.running:
-            with self.lock:  # Ensure exclusive access to the serial port
-                if self.ser and self.ser.is_open:
-                    try:
-                        if self.ser.in_waiting > 0:
-                            line = self.ser.readline().decode('utf-8').rstrip()
-                            try:
-                                data = json.loads(line)  # Parse JSON data
-                                if self.callback != None:
-                                    self.callback(data)  # Process the data
-                            except json.JSONDecodeError as e:
-                                print(f"Invalid JSON received: {line} - {e}")
-                            self.ser.flush()
-                    except serial.SerialException as e:
-                        print(f"Serial connection error: {e}")
-                        self.reconnect()
-            time.sleep(0.1)  # Prevent CPU overuse
+            ser = self.ser
+            if not (ser and ser.is_open):
+                time.sleep(0.5)
+                continue
+            try:
+                chunk = ser.read(ser.in_waiting or 1)
+            except (serial.SerialException, OSError) as e:
+                logger.warning("Serial connection error: %s", e)
+                self.buffer.clear()
+                self.on_disconnect()
+                self.supervisor.connection_lost(e)
+                continue
+            if not chunk:
+                continue
+            try:
+                self.feed(chunk, time.monotonic())
+            except Exception as e:
+                # A frame the callback chokes on must not end the reader thread:
+                # the port stays open, so the supervisor would never restart it
+                logger.exception("Error handling serial data: %s", e)
+
+    def feed(self, chunk: bytes, arrival: float):
+        """Append raw bytes to the receive buffer and dispatch every complete frame."""
+        if self.recorder is not None:
+            self.recorder.serial_in(chunk)
+        buffer = self.buffer
+        buffer += chunk
+        while buffer:
+            if buffer[0] == serial_protocol.SYNC:
+                consumed, frame = serial_protocol.parse_frame(buffer)
+                if not consumed:
+                    break
+                del buffer[:consumed]
+                if frame is None:
+                    # Bad length or CRC: drop the sync byte and resync
+                    self.frame_stats["crc_errors"] += 1
+                    continue
+                self.handle_binary_frame(frame, arrival)
+                continue
+
+            end = buffer.find(b'\n')
+            if self.protocol_version:
+                # In binary mode a partial line can precede a frame; skip to it
+                sync = buffer.find(serial_protocol.SYNC)
+                if sync >= 0 and (end < 0 or sync < end):
+                    del buffer[:sync]
+                    self.frame_stats["invalid"] += 1
+                    continue
+            if end < 0:
+                break
+            line = bytes(buffer[:end])
+            del buffer[:end + 1]
+            self.handle_frame(line, arrival)
+
+        # A line this long is noise on the port, not a frame from the Arduino
+        if len(buffer) > self.MAX_FRAME_SIZE:
+            logger.warning("Discarding %d bytes without frame terminator", len(buffer))
+            self.frame_stats["invalid"] += 1
+            buffer.clear()
+
+    def handle_frame(self, line: bytes, arrival: float):
+        """Decode one JSON line, run the callback and record arrival-to-callback latency."""
+        line = line.strip()
+        if not line:
+            return
+        started = time.perf_counter()
+        try:
+            data = json.loads(line)  # Parse JSON data
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            self.frame_stats["invalid"] += 1
+            logger.warning("Invalid JSON received: %r - %s", line, e)
+            return
+        self.parse_seconds.observe(time.perf_counter() - started)
+        if not isinstance(data, dict):
+            # Valid JSON but not a status object (42, null, [..]): noise on the line
+            self.frame_stats["invalid"] += 1
+            logger.warning("Ignoring serial line that is not a JSON object: %r", line)
+            return
+        self.frame_stats["json"] += 1
+
+        # Still talking JSON: the hello may have been lost while the Arduino
+        # was booting, so ask again a few times before settling on JSON
+        if self.protocol == "auto" and not self.protocol_version and self.hello_attempts < self.MAX_HELLO_ATTEMPTS:
+            self.send_hello()
+
+        self.dispatch(data, arrival)
+
+    def handle_binary_frame(self, frame, arrival: float):
+        frame_type, seq, payload = frame
+        self.frame_stats["binary"] += 1
+        if self.rx_seq is not None and seq != (self.rx_seq + 1) & 0xFF:
+            self.frame_stats["seq_gaps"] += 1
+        self.rx_seq = seq
+
+        if frame_type == serial_protocol.HELLO:
+            if not payload:
+                self.frame_stats["invalid"] += 1
+                logger.warning("Ignoring HELLO frame without a protocol version")
+                return
+            self.protocol_version = min(payload[0], serial_protocol.VERSION)
+            logger.info("Serial protocol negotiated: binary v%d", self.protocol_version)
+        elif frame_type == serial_protocol.STATUS and len(payload) >= 2:
+            started = time.perf_counter()
+            data = serial_protocol.decode_status(payload)
+            self.parse_seconds.observe(time.perf_counter() - started)
+            self.dispatch(data, arrival)
+        else:
+            self.frame_stats["invalid"] += 1
+
+    def dispatch(self, data, arrival: float):
+        # Lets the callback measure from the frame's arrival, also when it runs later (asyncio runtime)
+        data["_arrival"] = arrival
+        if "poll" in data:
+            self.poll_answered(data["poll"], arrival)
+        if self.callback != None:
+            started = time.perf_counter()
+            self.callback(data)  # Process the data
+            self.callback_seconds.observe(time.perf_counter() - started)
+        self.record_latency(time.monotonic() - arrival)
+
+    def record_latency(self, latency: float):
+        stats = self.latency_stats
+        stats["frames"] += 1
+        stats["total"] += latency
+        stats["last"] = latency
+        if latency > stats["max"]:
+            stats["max"] = latency
+        self.latency_seconds.observe(latency)
+
+    def get_latency_stats(self):
+        """Return frame count and arrival-to-callback latency in seconds."""
+        stats = dict(self.latency_stats)
+        stats["avg"] = stats["total"] / stats["frames"] if stats["frames"] else 0.0
+        return stats
+
+    def collect_metrics(self):
+        labels = self.metric_labels
+        for kind in ("json", "binary"):
+            yield ("serial_frames_total", "counter", "Serial frames received",
+                   dict(labels, protocol=kind), self.frame_stats[kind])
+        yield ("serial_invalid_frames_total", "counter", "Undecodable serial frames or lines",
+               labels, self.frame_stats["invalid"])
+        yield "serial_crc_errors_total", "counter", "Binary frames failing the CRC", labels, self.frame_stats["crc_errors"]
+        yield "serial_seq_gaps_total", "counter", "Gaps in binary frame sequence numbers", labels, self.frame_stats["seq_gaps"]
+        yield "serial_writes_total", "counter", "Commands written to the port", labels, self.write_stats["written"]
+        yield ("serial_writes_suppressed_total", "counter", "Command keys skipped because the shadow matched",
+               labels, self.write_stats["suppressed"])
+        yield ("serial_commands_dropped_total", "counter", "Commands dropped on a full write queue",
+               labels, self.write_stats["dropped"])
+        yield "serial_polls_total", "counter", "Status polls sent to the Arduino", labels, self.poll_stats["sent"]
+        yield ("serial_poll_replies_total", "counter", "Status polls answered by the Arduino",
+               labels, self.poll_stats["answered"])
+        yield "serial_connected", "gauge", "1 if the serial port is open", labels, int(bool(self.ser and self.ser.is_open))
 
     def send(self, data):
-        """Send data over the serial connection."""
-        # with self.lock:  # Ensure exclusive access to the serial port
+        """Queue a command for the writer thread. Never blocks the caller."""
+        self.write_stats["queued"] += 1
+        try:
+            self.write_queue.put_nowait(data)
+        except queue.Full:
+            # Collapse the backlog into one command so no key is lost and the
+            # newest value per key still wins
+            merged = {}
+            while True:
+                try:
+                    merged.update(self.write_queue.get_nowait())
+                except queue.Empty:
+                    break
+            merged.update(data)
+            data = merged
+            try:
+                self.write_queue.put_nowait(data)
+            except queue.Full:
+                self.write_stats["dropped"] += 1
+        if self.on_queued is not None:
+            self.on_queued()
+
+    def writer_loop(self):
+        """Thread function that coalesces queued commands and writes the changes."""
+        while self.running:
+            try:
+                pending = dict(self.write_queue.get(timeout=1))
+            except queue.Empty:
+                continue
+            self.write_changes(self.collect_pending(pending))
+
+    def collect_pending(self, pending):
+        """Fold everything else already queued into pending; the newest value per key wins."""
+        while True:
+            try:
+                pending.update(self.write_queue.get_nowait())
+            except queue.Empty:
+                return pending
+
+    def write_changes(self, pending):
+        """Write the keys whose value differs from the shadow or is due for a refresh."""
+        now = time.monotonic()
+        changes = {}
+        for key, value in pending.items():
+            if (key in self.shadow and self.shadow[key] == value
+                    and now - self.shadow_time[key] < self.refresh_interval):
+                self.write_stats["suppressed"] += 1
+                continue
+            changes[key] = value
+        if not changes:
+            return
+
+        if self.write(changes):
+            for key, value in changes.items():
+                self.shadow[key] = value
+                self.shadow_time[key] = now
+
+    def write(self, data):
+        """Send data over the serial connection. Returns True if it was written."""
         try:
             if self.ser and self.ser.is_open:
-                json_data = json.dumps(data) + '\n'
-                self.ser.write(json_data.encode('utf-8'))  # Encode as bytes and send
-                print(f"Sent data: {json_data}")
+                # tx_seq is shared with poll(), so it is taken under the lock too
+                with self.write_lock:
+                    frame = None
+                    if self.protocol_version:
+                        frame = serial_protocol.encode_command(data, self.tx_seq)
+                        self.tx_seq = (self.tx_seq + 1) & 0xFF
+                    if frame is None:
+                        frame = (json.dumps(data) + '\n').encode('utf-8')  # Encode as bytes and send
+                    self.ser.write(frame)
+                self.write_stats["written"] += 1
+                if self.recorder is not None:
+                    self.recorder.serial_out(data)
+                logger.debug("Sent data: %s", data)
+                return True
         except serial.SerialException as e:
-            print(f"Error sending data: {e}")
-            self.reconnect()
+            logger.warning("Error sending data: %s", e)
+            self.on_disconnect()
+            self.supervisor.connection_lost(e)
+        return False
+
+    def poll(self) -> Optional[int]:
+        """Ask the Arduino for a status frame now, bypassing the write queue.
+
+        Returns the poll's seq, or None if the port is closed or the firmware
+        doesn't answer polls. The answer goes to the callback like any other
+        frame, with data["poll"] set to the seq.
+        """
+        ser = self.ser
+        if not (ser and ser.is_open):
+            return None
+        if not self.polls_answered and len(self.polls_sent) >= self.MAX_UNANSWERED_POLLS:
+            return None
+        seq = self.poll_seq = (self.poll_seq + 1) & 0xFF
+        try:
+            with self.write_lock:
+                if self.protocol_version:
+                    frame = serial_protocol.encode_poll(seq, self.tx_seq)
+                    self.tx_seq = (self.tx_seq + 1) & 0xFF
+                else:
+                    frame = (json.dumps({"poll": seq}) + '\n').encode('utf-8')
+                ser.write(frame)
+        except serial.SerialException as e:
+            logger.warning("Error sending poll: %s", e)
+            return None
+        self.polls_sent[seq] = time.monotonic()
+        self.poll_stats["sent"] += 1
+        return seq
+
+    def poll_answered(self, seq: int, arrival: float):
+        sent = self.polls_sent.pop(seq, None)
+        if sent is None:
+            return
+        self.polls_answered = True
+        self.poll_stats["answered"] += 1
+        self.poll_seconds.observe(arrival - sent)
+
+    def send_hello(self):
+        """Ask the Arduino to switch to binary framing."""
+        ser = self.ser
+        if not (ser and ser.is_open):
+            return
+        self.hello_attempts += 1
+        try:
+            with self.write_lock:
+                ser.write((json.dumps({"proto": serial_protocol.VERSION}) + '\n').encode('utf-8'))
+        except serial.SerialException as e:
+            logger.warning("Error sending protocol hello: %s", e)
+
+    def invalidate_shadow(self):
+        """Forget what was last written so every key is sent again on its next command."""
+        self.shadow.clear()
+        self.shadow_time.clear()
 
     def is_connected(self):
         """Check if the serial connection is active."""
         with self.lock:
             return self.ser and self.ser.is_open
 
-    def reconnect(self):
-        """Attempt to reconnect the serial connection."""
-        print("Attempting to reconnect serial")
-        while True:
+    def try_open(self):
+        """Try each known port once. Returns True if one was opened."""
+        for port in self.ports:
             try:
                 with self.lock:  # Lock the port during reconnect attempts
-                    # self.ser = serial_client.Serial('/dev/ttyACM0', 115200, timeout=1)
-                    self.ser = serial.Serial('/dev/ttyACM0', 115200, timeout=1)
-                    print("Reconnected on /dev/ttyACM0")
-                    break
-            except:
-                try:
-                    with self.lock:
-                        # self.ser = serial_client.Serial('/dev/ttyUSB0', 115200, timeout=1)
-                        self.ser = serial.Serial('/dev/ttyUSB0', 115200, timeout=1)
-                        print("Reconnected on /dev/ttyUSB0")
-                        break
-                except:
-                    print("Reconnection failed, retrying in 3 seconds...")
-                    time.sleep(3)
+                    self.ser = serial.Serial(port, 115200, timeout=1)
+            except (serial.SerialException, OSError):
+                continue
+            logger.info("Reconnected on %s", port)
+            self.on_connect()
+            return True
+        return False
 
     def stop(self):
         """Gracefully stop the client."""
         self.running = False
-        if self.message_thread.is_alive():
-            self.message_thread.join()
+        self.supervisor.stop()
+        for thread in (self.message_thread, self.writer_thread):
+            if thread and thread.is_alive():
+                thread.join()
         self.on_disconnect()
+        metrics.REGISTRY.remove_collector(self.collect_metrics)
 
 if __name__ == "__main__":
     
@@ -0,0 +1,154 @@
+"""Compact binary framing shared by SerialClient and heltec_node.ino.
+
+Frame layout (all integers big-endian):
+
+    SYNC(0xA5) LEN VER SEQ TYPE PAYLOAD[LEN] CRC16
+
+CRC16 is CRC-16/CCITT-FALSE over VER..PAYLOAD. A status frame is 9 bytes
+instead of ~120 bytes of JSON. The Pi asks for binary mode by sending the
+JSON line {"proto": 1}; firmware that understands it answers with a HELLO
+frame, older firmware ignores the key and both sides stay on JSON.
+
+The Arduino sends a status frame as soon as a debounced input changes, and
+every few seconds as a heartbeat. The Pi can also poll for one ({"poll": seq}
+or a POLL frame); the answer carries the same seq. Status frames say why they
+were sent: EVENT_HEARTBEAT, EVENT_CHANGE with the milliseconds since the
+input edge, or EVENT_POLL with the poll's seq. Older firmware sends neither
+the event nor answers polls.
+"""
+from typing import Dict, Optional, Tuple
+
+SYNC = 0xA5
+VERSION = 1
+HEADER_SIZE = 5   # SYNC, LEN, VER, SEQ, TYPE
+CRC_SIZE = 2
+MAX_PAYLOAD = 32
+
+# Frame types
+HELLO = 0x01      # Arduino -> Pi: payload VERSION, STATION_ID
+STATUS = 0x02     # Arduino -> Pi: payload STATION_ID, INPUT_BITS[, EVENT, ARG]
+COMMAND = 0x10    # Pi -> Arduino: payload MASK, VALUES
+POLL = 0x11       # Pi -> Arduino: payload SEQ, answered with an EVENT_POLL status
+
+# Why a status frame was sent; ARG is the age of the edge in ms for a change
+# and the poll's seq for a poll
+EVENT_HEARTBEAT = 0
+EVENT_CHANGE = 1
+EVENT_POLL = 2
+EVENT_NAMES = ("heartbeat", "change", "poll")
+
+# Bit positions of the six digital inputs in a STATUS frame
+INPUT_BITS = (
+    ("pump_status", 0),
+    ("pressure_switch", 1),
+    ("top_level", 2),
+    ("bottom_level", 3),
+    ("fault", 4),
+    ("op_mode", 5),
+)
+
+# Bit positions of the outputs in a COMMAND frame
+COMMAND_BITS = {
+    "pump_control": 0,
+    "connected_status": 1,
+}
+
+
+def _make_crc_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table.append(crc & 0xFFFF)
+    return tuple(table)
+
+
+_CRC_TABLE = _make_crc_table()
+
+
+def crc16(data) -> int:
+    """CRC-16/CCITT-FALSE (poly 0x1021, init 0xFFFF)."""
+    crc = 0xFFFF
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ _CRC_TABLE[((crc >> 8) ^ byte) & 0xFF]
+    return crc
+
+
+def pack_inputs(data: Dict) -> int:
+    """Pack the six digital inputs of a status dict into one byte."""
+    bits = 0
+    for name, bit in INPUT_BITS:
+        if data.get(name):
+            bits |= 1 << bit
+    return bits
+
+
+def unpack_inputs(bits: int) -> Dict:
+    return {name: bool(bits >> bit & 1) for name, bit in INPUT_BITS}
+
+
+def encode_frame(frame_type: int, payload: bytes, seq: int) -> bytes:
+    body = bytes((VERSION, seq & 0xFF, frame_type)) + payload
+    crc = crc16(body)
+    return bytes((SYNC, len(payload))) + body + bytes((crc >> 8, crc & 0xFF))
+
+
+def parse_frame(buffer) -> Tuple[int, Optional[Tuple[int, int, bytes]]]:
+    """Try to parse one frame from the start of buffer (which starts with SYNC).
+
+    Returns (consumed, frame) where frame is (type, seq, payload). consumed is 0
+    when more bytes are needed, and 1 with frame None when the bytes at the
+    start are not a valid frame, so the caller can resync on the next byte.
+    """
+    if len(buffer) < 2:
+        return 0, None
+    length = buffer[1]
+    if length > MAX_PAYLOAD:
+        return 1, None
+    total = HEADER_SIZE + length + CRC_SIZE
+    if len(buffer) < total:
+        return 0, None
+    body = buffer[2:HEADER_SIZE + length]
+    crc = buffer[total - 2] << 8 | buffer[total - 1]
+    if crc16(body) != crc:
+        return 1, None
+    return total, (body[2], body[1], bytes(body[3:]))
+
+
+def decode_status(payload: bytes) -> Dict:
+    """Turn a STATUS payload into the same dict the JSON protocol produces."""
+    data = {"station_id": payload[0]}
+    data.update(unpack_inputs(payload[1]))
+    if len(payload) >= 4 and payload[2] < len(EVENT_NAMES):
+        data["event"] = EVENT_NAMES[payload[2]]
+        if payload[2] == EVENT_CHANGE:
+            data["age_ms"] = payload[3]
+        elif payload[2] == EVENT_POLL:
+            data["poll"] = payload[3]
+    return data
+
+
+def encode_status(station_id: int, data: Dict, event: Optional[str] = None, arg: int = 0) -> bytes:
+    """STATUS payload, as the firmware builds it."""
+    payload = bytes((station_id, pack_inputs(data)))
+    if event is not None:
+        payload += bytes((EVENT_NAMES.index(event), min(arg, 255)))
+    return payload
+
+
+def encode_poll(poll_seq: int, seq: int) -> bytes:
+    return encode_frame(POLL, bytes((poll_seq & 0xFF,)), seq)
+
+
+def encode_command(data: Dict, seq: int) -> Optional[bytes]:
+    """Encode a command dict as a COMMAND frame, or None if it has keys binary mode can't carry."""
+    mask = values = 0
+    for key, value in data.items():
+        bit = COMMAND_BITS.get(key)
+        if bit is None:
+            return None
+        mask |= 1 << bit
+        if value:
+            values |= 1 << bit
+    return encode_frame(COMMAND, bytes((mask, values)), seq)
@@ -0,0 +1,95 @@
+"""Station configuration file, read by main.py at startup.
+
+JSON. Settings at the top level apply to every station; "stations" lists the
+stations this Pi runs, each with at least its station_id and role:
+
+    {
+        "broker": "10.10.0.248",
+        "stations": [
+            {"station_id": 1, "role": "source", "serial_ports": ["/dev/ttyACM0"]}
+        ]
+    }
+
+Any PumpStation argument can be set (liveness_timeout, telemetry_codec,
+history_path, ...). role is source, intermediate or monitor and implies
+control_pump and has_tank. With more than one station, or a host_id, the
+stations share one MQTT connection on a StationHost; the connection settings
+(broker, broker_port, mqtt_keepalive, outbox_*, replay_order) are then the
+host's and go at the top level.
+"""
+import inspect
+import json
+from typing import Dict, List
+
+import control_engine
+import station_host
+from pump_station import PumpStation
+
+STATION_KEYS = set(inspect.signature(PumpStation.__init__).parameters) - {"self", "shared_mqtt", "shared_scheduler", "clock"}
+# Keys that set up the shared connection when the stations are hosted
+HOST_KEYS = {"host_id": "host_id", "broker": "broker", "broker_port": "port", "mqtt_keepalive": "keepalive",
+             "outbox_path": "outbox_path", "outbox_max_bytes": "outbox_max_bytes", "replay_order": "replay_order"}
+
+
+def load(path: str) -> Dict:
+    with open(path) as f:
+        config = json.load(f)
+    stations(config)   # fail at load time rather than half way through startup
+    return config
+
+
+def stations(config: Dict) -> List[Dict]:
+    """PumpStation keyword arguments of every configured station."""
+    defaults = {key: value for key, value in config.items() if key != "stations"}
+    entries = config.get("stations")
+    if not entries:
+        raise ValueError("config lists no stations")
+    result = []
+    for entry in entries:
+        misplaced = set(entry) & set(HOST_KEYS) if is_hosted(config) else ()
+        if misplaced:
+            raise ValueError(f"hosted stations share the connection, set {', '.join(sorted(misplaced))} "
+                             "at the top level")
+        kwargs = dict(defaults, **entry)
+        kwargs.pop("host_id", None)
+        unknown = set(kwargs) - STATION_KEYS
+        if unknown:
+            raise ValueError(f"unknown settings for station {kwargs.get('station_id')}: {', '.join(sorted(unknown))}")
+        if "station_id" not in kwargs:
+            raise ValueError(f"station without a station_id: {entry}")
+        role = kwargs.get("role")
+        if role is not None:
+            if role not in control_engine.ROLES:
+                raise ValueError(f"station {kwargs['station_id']}: role must be one of "
+                                 f"{', '.join(control_engine.ROLES)}")
+            kwargs.setdefault("control_pump", role != control_engine.MONITOR)
+            kwargs.setdefault("has_tank", role != control_engine.SOURCE)
+        result.append(kwargs)
+    ids = [kwargs["station_id"] for kwargs in result]
+    if len(set(ids)) != len(ids):
+        raise ValueError(f"station ids appear more than once: {ids}")
+    logs = [kwargs["traffic_log_path"] for kwargs in result if kwargs.get("traffic_log_path")]
+    if len(set(logs)) != len(logs):
+        raise ValueError(f"each station needs a traffic_log_path of its own, got {logs}")
+    return result
+
+
+def is_hosted(config: Dict) -> bool:
+    return "host_id" in config or len(config.get("stations", ())) > 1
+
+
+def build(config: Dict):
+    """Create the configured stations. Returns (stations, host), host None for a single station."""
+    entries = stations(config)
+    if not is_hosted(config):
+        return [PumpStation(**entries[0])], None
+
+    host_kwargs = {HOST_KEYS[key]: value for key, value in config.items() if key in HOST_KEYS}
+    host_kwargs.setdefault("host_id", "host")
+    host = station_host.StationHost(**host_kwargs)
+    started = []
+    for kwargs in entries:
+        for key in HOST_KEYS:
+            kwargs.pop(key, None)
+        started.append(host.add_station(kwargs.pop("station_id"), kwargs.pop("serial_ports", None), **kwargs))
+    return started, host
@@ -0,0 +1,88 @@
+"""Run several PumpStations in one process over one MQTT connection.
+
+For gateway Pis that front an Arduino per serial port, and for test rigs.
+The stations share one MQTTClient and one DeadlineScheduler, so the host
+has one network thread and one timer thread however many stations it runs;
+each station keeps its own serial port and SerialClient threads.
+
+    host = StationHost("gateway1", broker="10.10.0.248")
+    host.add_station(2, ["/dev/ttyUSB0"], control_pump=True, has_tank=True)
+    host.add_station(3, ["/dev/ttyUSB1"], control_pump=False, has_tank=True)
+
+Incoming messages are routed by topic: each station subscribes to its own
+pumps/<id>/cmd and the topics of the stations it feeds, the client keeps a
+list of handlers per topic and decodes a payload once, then hands it only to
+the stations that subscribed to it.
+
+A connection has a single Last Will, so it goes to the host's own
+pumps/<host_id>/alive. Each station still has a retained ONLINE/OFFLINE on
+its pumps/<id>/alive; the ONLINE names the will topic, and a station feeding
+a hosted station watches it too, so it still fails over at once when the
+host dies, and the aggregator marks every station of the host offline. The outbox (outbox_path) is also per host and replays to
+pumps/<host_id>/history, each record with the telemetry topic it was meant
+for.
+"""
+import logging
+from typing import Dict, Optional
+
+import mqtt_client
+import outbox
+import scheduler
+from pump_station import PumpStation
+
+logger = logging.getLogger(__name__)
+
+
+class StationHost:
+    def __init__(self, host_id: str, broker="localhost", port: int = 1883, keepalive: int = 5,
+                 outbox_path: Optional[str] = None, outbox_max_bytes: int = 16 * 1024 * 1024,
+                 replay_order: str = "oldest", start: bool = True):
+        if str(host_id).isdigit():
+            # pumps/<digits>/... are station topics
+            raise ValueError(f"host_id {host_id!r} would clash with a station id")
+        self.host_id = host_id
+        self.broker = broker
+        self.stations: Dict[int, PumpStation] = {}
+        self.scheduler = scheduler.DeadlineScheduler(metric_labels={"host": str(host_id)})
+
+        will_topic = mqtt_client.station_topic(host_id, "alive")
+        self.mqtt_client = mqtt_client.MQTTClient(
+            id=f"host_{host_id}",
+            broker=broker,
+            port=port,
+            alive_topic=will_topic,
+            start=start,
+            outbox=outbox.Outbox(outbox_path, outbox_max_bytes) if outbox_path else None,
+            replay_topic=mqtt_client.station_topic(host_id, "history"),
+            replay_order=replay_order,
+            status_topic=will_topic,
+            keepalive=keepalive,
+        )
+        if start:
+            self.scheduler.start()
+
+    def add_station(self, station_id: int, serial_ports: list, **kwargs) -> PumpStation:
+        """Create a station on the shared connection. kwargs are passed to PumpStation."""
+        if station_id in self.stations:
+            raise ValueError(f"station {station_id} is already hosted")
+        if kwargs.get("runtime", "threads") != "threads":
+            raise ValueError("hosted stations run on the threaded runtime")
+        in_use = {port for station in self.stations.values() for port in station.serial_client.ports}
+        if not serial_ports or in_use.intersection(serial_ports):
+            raise ValueError(f"station {station_id} needs serial ports of its own, got {serial_ports}")
+        station = PumpStation(station_id, broker=self.broker, serial_ports=serial_ports,
+                              shared_mqtt=self.mqtt_client, shared_scheduler=self.scheduler, **kwargs)
+        self.stations[station_id] = station
+        logger.info("Host %s: station %s on %s", self.host_id, station_id, ", ".join(serial_ports))
+        return station
+
+    def remove_station(self, station_id: int):
+        station = self.stations.pop(station_id, None)
+        if station is not None:
+            station.cleanup()
+
+    def cleanup(self):
+        for station_id in list(self.stations):
+            self.remove_station(station_id)
+        self.scheduler.stop()
+        self.mqtt_client.cleanup()
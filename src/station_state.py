@@ -0,0 +1,147 @@
+"""A station's own state, shared by the serial, MQTT and timer threads.
+
+The state is an immutable StateSnapshot: the boolean fields in one bitfield,
+the time the next station was last heard from, and a version that goes up
+on every change. Writers go through StationState's update methods, which
+build the next snapshot under a lock and swap it in; readers just take
+state.snapshot (one attribute read, no lock) and get a consistent view that
+no other thread can change under them.
+
+    state = StationState(1)
+    state.apply_frame({"pressure_switch": True, "op_mode": True, ...})
+    state.update(soft_manual=True)
+    snapshot = state.snapshot
+    snapshot.soft_manual, snapshot.version, snapshot.as_dict()
+"""
+import threading
+from typing import Dict, NamedTuple, Optional
+
+import control_engine
+
+# Telemetry fields in publishing order; the booleans each have a bit
+FIELDS = ("station_id", "pressure_switch", "top_level", "bottom_level", "pump_status", "fault_detected",
+          "op_mode", "soft_manual", "is_next_station_online", "last_time_of_next_station")
+BITS = {name: 1 << index for index, name in enumerate(FIELDS[1:-1])}
+
+PRESSURE_SWITCH = BITS["pressure_switch"]
+TOP_LEVEL = BITS["top_level"]
+BOTTOM_LEVEL = BITS["bottom_level"]
+FAULT_DETECTED = BITS["fault_detected"]
+OP_MODE = BITS["op_mode"]
+SOFT_MANUAL = BITS["soft_manual"]
+NEXT_ONLINE = BITS["is_next_station_online"]
+
+# Arduino frame key -> bit; the frame calls the fault input "fault"
+FRAME_BITS = (("pressure_switch", PRESSURE_SWITCH), ("top_level", TOP_LEVEL), ("bottom_level", BOTTOM_LEVEL),
+              ("pump_status", BITS["pump_status"]), ("fault", FAULT_DETECTED), ("op_mode", OP_MODE))
+FRAME_MASK = sum(bit for _, bit in FRAME_BITS)
+
+
+def input_bits(bits: int) -> int:
+    """The control engine's local input bits for a state bitfield."""
+    return control_engine.local_bits(bool(bits & PRESSURE_SWITCH), bool(bits & TOP_LEVEL),
+                                     bool(bits & BOTTOM_LEVEL), bool(bits & FAULT_DETECTED))
+
+
+class StateSnapshot(NamedTuple):
+    station_id: int
+    bits: int
+    last_time_of_next_station: Optional[float]
+    version: int
+    input_bits: int     # derived from bits, kept for the control engine
+
+    def flag(self, name: str) -> bool:
+        return bool(self.bits & BITS[name])
+
+    @property
+    def soft_manual(self) -> bool:
+        return bool(self.bits & SOFT_MANUAL)
+
+    @property
+    def is_next_station_online(self) -> bool:
+        return bool(self.bits & NEXT_ONLINE)
+
+    @property
+    def op_mode(self) -> bool:
+        return bool(self.bits & OP_MODE)
+
+    def as_dict(self) -> Dict:
+        """The telemetry dict, a new one on every call."""
+        data = {"station_id": self.station_id}
+        for name, bit in BITS.items():
+            data[name] = bool(self.bits & bit)
+        data["last_time_of_next_station"] = self.last_time_of_next_station
+        return data
+
+    def changes(self, since: Optional["StateSnapshot"]) -> Dict:
+        """Fields that differ from an earlier snapshot (all of them if there is none)."""
+        if since is None:
+            return self.as_dict()
+        diff = self.bits ^ since.bits
+        changed = {name: bool(self.bits & bit) for name, bit in BITS.items() if diff & bit}
+        if self.last_time_of_next_station != since.last_time_of_next_station:
+            changed["last_time_of_next_station"] = self.last_time_of_next_station
+        return changed
+
+
+class StationState:
+    __slots__ = ("lock", "snapshot")
+
+    def __init__(self, station_id: int):
+        self.lock = threading.Lock()
+        self.snapshot = StateSnapshot(station_id, 0, None, 0, input_bits(0))
+
+    @property
+    def version(self) -> int:
+        return self.snapshot.version
+
+    @property
+    def soft_manual(self) -> bool:
+        return self.snapshot.soft_manual
+
+    @property
+    def is_next_station_online(self) -> bool:
+        return self.snapshot.is_next_station_online
+
+    @property
+    def input_bits(self) -> int:
+        return self.snapshot.input_bits
+
+    def _swap(self, bits: int, last_time: Optional[float]) -> StateSnapshot:
+        """Swap in the next version if anything changed; call with the lock held."""
+        current = self.snapshot
+        if bits == current.bits and last_time == current.last_time_of_next_station:
+            return current
+        self.snapshot = StateSnapshot(current.station_id, bits, last_time, current.version + 1,
+                                      input_bits(bits) if (bits ^ current.bits) & FRAME_MASK
+                                      else current.input_bits)
+        return self.snapshot
+
+    def apply_frame(self, data: Dict) -> StateSnapshot:
+        """Take the six inputs from an Arduino frame (missing keys read as False)."""
+        frame_bits = 0
+        for key, bit in FRAME_BITS:
+            if data.get(key, False):
+                frame_bits |= bit
+        with self.lock:
+            current = self.snapshot
+            bits = (current.bits & ~FRAME_MASK) | frame_bits
+            if bits & OP_MODE:
+                # The manual switch turned back to local mode ends soft manual control
+                bits &= ~SOFT_MANUAL
+            return self._swap(bits, current.last_time_of_next_station)
+
+    def update(self, **fields) -> StateSnapshot:
+        """Set boolean fields and/or last_time_of_next_station in one step."""
+        with self.lock:
+            current = self.snapshot
+            bits = current.bits
+            last_time = current.last_time_of_next_station
+            for name, value in fields.items():
+                if name == "last_time_of_next_station":
+                    last_time = value
+                elif value:
+                    bits |= BITS[name]
+                else:
+                    bits &= ~BITS[name]
+            return self._swap(bits, last_time)
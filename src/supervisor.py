@@ -0,0 +1,190 @@
+"""Reconnect supervision for the serial and MQTT transports.
+
+Each transport has one ConnectionSupervisor that owns every reconnect attempt:
+
+    disconnected -> connecting -> connected -> (connection_lost) -> disconnected
+                        |
+                        v  attempt failed
+                     backoff -> connecting ...
+
+After a failed attempt it waits an exponentially growing delay (initial_delay,
+times multiplier per failure, up to max_delay) with random jitter, so stations
+that lost the broker at the same moment don't retry in lockstep. Reporting a
+lost connection several times, from several threads, still gives a single
+retry loop. A connection that drops within stable_time of being made counts
+as a failure too, so a flapping link backs off instead of reconnecting in a
+tight loop. A process-wide semaphore caps how many attempts run at once.
+
+Run it in its own thread with start(), or call attempt() from an event loop
+and sleep the returned delay (see async_runtime).
+"""
+import logging
+import random
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DISCONNECTED = "disconnected"
+CONNECTING = "connecting"
+CONNECTED = "connected"
+BACKOFF = "backoff"
+STOPPED = "stopped"
+STATES = (DISCONNECTED, CONNECTING, CONNECTED, BACKOFF, STOPPED)
+
+# Connection attempts allowed at the same time across all transports
+MAX_CONCURRENT_ATTEMPTS = 2
+_attempt_slots = threading.BoundedSemaphore(MAX_CONCURRENT_ATTEMPTS)
+
+
+class ConnectionSupervisor:
+    def __init__(self, name, connect, initial_delay=1.0, max_delay=60.0, multiplier=2.0, jitter=0.2,
+                 stable_time=30.0, metric_labels=None):
+        self.name = name
+        self.connect = connect        # returns True once connected; False or an exception is a failure
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.stable_time = stable_time
+
+        self.lock = threading.Lock()
+        self.wake = threading.Event()      # set when a (re)connect is needed
+        self.stopping = threading.Event()
+        self.thread = None
+        self.state = DISCONNECTED
+        self.delay = initial_delay         # backoff before the next retry, before jitter
+        self.not_before = 0.0              # monotonic time of the earliest next attempt
+        self.lost_while_connecting = False
+
+        self.stats = {"attempts": 0, "failures": 0, "connects": 0, "disconnects": 0, "consecutive_failures": 0}
+        self.connected_since = None
+        self.total_uptime = 0.0
+        self.last_error = None
+
+        self.metric_labels = dict(metric_labels or {}, transport=name)
+        metrics.add_collector(self.collect_metrics)
+
+    def start(self):
+        """Connect in a background thread and keep reconnecting until stop()."""
+        self.wake.set()
+        self.thread = threading.Thread(target=self.run, name=f"{self.name}-supervisor", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.wake.wait()
+            self.wake.clear()
+            while not self.stopping.is_set():
+                delay = self.attempt()
+                if not delay:
+                    break
+                logger.info("%s not connected, retrying in %.1f seconds", self.name, delay)
+                if self.stopping.wait(delay):
+                    return
+
+    def attempt(self) -> float:
+        """Make one connection attempt. Returns 0 once connected, else the delay before the next one."""
+        with self.lock:
+            if self.state == STOPPED:
+                return 0
+            wait = self.not_before - time.monotonic()
+            if wait > 0:
+                return wait
+            self.state = CONNECTING
+            self.lost_while_connecting = False
+            self.stats["attempts"] += 1
+
+        error = None
+        with _attempt_slots:
+            try:
+                ok = bool(self.connect())
+            except Exception as e:
+                ok = False
+                error = e
+
+        with self.lock:
+            if self.state == STOPPED:
+                return 0
+            if ok and not self.lost_while_connecting:
+                self.state = CONNECTED
+                self.connected_since = time.monotonic()
+                self.stats["connects"] += 1
+                self.stats["consecutive_failures"] = 0
+                return 0
+            self.state = BACKOFF
+            self.last_error = repr(error) if error else None
+            self.stats["failures"] += 1
+            self.stats["consecutive_failures"] += 1
+            delay = self.back_off()
+        if error:
+            logger.debug("%s connection attempt failed: %s", self.name, error)
+        return delay
+
+    def back_off(self) -> float:
+        """Schedule the next attempt after the current delay plus jitter and grow the delay. Needs the lock."""
+        delay = self.delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+        self.delay = min(self.delay * self.multiplier, self.max_delay)
+        delay = min(delay, self.max_delay)
+        self.not_before = time.monotonic() + delay
+        return delay
+
+    def connection_lost(self, reason=None):
+        """Report that the transport dropped; safe to call repeatedly and from any thread."""
+        with self.lock:
+            if self.state == CONNECTING:
+                # The attempt in flight succeeded at first but the link is gone again
+                self.lost_while_connecting = True
+                return
+            if self.state != CONNECTED:
+                return
+            self.state = DISCONNECTED
+            uptime = time.monotonic() - self.connected_since
+            self.total_uptime += uptime
+            self.connected_since = None
+            self.stats["disconnects"] += 1
+            if uptime >= self.stable_time:
+                self.delay = self.initial_delay
+                self.not_before = 0.0
+            else:
+                self.back_off()
+        logger.warning("%s connection lost after %.1f seconds: %s", self.name, uptime, reason)
+        self.wake.set()
+
+    def is_connected(self):
+        return self.state == CONNECTED
+
+    def uptime(self) -> float:
+        """Seconds since the current connection was made, 0 while disconnected."""
+        since = self.connected_since
+        return time.monotonic() - since if since is not None else 0.0
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats, state=self.state, next_delay=self.delay, last_error=self.last_error)
+        stats["uptime"] = self.uptime()
+        stats["total_uptime"] = self.total_uptime + stats["uptime"]
+        return stats
+
+    def collect_metrics(self):
+        labels = self.metric_labels
+        stats = self.get_stats()
+        yield "connection_up", "gauge", "1 while the transport is connected", labels, int(stats["state"] == CONNECTED)
+        yield "connection_uptime_seconds", "gauge", "Seconds since the current connection was made", labels, stats["uptime"]
+        yield "connection_attempts_total", "counter", "Connection attempts", labels, stats["attempts"]
+        yield "connection_failures_total", "counter", "Failed connection attempts", labels, stats["failures"]
+        yield "connection_disconnects_total", "counter", "Established connections that dropped", labels, stats["disconnects"]
+
+    def stop(self):
+        with self.lock:
+            if self.state == CONNECTED:
+                self.total_uptime += time.monotonic() - self.connected_since
+                self.connected_since = None
+            self.state = STOPPED
+        self.stopping.set()
+        self.wake.set()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join()
+        metrics.REGISTRY.remove_collector(self.collect_metrics)
@@ -0,0 +1,125 @@
+"""Bounded telemetry history kept in a memory-mapped ring buffer file.
+
+Each record is 12 bytes: a float64 timestamp and three bitfields (the
+station's inputs, its outputs/mode flags and the downstream levels). The file
+has a fixed size, so memory and disk use stay bounded. Appending a record
+writes 12 bytes into the mapping plus the head counter in the header, and the
+kernel writes the dirty pages back, so the history survives restarts without
+ever rewriting the whole file.
+
+Queries return NumPy structured arrays (fields timestamp, inputs, flags,
+downstream) when NumPy is installed, otherwise a list of tuples.
+"""
+import mmap
+import os
+import struct
+import threading
+from typing import Optional
+
+import serial_protocol
+
+try:
+    import numpy as np
+except ImportError:  # history still records without NumPy, queries return tuples
+    np = None
+
+MAGIC = b"PSTH"
+VERSION = 1
+HEADER = struct.Struct("<4sHHIQ")   # magic, version, record size, capacity, records written
+HEADER_SIZE = 64                     # header padded so records stay aligned
+TOTAL_OFFSET = 12                    # offset of "records written" in the header
+RECORD = struct.Struct("<dBBBx")     # timestamp, inputs, flags, downstream
+
+# inputs: same bit layout as the binary serial protocol (serial_protocol.INPUT_BITS)
+pack_inputs = serial_protocol.pack_inputs
+
+# flags
+PUMP_COMMAND = 1 << 0       # last pump_control sent to the Arduino
+CONNECTED = 1 << 1          # connected status LED
+SOFT_MANUAL = 1 << 2
+NEXT_ONLINE = 1 << 3
+LOCAL_MODE = 1 << 4
+
+# downstream: control_engine.DOWNSTREAM_EMPTY / DOWNSTREAM_FULL plus
+DOWNSTREAM_AUTO = 1 << 2    # every downstream station in auto (op_mode)
+
+if np is not None:
+    RECORD_DTYPE = np.dtype([("timestamp", "<f8"), ("inputs", "u1"), ("flags", "u1"),
+                             ("downstream", "u1"), ("pad", "u1")])
+
+
+class TelemetryHistory:
+    def __init__(self, path: str, capacity: int = 65536):
+        self.path = path
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        size = HEADER_SIZE + capacity * RECORD.size
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+            self.mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        magic, version, record_size, file_capacity, total = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size or file_capacity != capacity:
+            # New file, or one written with a different layout: start over
+            total = 0
+            HEADER.pack_into(self.mm, 0, MAGIC, VERSION, RECORD.size, capacity, total)
+        self.total = total
+
+    def append(self, timestamp: float, inputs: int, flags: int = 0, downstream: int = 0):
+        """Record one sample, overwriting the oldest once the buffer is full."""
+        with self.lock:
+            index = self.total % self.capacity
+            RECORD.pack_into(self.mm, HEADER_SIZE + index * RECORD.size, timestamp, inputs, flags, downstream)
+            self.total += 1
+            struct.pack_into("<Q", self.mm, TOTAL_OFFSET, self.total)
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+    def query(self, start: Optional[float] = None, end: Optional[float] = None):
+        """Return the records with start <= timestamp <= end, oldest first."""
+        with self.lock:
+            count = len(self)
+            head = self.total % self.capacity
+            if np is None:
+                return self._query_tuples(count, head, start, end)
+            data = np.frombuffer(self.mm, dtype=RECORD_DTYPE, count=self.capacity, offset=HEADER_SIZE)
+            if self.total > self.capacity:
+                records = np.concatenate((data[head:], data[:head]))
+            else:
+                records = data[:count].copy()
+
+        if start is not None or end is not None:
+            stamps = records["timestamp"]
+            mask = np.ones(len(records), dtype=bool)
+            if start is not None:
+                mask &= stamps >= start
+            if end is not None:
+                mask &= stamps <= end
+            records = records[mask]
+        return records
+
+    def _query_tuples(self, count, head, start, end):
+        first = head if self.total > self.capacity else 0
+        records = []
+        for i in range(count):
+            offset = HEADER_SIZE + (first + i) % self.capacity * RECORD.size
+            record = RECORD.unpack_from(self.mm, offset)
+            if (start is None or record[0] >= start) and (end is None or record[0] <= end):
+                records.append(record)
+        return records
+
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        self.flush()
+        self.mm.close()
@@ -0,0 +1,161 @@
+"""Record a station's serial and MQTT traffic for replay (see traffic_replay).
+
+A station created with traffic_log_path="/var/lib/pumps/traffic.log" records
+everything that reaches it, timestamped:
+
+- the raw bytes read from the serial port (JSON lines or binary frames)
+- the commands written to the Arduino
+- every MQTT message on its connection, and the connection going up and down
+
+Each record is
+
+    TIMESTAMP(float64)  KIND  LENGTH(uint16)  BODY
+
+after a "PTRL" file header. MQTT bodies start with a 16-bit topic id, the
+topic itself is written once per file, so a binary status frame costs 20
+bytes and an alive pulse about 50. A restart starts a new log, keeping the
+previous one as traffic.log.old, and so does the log reaching half of
+max_bytes, so at most max_bytes are kept on disk.
+
+    python src/traffic_replay.py dump traffic.log
+"""
+import heapq
+import json
+import logging
+import os
+import struct
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"PTRL"
+VERSION = 1
+FILE_HEADER = struct.Struct("<4sH")   # magic, version
+RECORD = struct.Struct("<dBH")        # timestamp, kind, body length
+TOPIC_ID = struct.Struct("<H")
+MAX_BODY = 0xFFFF
+
+# Record kinds
+SERIAL_IN = 1       # bytes read from the serial port
+SERIAL_OUT = 2      # command written to the Arduino, as JSON
+MQTT_IN = 3         # TOPIC_ID + payload of a received message
+MQTT_RETAINED = 4   # the same, delivered from the broker's retained store
+MQTT_UP = 5         # connected to the broker
+MQTT_DOWN = 6       # connection lost
+TOPIC = 7           # TOPIC_ID + topic name, before the topic's first message in a file
+KIND_NAMES = {SERIAL_IN: "serial_in", SERIAL_OUT: "serial_out", MQTT_IN: "mqtt_in",
+              MQTT_RETAINED: "mqtt_retained", MQTT_UP: "mqtt_up", MQTT_DOWN: "mqtt_down"}
+
+# (timestamp, kind, topic or None, body)
+Record = Tuple[float, int, Optional[str], bytes]
+
+
+class TrafficRecorder:
+    def __init__(self, path: str, max_bytes: int = 64 * 1024 * 1024, flush_interval: float = 5.0,
+                 clock: Callable[[], float] = time.time):
+        self.path = path
+        self.old_path = path + ".old"
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.last_time = 0.0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = None
+        self.open()
+
+    def open(self):
+        """Start a new log file, keeping the previous one as .old. Needs the lock (or __init__)."""
+        if os.path.exists(self.path) and os.path.getsize(self.path):
+            os.replace(self.path, self.old_path)
+        self.file = open(self.path, "wb")
+        self.file.write(FILE_HEADER.pack(MAGIC, VERSION))
+        self.size = FILE_HEADER.size
+        self.topics = {}
+        self.last_flush = self.clock()
+
+    def write(self, kind: int, body: bytes):
+        """Append a record. Needs the lock."""
+        if len(body) > MAX_BODY:
+            self.dropped += 1
+            return
+        # Keep the log ordered if the wall clock steps back
+        now = self.last_time = max(self.clock(), self.last_time)
+        self.file.write(RECORD.pack(now, kind, len(body)))
+        self.file.write(body)
+        self.size += RECORD.size + len(body)
+        if self.size >= self.max_bytes // 2:
+            self.file.close()
+            self.open()
+        elif now - self.last_flush >= self.flush_interval:
+            self.file.flush()
+            self.last_flush = now
+
+    def serial_in(self, chunk: bytes):
+        with self.lock:
+            if self.file is not None:
+                self.write(SERIAL_IN, bytes(chunk))
+
+    def serial_out(self, command: Dict):
+        with self.lock:
+            if self.file is not None:
+                self.write(SERIAL_OUT, json.dumps(command, separators=(",", ":")).encode())
+
+    def mqtt_message(self, topic: str, payload: bytes, retain: bool = False):
+        with self.lock:
+            if self.file is None:
+                return
+            topic_id = self.topics.get(topic)
+            if topic_id is None:
+                topic_id = self.topics[topic] = len(self.topics)
+                self.write(TOPIC, TOPIC_ID.pack(topic_id) + topic.encode())
+            self.write(MQTT_RETAINED if retain else MQTT_IN, TOPIC_ID.pack(topic_id) + payload)
+
+    def mqtt_state(self, connected: bool):
+        with self.lock:
+            if self.file is not None:
+                self.write(MQTT_UP if connected else MQTT_DOWN, b"")
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def read(path: str) -> Iterator[Record]:
+    """Records of one log file, stopping at a torn record at the end."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < FILE_HEADER.size:
+        return
+    magic, version = FILE_HEADER.unpack_from(data)
+    if magic != MAGIC or version > VERSION:
+        raise ValueError(f"{path} is not a traffic log (version {VERSION})")
+    topics = {}
+    pos = FILE_HEADER.size
+    while pos + RECORD.size <= len(data):
+        timestamp, kind, length = RECORD.unpack_from(data, pos)
+        start = pos + RECORD.size
+        pos = start + length
+        if pos > len(data):
+            logger.warning("Traffic log %s: stopping at a torn record at offset %d", path, start - RECORD.size)
+            return
+        if kind == TOPIC:
+            topic_id, = TOPIC_ID.unpack_from(data, start)
+            topics[topic_id] = data[start + TOPIC_ID.size:pos].decode()
+        elif kind in (MQTT_IN, MQTT_RETAINED):
+            topic_id, = TOPIC_ID.unpack_from(data, start)
+            yield timestamp, kind, topics[topic_id], data[start + TOPIC_ID.size:pos]
+        else:
+            yield timestamp, kind, None, data[start:pos]
+
+
+def read_all(paths: Iterable[str]) -> Iterator[Record]:
+    """Records of several logs (e.g. traffic.log.old and traffic.log) in timestamp order."""
+    return heapq.merge(*(read(path) for path in paths), key=lambda record: record[0])
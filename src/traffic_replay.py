@@ -0,0 +1,345 @@
+"""Replay recorded station traffic (see traffic_log) on a virtual clock.
+
+The replayer feeds a log back into a PumpStation created with
+runtime="replay" and a VirtualClock. Nothing is opened: serial bytes go
+through SerialClient.feed, MQTT messages through MQTTClient.on_message, and
+the station's scheduler runs every timer (alive pulse, liveness deadlines,
+poll timeouts) at its virtual deadline in between. Days of traffic replay
+in seconds:
+
+    python src/traffic_replay.py replay --config config/station1.json \\
+        --trace replay.jsonl --check traffic.log.old traffic.log
+
+--trace writes what the station did (commands to the Arduino, MQTT
+publishes, mode changes) as JSON lines with virtual timestamps; the same
+log and code give the same trace, so traces of two versions can be
+diffed. --check compares the replayed commands with the ones the station
+wrote in the field. Polls are never answered in a replay, so a command
+from station 0 runs at once instead of after the Arduino's answer.
+"""
+import argparse
+import cProfile
+import json
+import logging
+import math
+import os
+import pstats
+import sys
+import tempfile
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import paho.mqtt.client as mqtt
+
+import payload_codec
+import pump_station
+import station_config
+from traffic_log import (KIND_NAMES, MQTT_DOWN, MQTT_IN, MQTT_RETAINED, MQTT_UP, SERIAL_IN, SERIAL_OUT, Record,
+                         read_all)
+
+# Commands written within this many seconds of each other reach the Arduino as
+# one write (see SerialClient.collect_pending), so only the last value counts
+COALESCE_WINDOW = 0.05
+
+# Station settings that make no sense in a replay: nothing is opened or recorded,
+# and the outbox would replay to the broker from a thread
+REPLAY_IGNORED = set(station_config.HOST_KEYS) | {
+    "serial_ports", "broker_port", "mqtt_keepalive", "runtime", "traffic_log_path", "traffic_log_max_bytes",
+}
+
+
+class VirtualClock:
+    """A clock that only moves when the replayer moves it."""
+
+    def __init__(self, now: float = 0.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class ReplayLink:
+    """Stands in for the paho client of a replayed station.
+
+    Publishes go to on_publish and the connection is up or down as the log
+    says; there is no network.
+    """
+
+    def __init__(self, on_publish):
+        self.on_publish = on_publish
+        self.connected = False
+
+    def is_connected(self) -> bool:
+        return self.connected
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        info = mqtt.MQTTMessageInfo(0)
+        if self.connected:
+            self.on_publish(topic, payload, retain)
+        else:
+            info.rc = mqtt.MQTT_ERR_NO_CONN
+        return info
+
+    def subscribe(self, *args, **kwargs):
+        return mqtt.MQTT_ERR_SUCCESS, 0
+
+    def unsubscribe(self, *args, **kwargs):
+        return mqtt.MQTT_ERR_SUCCESS, 0
+
+    def disconnect(self, *args, **kwargs):
+        pass
+
+    def loop_stop(self):
+        pass
+
+
+class Replayer:
+    """Drive a PumpStation from recorded traffic; kwargs are passed to PumpStation."""
+
+    def __init__(self, station_id: int, start_time: float, speed: Optional[float] = None, **kwargs):
+        self.clock = VirtualClock(start_time)
+        self.start_time = start_time
+        self.speed = speed       # None: as fast as possible, else virtual seconds per real second
+        self.outputs = []        # (virtual time, "serial" | "mqtt" | "mode", topic, data)
+        self.commands = {}       # last value sent per command key
+        self.recorded = []       # (time, command) the station wrote in the field
+        self.counts = dict.fromkeys(KIND_NAMES.values(), 0)
+        self.timer_runs = 0
+
+        # The startup report only makes sense for a real start
+        kwargs.setdefault("startup_timeout", math.inf)
+        self.station = pump_station.PumpStation(station_id, runtime="replay", clock=self.clock, **kwargs)
+        self.link = ReplayLink(self.on_publish)
+        self.station.mqtt_client.mqtt_client = self.link
+        self.station.serial_client.on_queued = self.on_serial_command
+        self.mode = self.station.mode
+
+    def on_publish(self, topic, payload, retain):
+        self.outputs.append((self.clock.now, "mqtt", topic, payload))
+
+    def on_serial_command(self):
+        """Take the commands the station queued for the Arduino, keeping the ones that change a value."""
+        for key, value in self.station.serial_client.collect_pending({}).items():
+            if key not in self.commands or self.commands[key] != value:
+                self.commands[key] = value
+                self.outputs.append((self.clock.now, "serial", None, {key: value}))
+
+    def check_mode(self):
+        if self.station.mode != self.mode:
+            self.mode = self.station.mode
+            self.outputs.append((self.clock.now, "mode", None, self.mode))
+
+    def advance(self, when: float):
+        """Run every timer due up to when, each at its own deadline."""
+        scheduler = self.station.scheduler
+        clock = self.clock
+        while True:
+            delay = scheduler.run_pending(clock.now)
+            if delay is None or clock.now + delay > when:
+                break
+            clock.now += delay
+            self.timer_runs += 1
+            self.check_mode()
+        clock.now = max(clock.now, when)
+
+    def apply(self, kind: int, topic: Optional[str], body: bytes):
+        mqtt_client = self.station.mqtt_client
+        if kind == SERIAL_IN:
+            # Arrival in real time, so the latency metrics measure the replay's own processing
+            self.station.serial_client.feed(body, time.monotonic())
+        elif kind in (MQTT_IN, MQTT_RETAINED):
+            message = mqtt.MQTTMessage(topic=topic.encode())
+            message.payload = body
+            message.retain = kind == MQTT_RETAINED
+            mqtt_client.on_message(self.link, None, message)
+        elif kind == MQTT_UP:
+            self.link.connected = True
+            mqtt_client.on_connect(self.link, None, None, 0)
+        elif kind == MQTT_DOWN:
+            self.link.connected = False
+            mqtt_client.on_disconnect(self.link, None, None, 0, None)
+        elif kind == SERIAL_OUT:
+            self.recorded.append((self.clock.now, json.loads(body)))
+        self.counts[KIND_NAMES[kind]] += 1
+        self.check_mode()
+
+    def run(self, records: Iterable[Record]) -> Dict:
+        """Replay records (in timestamp order) and return a summary."""
+        started = time.perf_counter()
+        for timestamp, kind, topic, body in records:
+            self.advance(timestamp)
+            self.apply(kind, topic, body)
+            if self.speed:
+                ahead = (self.clock.now - self.start_time) / self.speed - (time.perf_counter() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+        wall = time.perf_counter() - started
+        virtual = self.clock.now - self.start_time
+        return {
+            "records": self.counts,
+            "virtual_seconds": round(virtual, 3),
+            "wall_seconds": round(wall, 3),
+            "speedup": round(virtual / wall) if wall else None,
+            "timer_runs": self.timer_runs,
+            "outputs": {kind: sum(1 for output in self.outputs if output[1] == kind)
+                        for kind in ("serial", "mqtt", "mode")},
+        }
+
+    def check(self, tolerance: float = 1.0) -> Dict:
+        """Compare the replayed command changes with the commands written in the field, per key.
+
+        Changes are matched by value and time (within tolerance), so one
+        missing or extra change counts once. The last tolerance seconds of
+        the log are left out: the station may have stopped before writing (or
+        recording) its last commands.
+        """
+        end = self.clock.now - tolerance
+        recorded = [(when, data) for when, data in self.recorded if when <= end]
+        replayed = [(when, data) for when, kind, _, data in self.outputs if kind == "serial" and when <= end]
+        keys = sorted({key for _, command in recorded + replayed for key in command})
+        report = {}
+        for key in keys:
+            field, replay = command_changes(recorded, key), command_changes(replayed, key)
+            unmatched = align_changes(field, replay, tolerance)
+            result = {"field": len(field), "replay": len(replay), "mismatches": len(unmatched)}
+            if unmatched:
+                side, when, value = min(unmatched, key=lambda change: change[1])
+                result["first_mismatch"] = {side: [round(when, 3), value]}
+            report[key] = result
+        return report
+
+    def write_trace(self, path: str):
+        with open(path, "w") as f:
+            for when, kind, topic, data in self.outputs:
+                entry = {"t": round(when, 3), "kind": kind}
+                if topic is not None:
+                    entry["topic"] = topic
+                    try:
+                        data = payload_codec.decode(data if isinstance(data, bytes) else data.encode())
+                    except ValueError:
+                        data = repr(data)
+                entry["data"] = data
+                f.write(json.dumps(entry) + "\n")
+
+    def cleanup(self):
+        self.station.cleanup()
+
+
+def command_changes(commands: List[Tuple[float, Dict]], key: str,
+                    coalesce: float = COALESCE_WINDOW) -> List[Tuple[float, object]]:
+    """(time, value) each time the value of one command key changed.
+
+    A value replaced within coalesce seconds is left out: the serial writer
+    folds commands queued together into one write of the newest values.
+    """
+    values = [(when, command[key]) for when, command in commands if key in command]
+    changes = []
+    for i, (when, value) in enumerate(values):
+        if i + 1 < len(values) and values[i + 1][0] - when <= coalesce:
+            continue
+        if not changes or changes[-1][1] != value:
+            changes.append((when, value))
+    return changes
+
+
+def align_changes(field: List[Tuple[float, object]], replay: List[Tuple[float, object]],
+                  tolerance: float) -> List[Tuple[str, float, object]]:
+    """Match field and replayed changes of the same value within tolerance seconds, in
+    time order. Returns the unmatched ones as ("field" or "replay", time, value)."""
+    unmatched = []
+    i = j = 0
+    while i < len(field) and j < len(replay):
+        (field_time, field_value), (replay_time, replay_value) = field[i], replay[j]
+        if field_value == replay_value and abs(field_time - replay_time) <= tolerance:
+            i += 1
+            j += 1
+        elif replay_time < field_time:
+            unmatched.append(("replay", replay_time, replay_value))
+            j += 1
+        else:
+            unmatched.append(("field", field_time, field_value))
+            i += 1
+    unmatched += [("field", when, value) for when, value in field[i:]]
+    unmatched += [("replay", when, value) for when, value in replay[j:]]
+    return unmatched
+
+
+def replay_kwargs(config: Dict, station_id: int) -> Dict:
+    """PumpStation arguments to replay one station of a config file."""
+    for kwargs in station_config.stations(config):
+        if kwargs["station_id"] == station_id:
+            return {key: value for key, value in kwargs.items() if key not in REPLAY_IGNORED}
+    raise ValueError(f"station {station_id} is not in the config")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pump station traffic logs")
+    commands = parser.add_subparsers(dest="command", required=True)
+    dump = commands.add_parser("dump", help="print the records of traffic logs")
+    dump.add_argument("logs", nargs="+")
+    replay = commands.add_parser("replay", help="replay traffic logs into a station on a virtual clock")
+    replay.add_argument("logs", nargs="+", help="traffic logs, e.g. traffic.log.old traffic.log")
+    replay.add_argument("--config", help="station config file (see station_config.py)")
+    replay.add_argument("--station", type=int, help="station id (the only one in --config by default)")
+    replay.add_argument("--role", choices=("source", "intermediate", "monitor"),
+                        help="without --config: the station's role")
+    replay.add_argument("--speed", type=float, help="virtual seconds per real second (default: as fast as possible)")
+    replay.add_argument("--trace", help="write the station's outputs here as JSON lines")
+    replay.add_argument("--check", action="store_true", help="compare with the commands written in the field")
+    replay.add_argument("--tolerance", type=float, default=1.0, help="seconds a command may be off for --check")
+    replay.add_argument("--profile", action="store_true", help="print the functions the replay spent most time in")
+    args = parser.parse_args()
+
+    log_level = os.environ.get("PUMP_LOG_LEVEL", "WARNING").upper()
+    logging.basicConfig(level=log_level, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    if args.command == "dump":
+        for timestamp, kind, topic, body in read_all(args.logs):
+            print(f"{timestamp:.3f} {KIND_NAMES[kind]} {topic or ''} {body!r}")
+        return
+
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+        station_id = args.station
+        if station_id is None:
+            ids = [kwargs["station_id"] for kwargs in station_config.stations(config)]
+            if len(ids) != 1:
+                parser.error(f"--config has stations {ids}, pick one with --station")
+            station_id = ids[0]
+        kwargs = replay_kwargs(config, station_id)
+    elif args.station is not None and args.role:
+        kwargs = {"station_id": args.station, "role": args.role,
+                  "control_pump": args.role != "monitor", "has_tank": args.role != "source"}
+    else:
+        parser.error("give --config or --station and --role")
+
+    first = next(read_all(args.logs), None)
+    if first is None:
+        parser.error("the logs hold no records")
+    with tempfile.TemporaryDirectory() as directory:
+        if kwargs.get("history_path"):
+            # A fresh history, so the adaptive local schedule learns from the replayed traffic only
+            kwargs["history_path"] = os.path.join(directory, "history.bin")
+        replayer = Replayer(kwargs.pop("station_id"), first[0], speed=args.speed, **kwargs)
+        profile = cProfile.Profile() if args.profile else None
+        if profile is not None:
+            profile.enable()
+        report = replayer.run(read_all(args.logs))
+        if profile is not None:
+            profile.disable()
+        if args.check:
+            report["check"] = replayer.check(args.tolerance)
+        if args.trace:
+            replayer.write_trace(args.trace)
+        replayer.cleanup()
+
+    print(json.dumps(report, indent=2))
+    if profile is not None:
+        pstats.Stats(profile, stream=sys.stderr).sort_stats("cumulative").print_stats(25)
+    if args.check and any(result["mismatches"] for result in report["check"].values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
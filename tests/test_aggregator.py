@@ -0,0 +1,51 @@
+import json
+
+import paho.mqtt.client as mqtt
+import pytest
+
+import aggregator
+
+
+@pytest.fixture
+def fleet():
+    fleet = aggregator.FleetAggregator(start=False)
+    yield fleet
+    fleet.cleanup()
+
+
+def deliver(fleet, topic, payload):
+    """Hand a message to the aggregator the way paho's network thread does."""
+    message = mqtt.MQTTMessage(topic=topic.encode())
+    message.payload = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+    fleet.mqtt_client.on_message(None, None, message)
+
+
+@pytest.mark.parametrize("payload", [b"42", b"null", b'"x"', b"[1, 2]", b"not json"])
+def test_non_object_payloads_are_dropped(fleet, payload):
+    deliver(fleet, "pumps/6/telemetry", payload)
+    deliver(fleet, "pumps/6/alive", payload)
+    deliver(fleet, "pumps/7/telemetry", {"station_id": 7, "pump_status": True})
+    assert fleet.table.get(6) is None
+    assert fleet.table.get(7)["pump_status"] is True
+
+
+@pytest.mark.parametrize("data", [
+    {"last_time_of_next_station": "x"},
+    {"last_time_of_next_station": [1]},
+    {"pump_status": "false"},
+    {"top_level": 1},
+])
+def test_malformed_fields_are_rejected(fleet, data):
+    deliver(fleet, "pumps/6/telemetry", dict(data, station_id=6))
+    assert fleet.table.get(6) is None
+    deliver(fleet, "pumps/6/telemetry", {"station_id": 6, "pump_status": True, "last_time_of_next_station": 12.5})
+    row = fleet.table.get(6)
+    assert row["pump_status"] is True
+    assert row["last_time_of_next_station"] == 12.5
+
+
+def test_handlers_ignore_non_objects(fleet):
+    fleet.on_telemetry(42)
+    fleet.on_alive("hello")
+    fleet.on_alive({"_topic": "pumps/7/alive", "status": "ALIVE"})
+    assert fleet.table.get(7)["status"] == "ONLINE"
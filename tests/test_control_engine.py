@@ -0,0 +1,131 @@
+"""ControlEngine against the original station 1/2/3 logic of PumpStation.
+
+The baseline_* functions restate the pre-engine handle_network_mode,
+handle_local_mode, set_pump command handling and start_pump/stop_pump
+guards, returning the pump command they sent: True, False, None for none,
+or "timer" where station 1 handed over to its local on/off timer.
+"""
+import itertools
+
+import pytest
+
+import control_engine
+from control_engine import ControlEngine
+
+# (role, baseline station id, control_pump, has_tank)
+STATIONS = [
+    (control_engine.SOURCE, 1, True, False),
+    (control_engine.INTERMEDIATE, 2, True, True),
+    (control_engine.MONITOR, 3, False, True),
+]
+ACTIONS = {control_engine.NONE: None, control_engine.START: True, control_engine.STOP: False,
+           control_engine.TIMER: "timer"}
+MISSING = object()
+
+
+def inputs():
+    """Every combination of pressure_ok, top_level, bottom_level, fault."""
+    return itertools.product((False, True), repeat=4)
+
+
+def downstream_statuses():
+    """The next station's bottom_level/top_level, each True, False or not reported."""
+    for bottom, top in itertools.product((False, True, MISSING), repeat=2):
+        status = {}
+        if bottom is not MISSING:
+            status["bottom_level"] = bottom
+        if top is not MISSING:
+            status["top_level"] = top
+        yield status
+
+
+def baseline_start(station, control_pump, pressure, top, fault):
+    if not control_pump:
+        return None
+    if station == 1:
+        return True if pressure and not fault else None
+    return True if not top and not fault else None
+
+
+def baseline_stop(control_pump):
+    return False if control_pump else None
+
+
+def baseline_network(station, control_pump, pressure, top, bottom, fault, data):
+    if station == 1:
+        if not pressure:
+            return baseline_stop(control_pump)
+        if not data.get("bottom_level", True) and not data.get("top_level", True) and not fault:
+            return baseline_start(station, control_pump, pressure, top, fault)
+        if data.get("bottom_level", False) and data.get("top_level", False):
+            return baseline_stop(control_pump)
+    elif station == 2:
+        if not bottom and not top:
+            return baseline_stop(control_pump)
+        if not data.get("bottom_level", True) and not data.get("top_level", True) and not fault:
+            return baseline_start(station, control_pump, pressure, top, fault)
+        if data.get("bottom_level", False) and data.get("top_level", False):
+            return baseline_stop(control_pump)
+    return None
+
+
+def baseline_local(station, control_pump, pressure, top, bottom, fault):
+    if station == 1 and not fault:
+        return "timer" if pressure else baseline_stop(control_pump)
+    if station == 2 and not fault:
+        if top and bottom:
+            return baseline_start(station, control_pump, pressure, top, fault)
+        if not top and not bottom:
+            return baseline_stop(control_pump)
+    return None
+
+
+def baseline_manual(station, control_pump, pressure, top, bottom, fault, value):
+    if not value:
+        return baseline_stop(control_pump)
+    if station == 1 and pressure:
+        return baseline_start(station, control_pump, pressure, top, fault)
+    if station == 2 and not bottom:
+        return baseline_start(station, control_pump, pressure, top, fault)
+    return None
+
+
+@pytest.mark.parametrize("role, station, control_pump, has_tank", STATIONS)
+def test_default_role(role, station, control_pump, has_tank):
+    assert control_engine.default_role(control_pump, has_tank) == role
+
+
+@pytest.mark.parametrize("role, station, control_pump, has_tank", STATIONS)
+def test_network(role, station, control_pump, has_tank):
+    engine = ControlEngine(role, control_pump)
+    for (pressure, top, bottom, fault), data in itertools.product(inputs(), downstream_statuses()):
+        local = control_engine.local_bits(pressure, top, bottom, fault)
+        action = engine.network(local, control_engine.downstream_bits([data]))
+        expected = baseline_network(station, control_pump, pressure, top, bottom, fault, data)
+        assert ACTIONS[action] == expected, (pressure, top, bottom, fault, data)
+
+
+@pytest.mark.parametrize("role, station, control_pump, has_tank", STATIONS)
+def test_local(role, station, control_pump, has_tank):
+    engine = ControlEngine(role, control_pump)
+    for pressure, top, bottom, fault in inputs():
+        action = engine.local(control_engine.local_bits(pressure, top, bottom, fault))
+        expected = baseline_local(station, control_pump, pressure, top, bottom, fault)
+        assert ACTIONS[action] == expected, (pressure, top, bottom, fault)
+
+
+@pytest.mark.parametrize("role, station, control_pump, has_tank", STATIONS)
+def test_manual(role, station, control_pump, has_tank):
+    engine = ControlEngine(role, control_pump)
+    for (pressure, top, bottom, fault), value in itertools.product(inputs(), (False, True)):
+        action = engine.manual(control_engine.local_bits(pressure, top, bottom, fault), value)
+        expected = baseline_manual(station, control_pump, pressure, top, bottom, fault, value)
+        assert ACTIONS[action] == expected, (pressure, top, bottom, fault, value)
+
+
+@pytest.mark.parametrize("role, station, control_pump, has_tank", STATIONS)
+def test_can_start(role, station, control_pump, has_tank):
+    engine = ControlEngine(role, control_pump)
+    for pressure, top, bottom, fault in inputs():
+        can_start = engine.can_start(control_engine.local_bits(pressure, top, bottom, fault))
+        assert can_start == (baseline_start(station, control_pump, pressure, top, fault) is True)